@@ -0,0 +1,87 @@
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bencode import bdecode, bdecode_spans, bencode
+
+try:
+    import bcoding
+except ImportError:
+    bcoding = None
+
+# Built-in bencode against bcoding: loading a multi-MB multi-file torrent and
+# computing its info hash (bcoding decodes, then re-encodes the info dictionary
+# to hash it; bdecode_spans hashes the original bytes), and encoding/decoding
+# the small messages sent to peers (extended handshakes) many times over.
+
+
+# Synthetic torrent with many files and a long pieces string
+def make_torrent(num_files: int, piece_length: int, file_length: int) -> bytes:
+    total = num_files * file_length
+    num_pieces = (total + piece_length - 1) // piece_length
+    files = [{'length': file_length, 'path': [f'dir{i // 1000}', f'file{i}.bin']} for i in range(num_files)]
+    info = {'name': 'bench', 'piece length': piece_length,
+            'pieces': os.urandom(20 * num_pieces), 'files': files}
+    return bencode({'announce': 'http://tracker.example/announce', 'info': info})
+
+
+def best_of(repeat: int, function) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bcoding_info_hash(data: bytes) -> bytes:
+    meta = bcoding.bdecode(data)
+    return hashlib.sha1(bcoding.bencode(meta['info'])).digest()
+
+
+def builtin_info_hash(data: bytes) -> bytes:
+    _, spans = bdecode_spans(data, [b'info'])
+    start, end = spans[b'info']
+    return hashlib.sha1(memoryview(data)[start:end]).digest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--piece-kib', type=int, default=256)
+    parser.add_argument('--file-kib', type=int, default=512)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = make_torrent(args.files, args.piece_kib * 1024, args.file_kib * 1024)
+    print(f"torrent with {args.files} files: {len(data) / 1e6:.1f} MB")
+
+    handshake = {'m': {'ut_metadata': 3, 'ut_pex': 1}, 'v': 'PC0001', 'reqq': 250,
+                 'p': 6881, 'yourip': b'\x7f\x00\x00\x01'}
+    encoded = bencode(handshake)
+    messages = range(args.messages)
+
+    implementations = [('builtin', builtin_info_hash, bdecode, bencode)]
+    if bcoding is not None:
+        assert bcoding.bencode(handshake) == encoded
+        assert bcoding_info_hash(data) == builtin_info_hash(data)
+        implementations.insert(0, ('bcoding', bcoding_info_hash, bcoding.bdecode, bcoding.bencode))
+    else:
+        print("bcoding is not installed; timing the built-in codec only")
+
+    for name, info_hash, decode, encode in implementations:
+        load = best_of(args.repeat, lambda: info_hash(data))
+        decode_time = best_of(args.repeat, lambda: [decode(encoded) for _ in messages])
+        encode_time = best_of(args.repeat, lambda: [encode(handshake) for _ in messages])
+        print(f"{name:8s} load + info hash {load * 1e3:8.1f} ms ({len(data) / load / 1e6:6.1f} MB/s) | "
+              f"handshake decode {decode_time / args.messages * 1e6:6.2f} us, "
+              f"encode {encode_time / args.messages * 1e6:6.2f} us")
+
+
+if __name__ == '__main__':
+    main()
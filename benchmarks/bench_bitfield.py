@@ -0,0 +1,120 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitfield import Bitfield
+
+try:
+    from bitstring import BitArray
+except ImportError:
+    BitArray = None
+
+# Peer bitfield operations on a torrent with many pieces: bitstring.BitArray as
+# PeerConnection used it, versus Bitfield. Covers building from the BITFIELD
+# payload, has_piece over every piece (what the picker does on each scheduler
+# pass) for a seed and for a peer with half the pieces, popcount, listing the
+# set bits for the picker, AND-NOT against our pieces and HAVE updates.
+
+
+def timed(function, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# The checks PeerConnection made with each implementation
+def bitarray_has(bits, index: int) -> bool:
+    return index < len(bits) and bits[index]
+
+
+def bitarray_ops(payload: bytes, ours: bytes, num_pieces: int, haves):
+    def scan(bits):
+        return lambda: sum(1 for index in range(num_pieces) if bitarray_has(bits, index))
+
+    def have():
+        bits = BitArray(bytes=payload)
+        for index in haves:
+            if index < len(bits) and not bits[index]:
+                bits[index] = True
+
+    peer = BitArray(bytes=payload)
+    seed = BitArray(bytes=b'\xff' * len(payload))
+    mine = BitArray(bytes=ours)
+    return {
+        'build': lambda: BitArray(bytes=payload),
+        'has_piece, seed': scan(seed),
+        'has_piece, half': scan(peer),
+        'popcount': lambda: peer.count(True),
+        'set bits': lambda: list(peer.findall([1])),
+        'AND-NOT': lambda: (peer & ~mine).any(True),
+        'HAVE updates': have,
+    }
+
+
+def bitfield_ops(payload: bytes, ours: bytes, num_pieces: int, haves):
+    def scan(bits):
+        has = bits.has
+        return lambda: sum(1 for index in range(num_pieces) if has(index))
+
+    def have():
+        bits = Bitfield.from_bytes(payload, num_pieces)
+        for index in haves:
+            bits.set(index)
+
+    peer = Bitfield.from_bytes(payload, num_pieces)
+    seed = Bitfield.from_bytes(b'\xff' * len(payload), num_pieces)
+    mine = Bitfield.from_bytes(ours, num_pieces)
+    return {
+        'build': lambda: Bitfield.from_bytes(payload, num_pieces),
+        'has_piece, seed': scan(seed),
+        'has_piece, half': scan(peer),
+        'popcount': lambda: peer.count,
+        'set bits': lambda: peer.set_indices(),
+        'AND-NOT': lambda: peer.any_and_not(mine),
+        'HAVE updates': have,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pieces', type=int, default=1_000_000)
+    parser.add_argument('--haves', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    num_pieces = args.pieces
+    size = (num_pieces + 7) // 8
+    payload = bytearray(rng.getrandbits(8) for _ in range(size))
+    if num_pieces % 8:
+        payload[-1] &= (0xff << (8 - num_pieces % 8)) & 0xff
+    payload = bytes(payload)
+    ours = bytes(rng.getrandbits(8) for _ in range(size))
+    haves = [rng.randrange(num_pieces) for _ in range(args.haves)]
+    print(f"{num_pieces} pieces, peer has about half, {args.haves} HAVEs")
+
+    results = {}
+    implementations = [('Bitfield', bitfield_ops)]
+    if BitArray is not None:
+        implementations.insert(0, ('BitArray', bitarray_ops))
+    else:
+        print("bitstring is not installed; timing Bitfield only")
+
+    for name, ops in implementations:
+        for op, function in ops(payload, ours, num_pieces, haves).items():
+            results.setdefault(op, {})[name] = timed(function, args.repeat)
+
+    print(f"{'':18s}" + ''.join(f"{name:>14s}" for name, _ in implementations))
+    for op, times in results.items():
+        print(f"{op:18s}" + ''.join(f"{times[name] * 1e3:11.2f} ms" for name, _ in implementations))
+
+
+if __name__ == '__main__':
+    main()
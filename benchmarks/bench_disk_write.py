@@ -0,0 +1,200 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_manager import FileManager
+from file_table import FileTable
+
+# Sustained MB/s writing completed pieces to a multi-file torrent on a local
+# filesystem: the original synchronous seek+write+flush per piece per file under
+# a global lock, versus FileManager's background writer that coalesces adjacent
+# pieces into vectored positional writes issued from a disk thread pool. Pieces
+# complete in random order, as they do with rarest-first picking (or in order
+# with --sequential), and the producer is held to a buffer budget the way the
+# picker is. "blocked" is the time the thread completing pieces spent inside
+# write_piece, stalled behind the disk. With more --files than the descriptor
+# limit the legacy writer fails, while FileManager's handle cache stays within
+# --max-open-files.
+
+
+# Just enough of TorrentFile for FileManager, plus the original file list for LegacyWriter
+class StubTorrent:
+    def __init__(self, piece_length: int, file_lengths):
+        self.piece_length = piece_length
+        self.files = FileTable()
+        self.file_list = []
+        offset = 0
+        for i, length in enumerate(file_lengths):
+            self.files.append(['bench', f'file{i}.bin'], length)
+            self.file_list.append({'path': ['bench', f'file{i}.bin'], 'length': length, 'offset': offset})
+            offset += length
+        self.total_length = offset
+        self.num_pieces = (offset + piece_length - 1) // piece_length
+
+    def get_piece_length(self, piece_index: int) -> int:
+        return min(self.piece_length, self.total_length - piece_index * self.piece_length)
+
+    def get_files_for_piece(self, piece_index: int):
+        piece_start = piece_index * self.piece_length
+        piece_end = piece_start + self.get_piece_length(piece_index)
+        return [f for f in self.file_list
+                if piece_start < f['offset'] + f['length'] and piece_end > f['offset']]
+
+
+# Copy of the original write path
+class LegacyWriter:
+    def __init__(self, torrent, download_dir: str):
+        self.torrent = torrent
+        self.download_dir = download_dir
+        self.lock = threading.Lock()
+        self.file_handles = {}
+        self.write_calls = 0
+        for file_info in torrent.file_list:
+            os.makedirs(os.path.dirname(os.path.join(download_dir, *file_info['path'])), exist_ok=True)
+
+    def write_piece(self, piece_index: int, piece_data: memoryview):
+        with self.lock:
+            print(f"Writing piece {piece_index} to disk ({len(piece_data)} bytes)")
+            piece_offset = piece_index * self.torrent.piece_length
+            for file_info in self.torrent.get_files_for_piece(piece_index):
+                file_start = file_info['offset']
+                overlap_start = max(piece_offset, file_start)
+                overlap_end = min(piece_offset + len(piece_data), file_start + file_info['length'])
+                if overlap_start < overlap_end:
+                    piece_read_pos = overlap_start - piece_offset
+                    self._write_to_file(file_info, overlap_start - file_start,
+                                        piece_data[piece_read_pos:piece_read_pos + overlap_end - overlap_start])
+
+    def _write_to_file(self, file_info, position: int, data: memoryview):
+        file_path = os.path.join(self.download_dir, *file_info['path'])
+        if file_path not in self.file_handles:
+            if not os.path.exists(file_path):
+                with open(file_path, 'wb') as f:
+                    f.seek(file_info['length'] - 1)
+                    f.write(b'\0')
+            self.file_handles[file_path] = open(file_path, 'r+b')
+        file_handle = self.file_handles[file_path]
+        file_handle.seek(position)
+        file_handle.write(data)
+        file_handle.flush()
+        self.write_calls += 1
+        print(f"Wrote {len(data)} bytes to {file_path} at position {position}")
+
+    def cleanup(self):
+        for file_handle in self.file_handles.values():
+            os.fsync(file_handle.fileno())
+            file_handle.close()
+
+
+def run_legacy(torrent, directory: str, order, piece_data: memoryview, budget: int):
+    writer = LegacyWriter(torrent, directory)
+    blocked = 0.0
+    for piece_index in order:
+        start = time.perf_counter()
+        writer.write_piece(piece_index, piece_data[:torrent.get_piece_length(piece_index)])
+        blocked += time.perf_counter() - start
+    writer.cleanup()
+    return writer.write_calls, blocked, None
+
+
+def run_write_behind(torrent, directory: str, order, piece_data: memoryview, budget: int,
+                     disk_workers: int, max_open_files: int):
+    manager = FileManager(torrent, directory, disk_workers, max_open_files)
+    in_flight = [0]
+    budget_condition = threading.Condition()
+
+    def on_piece_written(piece_index, written):
+        with budget_condition:
+            in_flight[0] -= torrent.get_piece_length(piece_index)
+            budget_condition.notify()
+
+    manager.on_piece_written = on_piece_written
+    blocked = 0.0
+    for piece_index in order:
+        length = torrent.get_piece_length(piece_index)
+        # The picker stops starting pieces while the buffer budget is used up
+        with budget_condition:
+            if in_flight[0] and in_flight[0] + length > budget:
+                start = time.perf_counter()
+                while in_flight[0] and in_flight[0] + length > budget:
+                    budget_condition.wait()
+                blocked += time.perf_counter() - start
+            in_flight[0] += length
+        start = time.perf_counter()
+        manager.write_piece(piece_index, piece_data[:length])
+        blocked += time.perf_counter() - start
+
+    manager.flush()
+    for fd in manager.handles.handles.values():
+        os.fsync(fd)
+    manager.cleanup()
+    return manager.write_calls, blocked, manager.get_handle_stats()
+
+
+def bench(name: str, run, torrent, order, piece_data: memoryview, budget: int, base_dir: str):
+    directory = tempfile.mkdtemp(dir=base_dir)
+    start = time.perf_counter()
+    try:
+        write_calls, blocked, handle_stats = run(torrent, directory, order, piece_data, budget)
+    except OSError as e:
+        # The legacy writer keeps every file open and runs out of descriptors
+        print(f"{name:12s} failed: {e}", file=sys.stderr)
+        return
+    finally:
+        shutil.rmtree(directory)
+    elapsed = time.perf_counter() - start
+    print(f"{name:12s} {torrent.total_length / elapsed / 1e6:8.1f} MB/s  "
+          f"{write_calls:7d} write calls  blocked {blocked:5.2f}s of {elapsed:.2f}s", file=sys.stderr)
+    if handle_stats:
+        print(f"{'':12s} {handle_stats['opens']} opens, {handle_stats['evictions']} evictions, "
+              f"{handle_stats['hit_rate'] * 100:.1f}% handle hit rate", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mib', type=int, default=512)
+    parser.add_argument('--piece-kib', type=int, default=256)
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--budget-mib', type=int, default=64)
+    parser.add_argument('--disk-workers', type=int, default=4)
+    parser.add_argument('--max-open-files', type=int, default=512)
+    parser.add_argument('--sequential', action='store_true', help='complete pieces in order')
+    parser.add_argument('--dir', default=None, help='directory on the filesystem to test')
+    args = parser.parse_args()
+
+    total = args.size_mib * 1024 * 1024
+    file_lengths = [total // args.files] * (args.files - 1)
+    file_lengths.append(total - sum(file_lengths))
+    torrent = StubTorrent(args.piece_kib * 1024, file_lengths)
+    order = list(range(torrent.num_pieces))
+    if not args.sequential:
+        random.Random(1).shuffle(order)
+    piece_data = memoryview(os.urandom(torrent.piece_length))
+    budget = args.budget_mib * 1024 * 1024
+
+    print(f"{args.size_mib} MiB in {torrent.num_pieces} pieces over {args.files} files, "
+          f"{args.budget_mib} MiB buffer budget", file=sys.stderr)
+
+    # Both FileManager and the legacy copy print per write; keep stdout quiet
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            bench('legacy', run_legacy, torrent, order, piece_data, budget, args.dir)
+            for workers in sorted({1, args.disk_workers}):
+                bench(f'pwritev x{workers}',
+                      lambda *a, workers=workers: run_write_behind(
+                          *a, disk_workers=workers, max_open_files=args.max_open_files),
+                      torrent, order, piece_data, budget, args.dir)
+        finally:
+            sys.stdout = sys.__stdout__
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_table import FileTable
+
+# Piece-to-file mapping on a synthetic torrent with many small files: the
+# original list of {'path', 'length', 'offset'} dicts scanned in full for every
+# piece, versus FileTable's offset array searched with bisect. Reports the memory
+# each file table takes and the cost of mapping every piece of the torrent; the
+# scan is timed on a sample of pieces and scaled up, as it would take hours.
+
+
+# Original lookup: every file checked against the piece
+def legacy_files_for_piece(files, piece_length: int, total_length: int, piece_index: int):
+    piece_start = piece_index * piece_length
+    piece_end = min(piece_start + piece_length, total_length)
+    overlapping_files = []
+    for file_info in files:
+        file_start = file_info['offset']
+        file_end = file_start + file_info['length']
+        if piece_start < file_end and piece_end > file_start:
+            overlapping_files.append(file_info)
+    return overlapping_files
+
+
+def build_legacy(paths, lengths):
+    files = []
+    offset = 0
+    for path, length in zip(paths, lengths):
+        files.append({'path': path, 'length': length, 'offset': offset})
+        offset += length
+    return files
+
+
+def build_table(paths, lengths):
+    table = FileTable()
+    for path, length in zip(paths, lengths):
+        table.append(path, length)
+    return table
+
+
+# Build a table, measuring the time and the memory still held afterwards
+def measure_build(name: str, build, paths, lengths):
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = build(paths, lengths)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:8s} built in {elapsed:6.2f}s, {size / 1e6:8.1f} MB ({size / len(lengths):6.1f} B/file)")
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--files-per-dir', type=int, default=1000)
+    parser.add_argument('--max-file-kib', type=int, default=256)
+    parser.add_argument('--piece-kib', type=int, default=1024)
+    parser.add_argument('--sample', type=int, default=20, help='pieces timed with the full scan')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    # Paths come from the parsed torrent; build them outside the measurements
+    paths = [['bench', f'dir{i // args.files_per_dir}', f'file{i}.bin'] for i in range(args.files)]
+    lengths = [rng.randint(0, args.max_file_kib * 1024) for _ in range(args.files)]
+    total_length = sum(lengths)
+    piece_length = args.piece_kib * 1024
+    num_pieces = (total_length + piece_length - 1) // piece_length
+    print(f"{args.files} files, {total_length / 1e9:.1f} GB in {num_pieces} pieces of {args.piece_kib} KiB")
+
+    legacy = measure_build('dicts', build_legacy, paths, lengths)
+    table = measure_build('table', build_table, paths, lengths)
+    del paths
+
+    # Full scan on a sample of pieces, checked against the table
+    sample = [rng.randrange(num_pieces) for _ in range(args.sample)]
+    start = time.perf_counter()
+    for piece_index in sample:
+        found = legacy_files_for_piece(legacy, piece_length, total_length, piece_index)
+        expected = table.files_in_range(piece_index * piece_length,
+                                        min(piece_length, total_length - piece_index * piece_length))
+        assert [f['offset'] for f in found if f['length']] == [table.offset(i) for i in expected]
+    per_piece = (time.perf_counter() - start) / len(sample)
+    print(f"scan     {per_piece * 1e3:10.3f} ms/piece, {per_piece * num_pieces:10.1f}s for all pieces (estimated)")
+
+    # Bisect over every piece
+    start = time.perf_counter()
+    overlaps = 0
+    for piece_index in range(num_pieces):
+        offset = piece_index * piece_length
+        overlaps += len(table.files_in_range(offset, min(piece_length, total_length - offset)))
+    elapsed = time.perf_counter() - start
+    print(f"bisect   {elapsed / num_pieces * 1e3:10.3f} ms/piece, {elapsed:10.1f}s for all pieces "
+          f"({overlaps / num_pieces:.1f} files per piece)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitfield import Bitfield
+from hash_pool import HashPool
+from piece_manager import BLOCK_SIZE, PieceManager
+
+# Verified MB/s against the number of hashing workers: the original inline
+# verify (copying the piece to bytes under the lock) versus HashPool with
+# worker threads hashing memoryviews and with worker processes. Also measures
+# the latency from a piece's last block arriving to it being verified, hashing
+# the whole piece at completion versus hashing incrementally as blocks arrive.
+
+MIB = 1024 * 1024
+
+
+# Original path: one thread, bytes() copy, hashed while holding the lock
+def run_inline(pieces, hashes, workers: int) -> int:
+    lock = threading.Lock()
+    verified = 0
+    for data, expected in zip(pieces, hashes):
+        with lock:
+            if hashlib.sha1(bytes(data)).digest() == expected:
+                verified += 1
+    return verified
+
+
+def run_pool(pieces, hashes, workers: int, use_processes: bool) -> int:
+    pool = HashPool(workers, use_processes)
+    done = threading.Semaphore(0)
+    results = []
+
+    def on_hashed(piece_index, ok):
+        results.append(ok)
+        done.release()
+
+    for index, (data, expected) in enumerate(zip(pieces, hashes)):
+        pool.submit(index, memoryview(data), expected, on_hashed)
+    for _ in pieces:
+        done.acquire()
+    pool.shutdown()
+    return sum(results)
+
+
+# Just enough of TorrentFile for PieceManager
+class StubTorrent:
+    def __init__(self, pieces, hashes):
+        self.pieces = pieces
+        self.hashes = hashes
+        self.piece_length = len(pieces[0])
+        self.total_length = sum(len(data) for data in pieces)
+
+    def get_total_pieces(self) -> int:
+        return len(self.pieces)
+
+    def get_piece_length(self, piece_index: int) -> int:
+        return len(self.pieces[piece_index])
+
+    def get_piece_hash(self, piece_index: int) -> bytes:
+        return self.hashes[piece_index]
+
+
+class StubPeer:
+    def __init__(self, num_pieces: int):
+        self.peer_pieces = Bitfield.from_indices(range(num_pieces), num_pieces)
+
+    def has_piece(self, piece_index: int) -> bool:
+        return True
+
+    def is_closed(self) -> bool:
+        return False
+
+
+# Deliver each piece block by block and time last block -> verified
+def bench_completion(name: str, pieces, hashes, incremental: bool):
+    pool = HashPool(1)
+    manager = PieceManager(StubTorrent(pieces, hashes), hash_pool=pool)
+    manager.incremental_hashing = incremental
+    peer = StubPeer(len(pieces))
+    manager.add_peer_pieces(peer, peer.peer_pieces)
+    verified = threading.Semaphore(0)
+    manager.on_piece_hashed = lambda piece_index, ok: verified.release()
+
+    latencies = []
+    for _ in pieces:
+        # Whole pieces of a BLOCK_SIZE multiple, so one batch covers exactly one piece
+        requests = manager.get_next_requests(peer, len(pieces[0]) // BLOCK_SIZE)
+        view = memoryview(pieces[requests[0][0]])
+        for piece_index, offset, length in requests[:-1]:
+            manager.add_piece_data(piece_index, offset, view[offset:offset + length], peer)
+        piece_index, offset, length = requests[-1]
+        start = time.perf_counter()
+        manager.add_piece_data(piece_index, offset, view[offset:offset + length], peer)
+        verified.acquire()
+        latencies.append(time.perf_counter() - start)
+    pool.shutdown()
+    assert len(manager.completed_pieces) == len(pieces)
+
+    latencies.sort()
+    print(f"{name:12s} last block -> verified: median {latencies[len(latencies) // 2] * 1e3:7.3f} ms, "
+          f"max {latencies[-1] * 1e3:7.3f} ms")
+
+
+def bench(name: str, run, pieces, hashes, workers: int):
+    # Warm up (process pools pay their start-up cost here)
+    run(pieces[:workers], hashes[:workers], workers)
+
+    start = time.perf_counter()
+    verified = run(pieces, hashes, workers)
+    elapsed = time.perf_counter() - start
+    assert verified == len(pieces)
+
+    total = sum(len(data) for data in pieces)
+    print(f"{name:8s} {workers:3d} workers {total / elapsed / 1e6:9.1f} MB/s verified")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--piece-mib', type=int, default=4)
+    parser.add_argument('--pieces', type=int, default=64)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    pieces = [bytearray(os.urandom(args.piece_mib * MIB)) for _ in range(args.pieces)]
+    hashes = [hashlib.sha1(data).digest() for data in pieces]
+    print(f"{args.pieces} pieces of {args.piece_mib} MiB, {os.cpu_count()} cores")
+
+    worker_counts = []
+    workers = 1
+    while workers < args.max_workers:
+        worker_counts.append(workers)
+        workers *= 2
+    worker_counts.append(args.max_workers)
+
+    bench('inline', run_inline, pieces, hashes, 1)
+    for workers in worker_counts:
+        bench('threads', lambda p, h, w: run_pool(p, h, w, False), pieces, hashes, workers)
+    for workers in worker_counts:
+        bench('process', lambda p, h, w: run_pool(p, h, w, True), pieces, hashes, workers)
+
+    bench_completion('whole piece', pieces, hashes, False)
+    bench_completion('incremental', pieces, hashes, True)
+
+
+if __name__ == '__main__':
+    main()
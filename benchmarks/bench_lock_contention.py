@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitfield import Bitfield
+from hash_pool import HashPool
+from piece_manager import PIECE_LOCK_STRIPES, PieceManager
+from timed_lock import TimedLock
+
+# Lock wait time in PieceManager with many peers: the striped piece locks,
+# picker lock and request lock against the previous design of one lock around
+# everything (emulated by making every lock the same re-entrant lock, with the
+# stats call holding it while it sums completed pieces). A scheduler thread
+# keeps the request pipeline of every simulated peer full, receive threads
+# deliver blocks as the peer engine does (into the piece buffer when it can be
+# claimed), hash pool threads verify and complete pieces, and a stats thread
+# polls get_download_stats. Also reports how long delivering a block took on
+# the receive threads.
+
+
+# Just enough of TorrentFile for PieceManager; every piece is zeros
+class StubTorrent:
+    def __init__(self, num_pieces: int, piece_length: int):
+        self.num_pieces = num_pieces
+        self.piece_length = piece_length
+        self.total_length = num_pieces * piece_length
+        self.piece_hash = hashlib.sha1(bytes(piece_length)).digest()
+
+    def get_total_pieces(self) -> int:
+        return self.num_pieces
+
+    def get_piece_length(self, piece_index: int) -> int:
+        return self.piece_length
+
+    def get_piece_hash(self, piece_index: int) -> bytes:
+        return self.piece_hash
+
+
+# A seed with a bounded pipeline of requests in flight
+class StubPeer:
+    def __init__(self, num_pieces: int, pipeline: int):
+        self.peer_pieces = Bitfield.from_indices(range(num_pieces), num_pieces)
+        self.has_piece = self.peer_pieces.has
+        self.pipeline = pipeline
+        self.outstanding = 0
+        self.lock = threading.Lock()
+
+    def is_closed(self) -> bool:
+        return False
+
+    def free_slots(self) -> int:
+        with self.lock:
+            return self.pipeline - self.outstanding
+
+    def sent(self, count: int):
+        with self.lock:
+            self.outstanding += count
+
+    def answered(self):
+        with self.lock:
+            self.outstanding -= 1
+
+
+# The previous locking: one lock for everything, stats included
+class GlobalLockManager(PieceManager):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        lock = TimedLock(threading.RLock())
+        self.picker_lock = self.request_lock = lock
+        self.piece_locks = [lock] * PIECE_LOCK_STRIPES
+
+    def get_download_stats(self):
+        with self.picker_lock:
+            return super().get_download_stats()
+
+    def get_lock_stats(self):
+        return {'global': self.picker_lock.get_stats()}
+
+
+def run(name: str, manager_class, args):
+    torrent = StubTorrent(args.pieces, args.piece_kib * 1024)
+    pool = HashPool(args.hash_workers)
+    manager = manager_class(torrent, hash_pool=pool, matrix_picker=False)
+    peers = [StubPeer(args.pieces, args.pipeline) for _ in range(args.peers)]
+    for peer in peers:
+        manager.add_peer_pieces(peer, peer.peer_pieces)
+
+    blocks = queue.Queue()
+    zeros = memoryview(bytes(torrent.piece_length))
+    done = threading.Event()
+    latencies = []
+
+    def schedule():
+        while not manager.is_complete():
+            issued = 0
+            for peer in peers:
+                slots = peer.free_slots()
+                if slots > 0:
+                    requests = manager.get_next_requests(peer, slots)
+                    peer.sent(len(requests))
+                    issued += len(requests)
+                    for request in requests:
+                        blocks.put((peer, request))
+            if not issued:
+                time.sleep(0.0005)
+        done.set()
+
+    def receive():
+        timings = []
+        latencies.append(timings)
+        while True:
+            item = blocks.get()
+            if item is None:
+                return
+            peer, (piece_index, offset, length) = item
+            received = time.perf_counter()
+            view = manager.claim_block_buffer(piece_index, offset, length)
+            if view is not None:
+                view[:] = zeros[:length]
+                manager.add_piece_data(piece_index, offset, view, peer)
+            else:
+                manager.add_piece_data(piece_index, offset, zeros[:length], peer)
+            timings.append(time.perf_counter() - received)
+            peer.answered()
+
+    def poll_stats():
+        while not done.is_set():
+            manager.get_download_stats()
+            time.sleep(args.stats_interval / 1000)
+
+    threads = [threading.Thread(target=schedule), threading.Thread(target=poll_stats)]
+    threads += [threading.Thread(target=receive) for _ in range(args.receive_threads)]
+    start = time.perf_counter()
+    # The piece manager prints a line per piece
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        done.wait()
+        elapsed = time.perf_counter() - start
+        for _ in range(args.receive_threads):
+            blocks.put(None)
+        for thread in threads:
+            thread.join()
+        pool.shutdown()
+
+    total = torrent.total_length
+    timings = sorted(timing for thread_timings in latencies for timing in thread_timings)
+    print(f"{name}: {total / elapsed / 1e6:.1f} MB/s, {elapsed:.2f} s | block delivery "
+          f"median {timings[len(timings) // 2] * 1e6:.0f} us, "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1e3:.2f} ms, max {timings[-1] * 1e3:.2f} ms")
+    for lock_name, stats in manager.get_lock_stats().items():
+        print(f"  {lock_name:9s} {stats['acquisitions']:8d} acquisitions, "
+              f"{stats['contention_rate'] * 100:5.1f}% waited, "
+              f"total wait {stats['wait_time'] * 1e3:8.1f} ms, "
+              f"mean {stats['mean_wait'] * 1e6:7.1f} us, max {stats['max_wait'] * 1e3:6.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--peers', type=int, default=200)
+    parser.add_argument('--pieces', type=int, default=1024)
+    parser.add_argument('--piece-kib', type=int, default=256)
+    parser.add_argument('--pipeline', type=int, default=16, help="requests in flight per peer")
+    parser.add_argument('--receive-threads', type=int, default=4)
+    parser.add_argument('--hash-workers', type=int, default=2)
+    parser.add_argument('--stats-interval', type=float, default=5.0, help="milliseconds between stats calls")
+    args = parser.parse_args()
+
+    print(f"{args.peers} peers, {args.pieces} pieces of {args.piece_kib} KiB, "
+          f"{args.receive_threads} receive threads, {args.hash_workers} hash workers")
+    run('one lock', GlobalLockManager, args)
+    run('sharded', PieceManager, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peer import PeerConnection, HANDSHAKE_LENGTH
+from peer_engine import AsyncPeerConnection, PeerEngine
+
+# Compares the thread-per-peer PeerConnection against the asyncio PeerEngine:
+# CPU seconds per MB downloaded and how many peers can be held open at once.
+
+INFO_HASH = b'\x11' * 20
+BLOCK_SIZE = 16384
+NUM_PIECES = 64
+PIECE_LENGTH = 256 * 1024
+
+
+# Seeder that answers every REQUEST with a zero-filled block
+async def _serve_peer(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    block = bytes(BLOCK_SIZE)
+    try:
+        handshake = await reader.readexactly(HANDSHAKE_LENGTH)
+        writer.write(handshake[:48] + b'-BS0001-000000000000')
+        bitfield = b'\xff' * (NUM_PIECES // 8)
+        writer.write(struct.pack('>IB', 1 + len(bitfield), 5) + bitfield)
+        writer.write(struct.pack('>IB', 1, 1))
+        while True:
+            length = struct.unpack('>I', await reader.readexactly(4))[0]
+            if length == 0:
+                continue
+            message = await reader.readexactly(length)
+            if message[0] == 6:
+                index, begin, size = struct.unpack('>III', message[1:13])
+                writer.write(struct.pack('>IBII', 9 + size, 7, index, begin))
+                writer.write(block[:size])
+                if writer.transport.get_write_buffer_size() > 1 << 20:
+                    await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def _run_seeder(port_queue):
+    _raise_fd_limit()
+
+    async def main():
+        server = await asyncio.start_server(_serve_peer, '127.0.0.1', 0, backlog=4096)
+        port_queue.put(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def _raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# Keeps one peer's pipeline full until its byte budget is downloaded
+class _Downloader:
+
+    def __init__(self, peer: PeerConnection, budget: int, done: threading.Event, counter: list):
+        self.peer = peer
+        self.budget = budget
+        self.received = 0
+        self.next_block = 0
+        self.done = done
+        self.counter = counter
+        self.lock = threading.Lock()
+        peer.on_piece_received = self.on_piece
+        peer.on_unchoke = self.fill
+
+    def fill(self):
+        with self.lock:
+            while self.peer.available_request_slots() > 0 and self.next_block * BLOCK_SIZE < self.budget:
+                blocks_per_piece = PIECE_LENGTH // BLOCK_SIZE
+                index = (self.next_block // blocks_per_piece) % NUM_PIECES
+                begin = (self.next_block % blocks_per_piece) * BLOCK_SIZE
+                if not self.peer.request_piece(index, begin, BLOCK_SIZE):
+                    break
+                self.next_block += 1
+
+    def on_piece(self, piece_index: int, begin: int, data: bytes):
+        self.received += len(data)
+        if self.received >= self.budget:
+            with self.lock:
+                self.counter[0] -= 1
+                if self.counter[0] == 0:
+                    self.done.set()
+            return
+        self.fill()
+
+
+def _make_peer(mode: str, port: int, engine: PeerEngine) -> PeerConnection:
+    if mode == 'asyncio':
+        return AsyncPeerConnection('127.0.0.1', port, INFO_HASH, b'-BC0001-%012d' % 0, engine, NUM_PIECES)
+    return PeerConnection('127.0.0.1', port, INFO_HASH, b'-BC0001-%012d' % 0, NUM_PIECES)
+
+
+def _connect_all(mode: str, peers: list, engine: PeerEngine) -> int:
+    if mode == 'asyncio':
+        futures = [engine.connect(peer) for peer in peers]
+        return sum(1 for future in futures if future.result())
+
+    results = [False] * len(peers)
+
+    def connect(i):
+        results[i] = peers[i].connect()
+
+    threads = [threading.Thread(target=connect, args=(i,), daemon=True) for i in range(len(peers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(results)
+
+
+def _disconnect_all(peers: list):
+    for peer in peers:
+        peer.disconnect()
+    for peer in peers:
+        if peer.receive_thread:
+            peer.receive_thread.join()
+
+
+def _quiet():
+    return open(os.devnull, 'w')
+
+
+# Download megabytes_per_peer from each of num_peers and report CPU cost
+def bench_throughput(mode: str, port: int, num_peers: int, megabytes_per_peer: int):
+    engine = PeerEngine()
+    engine.start()
+    peers = [_make_peer(mode, port, engine) for _ in range(num_peers)]
+    done = threading.Event()
+    counter = [num_peers]
+    budget = megabytes_per_peer * 1024 * 1024
+    downloaders = [_Downloader(peer, budget, done, counter) for peer in peers]
+
+    stdout = sys.stdout
+    sys.stdout = _quiet()
+    try:
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        _connect_all(mode, peers, engine)
+        for downloader in downloaders:
+            downloader.fill()
+        done.wait(300)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        _disconnect_all(peers)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    engine.stop()
+
+    total_mb = sum(d.received for d in downloaders) / (1024 * 1024)
+    print(f"{mode:8s} throughput: {num_peers} peers, {total_mb:.0f} MB in {wall:.2f}s "
+          f"({total_mb / wall:.1f} MB/s), CPU {cpu * 1000 / total_mb:.2f} ms/MB")
+
+
+# Open num_peers connections at once and count how many complete the handshake
+def bench_connections(mode: str, port: int, num_peers: int):
+    engine = PeerEngine()
+    engine.start()
+    peers = [_make_peer(mode, port, engine) for _ in range(num_peers)]
+
+    stdout = sys.stdout
+    sys.stdout = _quiet()
+    try:
+        start = time.perf_counter()
+        connected = _connect_all(mode, peers, engine)
+        elapsed = time.perf_counter() - start
+        threads = threading.active_count()
+        _disconnect_all(peers)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    engine.stop()
+
+    print(f"{mode:8s} connections: {connected}/{num_peers} open in {elapsed:.2f}s, "
+          f"{threads} threads alive")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--peers', type=int, default=50)
+    parser.add_argument('--mb-per-peer', type=int, default=8)
+    parser.add_argument('--connections', type=int, default=2000)
+    args = parser.parse_args()
+
+    _raise_fd_limit()
+    port_queue = multiprocessing.Queue()
+    seeder = multiprocessing.Process(target=_run_seeder, args=(port_queue,), daemon=True)
+    seeder.start()
+    port = port_queue.get()
+
+    for mode in ('threaded', 'asyncio'):
+        bench_throughput(mode, port, args.peers, args.mb_per_peer)
+    for mode in ('threaded', 'asyncio'):
+        bench_connections(mode, port, args.connections)
+
+    seeder.terminate()
+
+
+if __name__ == '__main__':
+    main()
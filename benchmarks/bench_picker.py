@@ -0,0 +1,95 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitfield import Bitfield
+from piece_picker import PiecePicker
+from swarm_matrix import SwarmMatrixPicker, np
+
+# Rarest-first picker latency in a large swarm: the pure-Python bucket picker
+# against the NumPy availability matrix. Peers range from seeds to peers with
+# one piece in a thousand, and we already have some of the pieces. One tick asks
+# every peer for a piece, as the scheduler does when it refills pipelines; the
+# pieces picked are marked started so each peer gets a different one, and are
+# released again after the tick. Also times counting every peer's bitfield.
+
+
+class StubPeer:
+    def __init__(self, peer_pieces: Bitfield):
+        self.peer_pieces = peer_pieces
+        self.has_piece = peer_pieces.has
+
+
+# Peers with pieces at random, each with a density from 1 (a seed) down to 1/1024
+def make_peers(num_peers: int, num_pieces: int, rng: random.Random):
+    size = (num_pieces + 7) // 8
+    peers = []
+    for _ in range(num_peers):
+        halvings = rng.randrange(11)
+        bits = (1 << (size * 8)) - 1
+        for _ in range(halvings):
+            bits &= int.from_bytes(os.urandom(size), 'big')
+        peers.append(StubPeer(Bitfield.from_bytes(bits.to_bytes(size, 'big'), num_pieces)))
+    return peers
+
+
+def run(name: str, picker, peers, have, ticks: int):
+    start = time.perf_counter()
+    for peer in peers:
+        picker.add_peer(peer, peer.peer_pieces)
+    setup = time.perf_counter() - start
+    for piece_index in have:
+        picker.mark_have(piece_index)
+
+    is_pickable = lambda piece_index: True
+    latencies = []
+    for _ in range(ticks):
+        picked = []
+        for peer in peers:
+            start = time.perf_counter()
+            piece_index = picker.pick(peer, is_pickable)
+            latencies.append(time.perf_counter() - start)
+            if piece_index is not None:
+                picker.mark_partial(piece_index)
+                picked.append(piece_index)
+        for piece_index in picked:
+            picker.clear_partial(piece_index)
+
+    latencies.sort()
+    mean = sum(latencies) / len(latencies)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{name:8s} add bitfields {setup:7.2f} s | pick mean {mean * 1e3:7.3f} ms, "
+          f"p99 {p99 * 1e3:7.3f} ms, max {latencies[-1] * 1e3:7.3f} ms | "
+          f"tick of {len(peers)} peers {mean * len(peers) * 1e3:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pieces', type=int, default=1_000_000)
+    parser.add_argument('--peers', type=int, default=500)
+    parser.add_argument('--have', type=float, default=0.3, help="fraction of pieces we already have")
+    parser.add_argument('--ticks', type=int, default=3)
+    parser.add_argument('--no-python', action='store_true', help="skip the pure-Python picker")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    peers = make_peers(args.peers, args.pieces, rng)
+    have = rng.sample(range(args.pieces), int(args.pieces * args.have))
+    print(f"{args.peers} peers x {args.pieces} pieces, "
+          f"{sum(peer.peer_pieces.count for peer in peers) / args.peers:.0f} pieces per peer, "
+          f"{len(have)} pieces already ours")
+
+    if not args.no_python:
+        run('python', PiecePicker(args.pieces), peers, have, args.ticks)
+    if np is not None:
+        run('numpy', SwarmMatrixPicker(args.pieces), peers, have, args.ticks)
+    else:
+        print("NumPy is not installed; timing the pure-Python picker only")
+
+
+if __name__ == '__main__':
+    main()
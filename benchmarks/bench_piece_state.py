@@ -0,0 +1,133 @@
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from piece_manager import BLOCK_SIZE, Piece, PieceManager
+
+# Memory held by piece/block bookkeeping at 1M-piece scale, and the cost of
+# finding a block by offset: the original one-object-per-block layout versus
+# Piece with __slots__ and a per-piece bytearray of block flags.
+
+
+# Copy of the original per-block objects
+class LegacyBlock:
+    def __init__(self, piece_index: int, offset: int, length: int):
+        self.piece_index = piece_index
+        self.offset = offset
+        self.length = length
+        self.requested = False
+        self.received = False
+        self.landing = False
+
+
+class LegacyPiece:
+    def __init__(self, index: int, length: int, hash_value: bytes):
+        self.index = index
+        self.length = length
+        self.hash_value = hash_value
+        self.blocks = []
+        self.next_free_block = 0
+        self.completed = False
+        self.verified = False
+        self.data = None
+        offset = 0
+        while offset < length:
+            self.blocks.append(LegacyBlock(index, offset, min(BLOCK_SIZE, length - offset)))
+            offset += BLOCK_SIZE
+
+    def find_block(self, offset: int, length: int):
+        for block in self.blocks:
+            if block.offset == offset and block.length == length:
+                return block
+        return None
+
+
+# Just enough of TorrentFile for PieceManager
+class StubTorrent:
+    def __init__(self, num_pieces: int, piece_length: int):
+        self.piece_length = piece_length
+        self.num_pieces = num_pieces
+        self.total_length = num_pieces * piece_length
+        self.hash_value = b'\0' * 20
+
+    def get_total_pieces(self) -> int:
+        return self.num_pieces
+
+    def get_piece_length(self, piece_index: int) -> int:
+        return self.piece_length
+
+    def get_piece_hash(self, piece_index: int) -> bytes:
+        return self.hash_value
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, elapsed
+
+
+def report(name: str, num_pieces: int, size: int, elapsed: float, scale: int = 1):
+    note = f"  (measured on {num_pieces // scale} pieces)" if scale > 1 else ""
+    print(f"{name:22s} {size * scale / 1e6:9.1f} MB  {size / (num_pieces // scale):7.1f} B/piece  "
+          f"built in {elapsed * scale:6.2f}s{note}")
+
+
+def bench_lookup(name: str, pieces, lookup, blocks_per_piece: int, piece_length: int):
+    offsets = [(block * BLOCK_SIZE, min(BLOCK_SIZE, piece_length - block * BLOCK_SIZE))
+               for block in range(blocks_per_piece)]
+    sample = pieces[:min(len(pieces), 20000)]
+    start = time.perf_counter()
+    for piece in sample:
+        for offset, length in offsets:
+            lookup(piece, offset, length)
+    elapsed = time.perf_counter() - start
+    print(f"{name:22s} {elapsed / (len(sample) * blocks_per_piece) * 1e9:9.0f} ns per offset lookup")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pieces', type=int, default=1_000_000)
+    parser.add_argument('--piece-kib', type=int, default=256)
+    # The legacy layout needs ~3 GB at 1M pieces, so it is measured on a sample and scaled
+    parser.add_argument('--legacy-pieces', type=int, default=100_000)
+    args = parser.parse_args()
+
+    piece_length = args.piece_kib * 1024
+    blocks_per_piece = (piece_length + BLOCK_SIZE - 1) // BLOCK_SIZE
+    hash_value = b'\0' * 20
+    print(f"{args.pieces} pieces of {args.piece_kib} KiB ({blocks_per_piece} blocks each)")
+
+    legacy_pieces = min(args.legacy_pieces, args.pieces)
+    legacy, size, elapsed = measure(
+        lambda: [LegacyPiece(i, piece_length, hash_value) for i in range(legacy_pieces)])
+    report('legacy Piece+Block', args.pieces, size, elapsed, args.pieces // legacy_pieces)
+    bench_lookup('legacy Piece+Block', legacy, LegacyPiece.find_block, blocks_per_piece, piece_length)
+    del legacy
+
+    compact, size, elapsed = measure(
+        lambda: [Piece(i, piece_length) for i in range(args.pieces)])
+    report('compact Piece', args.pieces, size, elapsed)
+    bench_lookup('compact Piece', compact, Piece.block_at, blocks_per_piece, piece_length)
+
+    # Started pieces carry their block flags; only in-flight pieces pay for them
+    _, size, elapsed = measure(lambda: [piece.start(None) for piece in compact])
+    report('  + block state, all', args.pieces, size, elapsed)
+    del compact
+
+    manager, size, elapsed = measure(
+        lambda: PieceManager(StubTorrent(args.pieces, piece_length)))
+    report('PieceManager', args.pieces, size, elapsed)
+
+
+if __name__ == '__main__':
+    main()
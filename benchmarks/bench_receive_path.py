@@ -0,0 +1,137 @@
+import argparse
+import hashlib
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peer import PeerConnection
+
+# Measures bytes copied in user space per byte downloaded on the receive path:
+# the original recv/+= framing with slicing versus MessageReader, which uses
+# recv_into and lands PIECE payloads directly in the piece buffer.
+
+BLOCK_SIZE = 16384
+PIECE_LENGTH = 256 * 1024
+BLOCKS_PER_PIECE = PIECE_LENGTH // BLOCK_SIZE
+
+
+def _build_stream(num_pieces: int) -> bytes:
+    block = os.urandom(BLOCK_SIZE)
+    messages = []
+    for index in range(num_pieces):
+        for begin in range(0, PIECE_LENGTH, BLOCK_SIZE):
+            messages.append(struct.pack('>IBII', 9 + BLOCK_SIZE, 7, index, begin) + block)
+    return b''.join(messages)
+
+
+def _send_stream(sock: socket.socket, stream: bytes):
+    sock.sendall(stream)
+    sock.close()
+
+
+# Copy of the original receive path, counting every copy it makes
+def run_legacy(sock: socket.socket, num_pieces: int) -> int:
+    copied = 0
+    pieces = {}
+
+    def receive_exact(length):
+        nonlocal copied
+        data = b''
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+            copied += len(data)  # += builds a new bytes object
+        return data
+
+    while True:
+        length_data = receive_exact(4)
+        if not length_data:
+            break
+        message = receive_exact(int.from_bytes(length_data, 'big'))
+        payload = message[1:]
+        copied += len(payload)
+        index = int.from_bytes(payload[:4], 'big')
+        begin = int.from_bytes(payload[4:8], 'big')
+        block_data = payload[8:]
+        copied += len(block_data)
+
+        piece = pieces.setdefault(index, [bytearray(PIECE_LENGTH), 0])
+        piece[0][begin:begin + len(block_data)] = block_data
+        copied += len(block_data)
+        piece[1] += 1
+        if piece[1] == BLOCKS_PER_PIECE:
+            piece_data = bytes(piece[0])  # verify() and on_piece_completed
+            hashlib.sha1(piece_data).digest()
+            file_data = piece_data[0:PIECE_LENGTH]  # write_piece slicing
+            copied += 2 * PIECE_LENGTH
+            del pieces[index]
+    return copied
+
+
+# MessageReader receive loop feeding blocks straight into piece buffers
+def run_reader(sock: socket.socket, num_pieces: int) -> int:
+    peer = PeerConnection('127.0.0.1', 0, b'\0' * 20, b'\0' * 20, num_pieces)
+    peer.socket = sock
+    peer.connected = True
+    peer.running = True
+    pieces = {}
+
+    def claim(index, begin, length):
+        piece = pieces.setdefault(index, [bytearray(PIECE_LENGTH), 0])
+        return memoryview(piece[0])[begin:begin + length]
+
+    def received(index, begin, data):
+        piece = pieces[index]
+        piece[1] += 1
+        if piece[1] == BLOCKS_PER_PIECE:
+            hashlib.sha1(piece[0]).digest()
+            del pieces[index]
+
+    peer.claim_block_buffer = claim
+    peer.on_piece_received = received
+    peer.disconnect = lambda: None
+
+    peer._receive_loop()
+    return peer.reader.bytes_copied
+
+
+def bench(name: str, receive, stream: bytes, num_pieces: int):
+    receiver, sender = socket.socketpair()
+    thread = threading.Thread(target=_send_stream, args=(sender, stream), daemon=True)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    thread.start()
+    copied = receive(receiver, num_pieces)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    thread.join()
+    receiver.close()
+
+    downloaded = num_pieces * PIECE_LENGTH
+    print(f"{name:8s} {downloaded / elapsed / 1e6:8.1f} MB/s  "
+          f"{copied / downloaded:5.2f} bytes copied per byte  "
+          f"peak traced memory {peak / 1024:.0f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pieces', type=int, default=256)
+    args = parser.parse_args()
+
+    stream = _build_stream(args.pieces)
+    bench('legacy', run_legacy, stream, args.pieces)
+    bench('reader', run_reader, stream, args.pieces)
+
+
+if __name__ == '__main__':
+    main()
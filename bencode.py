@@ -0,0 +1,152 @@
+import re
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+# Bencoding (BEP 3). The decoder matches tokens with a compiled regex directly
+# over a memoryview of the input, so nothing but the decoded values is copied.
+# It returns strings and dictionary keys as bytes, and can report where
+# top-level dictionary values lie in the input, so the info hash is taken over
+# the original bytes of the info dictionary rather than over a re-encoding that
+# may differ from them.
+
+# Raised for malformed bencoded data
+class BencodeError(ValueError):
+    pass
+
+
+# One token: a string length prefix, an integer (no leading zeros or -0), or the
+# start of a list or dictionary, or the end of one
+_TOKEN = re.compile(rb'(0|[1-9][0-9]*):|i(0|-?[1-9][0-9]*)e|([lde])')
+_END = ord('e')
+
+
+class _Decoder:
+
+    def __init__(self, data):
+        view = memoryview(data)
+        self.view = view if view.format == 'B' else view.cast('B')
+        self.length = len(self.view)
+
+    # Decode the value at pos; returns (value, position after it)
+    def decode(self, pos: int) -> Tuple[Any, int]:
+        match = _TOKEN.match(self.view, pos)
+        if match is None:
+            if pos >= self.length:
+                raise BencodeError("Unexpected end of data")
+            raise BencodeError(f"Invalid data at {pos}")
+
+        kind = match.lastindex
+        if kind == 1:
+            start = match.end()
+            end = start + int(match.group(1))
+            if end > self.length:
+                raise BencodeError(f"String at {start} runs past the end of data")
+            return self.view[start:end].tobytes(), end
+
+        if kind == 2:
+            return int(match.group(2)), match.end()
+
+        container = match.group(3)
+        if container == b'l':
+            items = []
+            pos = match.end()
+            while pos >= self.length or self.view[pos] != _END:
+                item, pos = self.decode(pos)
+                items.append(item)
+            return items, pos + 1
+
+        if container == b'd':
+            return self._dict(pos, None)
+
+        raise BencodeError(f"Unexpected end marker at {pos}")
+
+    # Decode the dictionary at pos, filling in the spans of values whose keys are in spans
+    def _dict(self, pos: int, spans: Optional[Dict[bytes, Tuple[int, int]]]) -> Tuple[Dict, int]:
+        result = {}
+        pos += 1
+        while pos >= self.length or self.view[pos] != _END:
+            key, pos = self.decode(pos)
+            if not isinstance(key, bytes):
+                raise BencodeError(f"Dictionary key before {pos} is not a string")
+            start = pos
+            result[key], pos = self.decode(pos)
+            if spans is not None and key in spans:
+                spans[key] = (start, pos)
+        return result, pos + 1
+
+
+# Decode one bencoded value that makes up all of data
+def bdecode(data) -> Any:
+    decoder = _Decoder(data)
+    try:
+        value, end = decoder.decode(0)
+    except RecursionError:
+        raise BencodeError("Data is nested too deeply")
+    if end != decoder.length:
+        raise BencodeError(f"Trailing data at {end}")
+    return value
+
+
+# Decode a bencoded dictionary and return it with the (start, end) byte span of
+# each of keys found at its top level, e.g. bdecode_spans(data, [b'info'])
+def bdecode_spans(data, keys: Iterable[bytes]) -> Tuple[Dict, Dict[bytes, Tuple[int, int]]]:
+    decoder = _Decoder(data)
+    if not decoder.length or decoder.view[0] != ord('d'):
+        raise BencodeError("Not a bencoded dictionary")
+    spans = dict.fromkeys(keys)
+    try:
+        value, end = decoder._dict(0, spans)
+    except RecursionError:
+        raise BencodeError("Data is nested too deeply")
+    if end != decoder.length:
+        raise BencodeError(f"Trailing data at {end}")
+    return value, {key: span for key, span in spans.items() if span is not None}
+
+
+# Encode a value: ints, bytes, str (as UTF-8), lists/tuples and dicts with bytes
+# or str keys, which are written in sorted order
+def bencode(value: Any) -> bytes:
+    parts = []
+    _encode(value, parts.append)
+    return b''.join(parts)
+
+
+def _encode(value: Any, append):
+    value_type = type(value)
+    if value_type is bytes:
+        append(b'%d:' % len(value))
+        append(value)
+    elif value_type is str:
+        value = value.encode('utf-8')
+        append(b'%d:' % len(value))
+        append(value)
+    elif value_type is int:
+        append(b'i%de' % value)
+    elif value_type is dict:
+        append(b'd')
+        # Keys are compared as raw bytes, so str keys are encoded before sorting
+        for key, item in sorted([(key.encode('utf-8') if type(key) is str else bytes(key), item)
+                                 for key, item in value.items()]):
+            append(b'%d:' % len(key))
+            append(key)
+            _encode(item, append)
+        append(b'e')
+    elif value_type is list or value_type is tuple:
+        append(b'l')
+        for item in value:
+            _encode(item, append)
+        append(b'e')
+    else:
+        _encode(_plain(value), append)
+
+
+# Convert buffers and subclasses of the supported types to the plain types
+# (bool is refused rather than taken as an int)
+def _plain(value: Any) -> Any:
+    if isinstance(value, bool):
+        raise BencodeError("Cannot bencode a bool")
+    for plain_type in (bytes, str, int, dict, list):
+        if isinstance(value, plain_type):
+            return plain_type(value)
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    raise BencodeError(f"Cannot bencode {type(value).__name__}")
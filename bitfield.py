@@ -0,0 +1,142 @@
+from typing import Iterable, Iterator, List
+
+# Set bit positions of every byte value, high bit first as in BitTorrent bitfields
+_BIT_POSITIONS = [tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256)]
+
+
+# Number of set bits in a bytes-like object
+def _popcount(data) -> int:
+    value = int.from_bytes(data, 'big')
+    if hasattr(value, 'bit_count'):
+        return value.bit_count()
+    return bin(value).count('1')
+
+
+# Which pieces a peer (or we) have, packed eight to a byte in BitTorrent wire
+# order: bit 0x80 of byte 0 is piece 0. The size is fixed by the torrent's piece
+# count, so HAVE messages can be recorded before (or without) a BITFIELD. The
+# number of set bits is kept up to date, making popcount and the check for a
+# seed, which has every piece, O(1).
+class Bitfield:
+    __slots__ = ('length', 'bits', 'count')
+
+    def __init__(self, length: int):
+        self.length = length
+        self.bits = bytearray((length + 7) // 8)
+        self.count = 0
+
+    # Build a bitfield from wire data; spare bits past length are ignored and a
+    # short payload leaves the missing pieces unset
+    @classmethod
+    def from_bytes(cls, data, length: int) -> 'Bitfield':
+        bitfield = cls(length)
+        size = len(bitfield.bits)
+        received = bytes(data[:size])
+        bitfield.bits[:len(received)] = received
+        if length % 8 and len(received) == size:
+            bitfield.bits[-1] &= (0xff << (8 - length % 8)) & 0xff
+        bitfield.count = _popcount(bitfield.bits)
+        return bitfield
+
+    # Build a bitfield with the given indices set
+    @classmethod
+    def from_indices(cls, indices: Iterable[int], length: int) -> 'Bitfield':
+        bitfield = cls(length)
+        for index in indices:
+            bitfield.set(index)
+        return bitfield
+
+    # Check if a bit is set; False for indices out of range
+    def has(self, index: int) -> bool:
+        if self.count == self.length:
+            return 0 <= index < self.length
+        return 0 <= index < self.length and bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    __getitem__ = has
+
+    # Set a bit; returns True if it was not set before
+    def set(self, index: int) -> bool:
+        if not 0 <= index < self.length:
+            return False
+        mask = 0x80 >> (index & 7)
+        byte = self.bits[index >> 3]
+        if byte & mask:
+            return False
+        self.bits[index >> 3] = byte | mask
+        self.count += 1
+        return True
+
+    # Clear a bit; returns True if it was set before
+    def clear(self, index: int) -> bool:
+        if not 0 <= index < self.length:
+            return False
+        mask = 0x80 >> (index & 7)
+        byte = self.bits[index >> 3]
+        if not byte & mask:
+            return False
+        self.bits[index >> 3] = byte & ~mask
+        self.count -= 1
+        return True
+
+    # Check if every bit is set
+    def is_seed(self) -> bool:
+        return self.count == self.length
+
+    # Number of set bits, counted afresh
+    def popcount(self) -> int:
+        return _popcount(self.bits)
+
+    # Bits set here but not in other, e.g. the pieces a peer has that we lack
+    def and_not(self, other: 'Bitfield') -> 'Bitfield':
+        result = Bitfield(self.length)
+        if other.count == 0:
+            result.bits[:] = self.bits
+            result.count = self.count
+        elif not other.is_seed() and self.count:
+            ours = int.from_bytes(self.bits, 'big')
+            theirs = int.from_bytes(other.bits, 'big')
+            result.bits[:] = (ours & ~theirs).to_bytes(len(self.bits), 'big')
+            result.count = result.popcount()
+        return result
+
+    # Check if any bit is set here but not in other, without building the difference
+    def any_and_not(self, other: 'Bitfield') -> bool:
+        if self.count == 0 or other.is_seed():
+            return False
+        if other.count == 0:
+            return True
+        return bool(int.from_bytes(self.bits, 'big') & ~int.from_bytes(other.bits, 'big'))
+
+    # Set every bit of other here; returns the bits that were newly set
+    def update(self, other: 'Bitfield') -> 'Bitfield':
+        added = other.and_not(self)
+        if added.count:
+            merged = int.from_bytes(self.bits, 'big') | int.from_bytes(added.bits, 'big')
+            self.bits[:] = merged.to_bytes(len(self.bits), 'big')
+            self.count += added.count
+        return added
+
+    # Indices of the set bits in increasing order
+    def iter_set(self) -> Iterator[int]:
+        if self.count == self.length:
+            yield from range(self.length)
+            return
+        positions = _BIT_POSITIONS
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                base = byte_index << 3
+                for bit in positions[byte]:
+                    yield base + bit
+
+    __iter__ = iter_set
+
+    # Indices of the set bits as a list
+    def set_indices(self) -> List[int]:
+        return list(self.iter_set())
+
+    # Wire form of the bitfield
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
+
+    def __len__(self) -> int:
+        return self.length
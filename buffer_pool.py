@@ -0,0 +1,39 @@
+# Hands out piece buffers within a memory budget and keeps released buffers for
+# reuse, so only pieces in flight hold memory and steady-state downloading does
+# not allocate. Not thread-safe; the piece manager's lock guards it.
+class BufferPool:
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.in_use = 0       # Bytes held by pieces being downloaded, hashed or written
+        self.free = {}        # length -> spare buffers of that length
+        self.free_bytes = 0
+        self.allocations = 0  # Buffers allocated because no spare was available
+
+    # Whether a new piece of this length fits in the budget; one piece always fits
+    def can_acquire(self, length: int) -> bool:
+        return self.in_use == 0 or self.in_use + length <= self.budget
+
+    # Take a buffer for a piece, reusing a spare of the same length if there is one
+    def acquire(self, length: int) -> bytearray:
+        spares = self.free.get(length)
+        if spares:
+            buffer = spares.pop()
+            self.free_bytes -= length
+        else:
+            buffer = bytearray(length)
+            self.allocations += 1
+        self.in_use += length
+        return buffer
+
+    # Give a buffer back; it is kept as a spare while the pool stays within budget
+    def release(self, buffer: bytearray):
+        length = len(buffer)
+        self.in_use -= length
+        if self.in_use + self.free_bytes + length <= self.budget:
+            self.free.setdefault(length, []).append(buffer)
+            self.free_bytes += length
+
+    # Bytes held in use and as spares
+    def total_bytes(self) -> int:
+        return self.in_use + self.free_bytes
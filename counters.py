@@ -0,0 +1,23 @@
+import threading
+
+# A counter that threads add to without taking a lock. Each thread adds to a
+# cell of its own, so no update is lost between a read and a write racing in
+# another thread, and reading sums one cell per thread that ever added.
+class ShardedCounter:
+
+    def __init__(self, value: int = 0):
+        self.base = value
+        self.cells = []  # One single-item list per thread that has added
+        self.local = threading.local()
+
+    def add(self, amount: int = 1):
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0]
+            self.cells.append(cell)
+        cell[0] += amount
+
+    # Current total; adds still in progress on other threads may be missed
+    def value(self) -> int:
+        return self.base + sum(cell[0] for cell in self.cells)
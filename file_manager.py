@@ -1,18 +1,97 @@
+import hashlib
+import mmap
 import os
 import threading
-from typing import Dict, List
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from handle_cache import HandleCache
+
+# Most buffers os.pwritev/os.preadv accept in one call (IOV_MAX on Linux)
+MAX_IO_SEGMENTS = 1024
+
+# Runs of one file are grouped into disk pool tasks of about this many bytes
+DISK_TASK_BYTES = 4 * 1024 * 1024
+
+# Default cap on open file descriptors; torrents with more files reopen them as needed
+DEFAULT_MAX_OPEN_FILES = 512
+
+# Consecutive pieces are rechecked in tasks of about this many bytes
+RECHECK_TASK_BYTES = 64 * 1024 * 1024
+
+# Hash pieces out of memory-mapped files in a recheck worker process. pieces holds
+# (piece_index, expected hash, [(path, file position, length)]); returns the
+# indices that verified. Pieces whose files are missing or short fail.
+def _recheck_pieces(pieces: List[Tuple[int, bytes, List[Tuple[str, int, int]]]]) -> List[int]:
+    verified = []
+    maps = {}  # path -> (mmap, memoryview), None if the file cannot be mapped
+    try:
+        for piece_index, expected_hash, extents in pieces:
+            hasher = hashlib.sha1()
+            for path, position, length in extents:
+                if path not in maps:
+                    maps[path] = _map_file(path)
+                mapped = maps[path]
+                if mapped is None or position + length > len(mapped[0]):
+                    break
+                chunk = mapped[1][position:position + length]
+                hasher.update(chunk)
+                chunk.release()
+            else:
+                if hasher.digest() == expected_hash:
+                    verified.append(piece_index)
+    finally:
+        for mapped in maps.values():
+            if mapped is not None:
+                mapped[1].release()
+                mapped[0].close()
+    return verified
+
+# Map a file read-only with sequential readahead, None if it is missing or empty
+def _map_file(path: str) -> Optional[Tuple[mmap.mmap, memoryview]]:
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped, memoryview(mapped)
 
 # Manages file operations for downloaded pieces
 class FileManager:
 
-    def __init__(self, torrent_file, download_dir: str = "downloads"):
+    def __init__(self, torrent_file, download_dir: str = "downloads", disk_workers: int = 4,
+                 max_open_files: int = DEFAULT_MAX_OPEN_FILES):
         self.torrent = torrent_file
         self.download_dir = download_dir
-        self.lock = threading.Lock()
-        self.file_handles = {}  # path -> file handle
+        self.lock = threading.Lock()  # Guards the counters, not the I/O
+        self.handles = HandleCache(max_open_files)  # LRU of open file descriptors
+        
+        # Positional I/O needs no shared file offset, so runs are written concurrently
+        self.disk_pool = ThreadPoolExecutor(max_workers=disk_workers, thread_name_prefix='disk')
+        
+        # Write-behind cache drained by a background writer
+        self.pending_writes = {}  # piece_index -> piece data waiting to be written
+        self.pending_bytes = 0
+        self.write_condition = threading.Condition()
+        self.closing = False
+        self.bytes_written = 0
+        self.write_calls = 0      # Write system calls made
+        self.write_batch_bytes = 8 * 1024 * 1024  # Write as soon as this much is queued...
+        self.write_delay = 0.05                   # ...or once the oldest piece waited this long
+        
+        # Callback(piece_index, written) once a piece's writes are done; written is
+        # False if any of them failed, so the piece is not on disk
+        self.on_piece_written = None
         
         # Create download directory structure
         self._create_directory_structure()
+        
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
 
     # Create necessary directories for the torrent files
     def _create_directory_structure(self):
@@ -21,86 +100,343 @@ class FileManager:
         # Create base download directory
         os.makedirs(self.download_dir, exist_ok=True)
         
-        # Create directories for all files
-        for file_info in self.torrent.files:
-            file_path = os.path.join(self.download_dir, *file_info['path'])
-            directory = os.path.dirname(file_path)
-            
-            if directory:
+        # Create each directory holding files once, however many files it holds
+        for components in self.torrent.files.dirs:
+            if components:
+                directory = os.path.join(self.download_dir, *components)
                 os.makedirs(directory, exist_ok=True)
                 print(f"Created directory: {directory}")
 
-    # Write a completed piece to the appropriate file(s)
-    def write_piece(self, piece_index: int, piece_data: bytes):
-        with self.lock:
-            print(f"Writing piece {piece_index} to disk ({len(piece_data)} bytes)")
+    # Queue a completed piece for the background writer. The piece buffer must stay
+    # untouched until on_piece_written(piece_index, written) is called, so the piece
+    # manager's buffer budget also bounds this cache and throttles the picker when
+    # the disk is slow.
+    def write_piece(self, piece_index: int, piece_data: memoryview):
+        with self.write_condition:
+            self.pending_writes[piece_index] = piece_data
+            self.pending_bytes += len(piece_data)
+            self.write_condition.notify_all()
+
+    # Background writer: gathers pieces for a moment, then takes every pending piece
+    # at once so neighbouring pieces are coalesced into one sequential write
+    def _writer_loop(self):
+        while True:
+            with self.write_condition:
+                while not self.pending_writes and not self.closing:
+                    self.write_condition.wait()
+                if not self.pending_writes:
+                    return
+                deadline = time.monotonic() + self.write_delay
+                while self.pending_bytes < self.write_batch_bytes and not self.closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.write_condition.wait(remaining)
+                batch = sorted(self.pending_writes.items())
+                self.pending_writes = {}
             
-            # Calculate piece offset in the torrent
-            piece_offset = piece_index * self.torrent.piece_length
+            self._write_batch(batch)
+
+    # Hand a batch to the disk pool. Positional writes share no file offset, so
+    # different files, and different regions of one file, are written concurrently.
+    def _write_batch(self, batch: List[Tuple[int, memoryview]]):
+        batch_bytes = sum(len(piece_data) for _, piece_data in batch)
+        print(f"Writing {len(batch)} pieces to disk ({batch_bytes} bytes)")
+        
+        tasks = self._plan_tasks(self._plan_runs(batch))
+        
+        # Keep the files about to be written open while the tasks wait their turn
+        for runs in tasks:
+            for run in runs:
+                self.handles.add_pending(self._file_path(run[0]))
+        remaining = [len(tasks)]
+        failed = set()  # Pieces with a run that could not be written
+        remaining_lock = threading.Lock()
+        
+        # The batch is done when its last task is written
+        def task_done(future):
+            with remaining_lock:
+                failed.update(future.result())
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self._finish_batch(batch, batch_bytes, failed)
+        
+        if not tasks:
+            self._finish_batch(batch, batch_bytes, failed)
+        for runs in tasks:
+            self.disk_pool.submit(self._write_runs, runs).add_done_callback(task_done)
+
+    # Group runs into disk pool tasks: runs of one file share a task up to
+    # DISK_TASK_BYTES, so small scattered pieces do not become one task each
+    def _plan_tasks(self, runs: List[list]) -> List[List[list]]:
+        tasks = []
+        open_tasks = {}  # file_index -> [runs, bytes] of the task still being filled
+        for run in runs:
+            task = open_tasks.get(run[0])
+            if task is None or task[1] >= DISK_TASK_BYTES:
+                task = [[], 0]
+                open_tasks[run[0]] = task
+                tasks.append(task[0])
+            task[0].append(run)
+            task[1] += run[2] - run[1]
+        return tasks
+
+    # Write a task's runs one after another; returns the pieces of runs that failed
+    def _write_runs(self, runs: List[list]) -> Set[int]:
+        failed = set()
+        for file_index, position, _, views, pieces in runs:
+            if not self._write_to_file(file_index, position, views):
+                failed.update(pieces)
+            self.handles.remove_pending(self._file_path(file_index))
+        return failed
+
+    # Release a written batch from the cache and report its pieces
+    def _finish_batch(self, batch: List[Tuple[int, memoryview]], batch_bytes: int, failed: Set[int]):
+        with self.write_condition:
+            self.pending_bytes -= batch_bytes
+            self.write_condition.notify_all()
+        
+        if self.on_piece_written:
+            for piece_index, _ in batch:
+                self.on_piece_written(piece_index, piece_index not in failed)
+
+    # Split pieces sorted by index into per-file runs, merging runs that are contiguous
+    def _plan_runs(self, batch: List[Tuple[int, memoryview]]) -> List[list]:
+        runs = []  # [file_index, file position, end position, [views], [piece indices]]
+        for piece_index, piece_data in batch:
+            for file_index, file_write_pos, file_data in self._piece_segments(piece_index, piece_data):
+                # Extend the previous run if this lands right after it in the same file
+                if runs and runs[-1][0] == file_index and runs[-1][2] == file_write_pos:
+                    runs[-1][2] += len(file_data)
+                    runs[-1][3].append(file_data)
+                    runs[-1][4].append(piece_index)
+                    continue
+                runs.append([file_index, file_write_pos, file_write_pos + len(file_data),
+                             [file_data], [piece_index]])
+        return runs
+
+    # Split piece data starting at offset into the piece into (file_index, file position,
+    # view) for each file it overlaps
+    def _piece_segments(self, piece_index: int, piece_data: memoryview,
+                        offset: int = 0) -> List[Tuple[Dict, int, memoryview]]:
+        return [(file_index, position, piece_data[data_pos:data_pos + length])
+                for file_index, position, data_pos, length
+                in self._piece_extents(piece_index, offset, len(piece_data))]
+
+    # Map length bytes at offset into a piece onto files: (file_index, file position,
+    # position in the data, length) for each file the range overlaps
+    def _piece_extents(self, piece_index: int, offset: int, length: int) -> List[Tuple[Dict, int, int, int]]:
+        # Calculate the range's offset in the torrent
+        range_offset = piece_index * self.torrent.piece_length + offset
+        files = self.torrent.files
+        
+        extents = []
+        for file_index in files.files_in_range(range_offset, length):
+            file_start = files.offset(file_index)
+            file_end = file_start + files.length(file_index)
             
-            # Find files that this piece overlaps with
-            overlapping_files = self.torrent.get_files_for_piece(piece_index)
+            # Calculate overlap between the range and the file
+            overlap_start = max(range_offset, file_start)
+            overlap_end = min(range_offset + length, file_end)
+            if overlap_start >= overlap_end:
+                continue
             
-            # Write piece data to each overlapping file
-            piece_pos = 0
-            for file_info in overlapping_files:
-                file_start = file_info['offset']
-                file_end = file_start + file_info['length']
-                
-                # Calculate overlap between piece and file
-                overlap_start = max(piece_offset, file_start)
-                overlap_end = min(piece_offset + len(piece_data), file_end)
-                
-                if overlap_start < overlap_end:
-                    # Calculate positions
-                    file_write_pos = overlap_start - file_start
-                    piece_read_pos = overlap_start - piece_offset
-                    overlap_length = overlap_end - overlap_start
-                    
-                    # Extract data for this file
-                    file_data = piece_data[piece_read_pos:piece_read_pos + overlap_length]
-                    
-                    # Write to file
-                    self._write_to_file(file_info, file_write_pos, file_data)
-
-    # Write data to a specific file at a specific position
-    def _write_to_file(self, file_info: Dict, position: int, data: bytes):
-        file_path = os.path.join(self.download_dir, *file_info['path'])
+            extents.append((file_index, overlap_start - file_start,
+                            overlap_start - range_offset, overlap_end - overlap_start))
+        return extents
+
+    # Full path of a torrent file in the download directory
+    def _file_path(self, file_index: int) -> str:
+        return os.path.join(self.download_dir, *self.torrent.files.path(file_index))
+
+    # Get the descriptor for a file from the handle cache, creating the file at full
+    # size on first use; pair with self.handles.release(file_path)
+    def _get_fd(self, file_index: int, file_path: str) -> int:
+        def open_file() -> int:
+            # Create file with correct size if it doesn't exist
+            if not os.path.exists(file_path):
+                with open(file_path, 'wb') as f:
+                    f.seek(self.torrent.files.length(file_index) - 1)
+                    f.write(b'\0')
+            return os.open(file_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        
+        return self.handles.acquire(file_path, open_file)
+
+    # Write consecutive views to a specific file starting at a specific position;
+    # returns False, after reporting the error, if the write failed
+    def _write_to_file(self, file_index: int, position: int, views: List[memoryview]) -> bool:
+        file_path = self._file_path(file_index)
         
         try:
-            # Open file if not already open
-            if file_path not in self.file_handles:
-                # Create file with correct size if it doesn't exist
-                if not os.path.exists(file_path):
-                    with open(file_path, 'wb') as f:
-                        f.seek(file_info['length'] - 1)
-                        f.write(b'\0')
-                
-                # Open file for random access
-                self.file_handles[file_path] = open(file_path, 'r+b')
-            
-            # Write data at specified position
-            file_handle = self.file_handles[file_path]
-            file_handle.seek(position)
-            file_handle.write(data)
-            file_handle.flush()
+            fd = self._get_fd(file_index, file_path)
+            try:
+                calls = self._pwritev(fd, views, position)
+            finally:
+                self.handles.release(file_path)
             
-            print(f"Wrote {len(data)} bytes to {file_path} at position {position}")
+            length = sum(len(view) for view in views)
+            with self.lock:
+                self.bytes_written += length
+                self.write_calls += calls
+            print(f"Wrote {length} bytes to {file_path} at position {position}")
+            return True
             
         except Exception as e:
             print(f"Error writing to file {file_path}: {e}")
+            return False
 
-    # Close all open file handles
-    def close_all_files(self):
-        with self.lock:
-            for file_path, file_handle in self.file_handles.items():
+    # Write views back to back at position, retrying short writes; returns system calls made
+    def _pwritev(self, fd: int, views: List[memoryview], position: int) -> int:
+        calls = 0
+        if not hasattr(os, 'pwritev'):
+            for view in views:
+                while view:
+                    written = os.pwrite(fd, view, position)
+                    view = view[written:]
+                    position += written
+                    calls += 1
+            return calls
+        
+        first = 0
+        while first < len(views):
+            written = os.pwritev(fd, views[first:first + MAX_IO_SEGMENTS], position)
+            position += written
+            calls += 1
+            while first < len(views) and written >= len(views[first]):
+                written -= len(views[first])
+                first += 1
+            if written:
+                views[first] = views[first][written:]
+        return calls
+
+    # Write received blocks of an unfinished piece straight away, bypassing the cache,
+    # so they survive a restart. Used at shutdown; blocks are numbered by block_size.
+    # Returns False if any of them could not be written.
+    def write_blocks(self, piece_index: int, blocks: List[int], piece_data: memoryview, block_size: int) -> bool:
+        # Coalesce consecutive blocks into one write per range
+        ranges = []
+        for block in sorted(blocks):
+            start = block * block_size
+            end = min(start + block_size, len(piece_data))
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        
+        written = True
+        for start, end in ranges:
+            for file_index, position, view in self._piece_segments(piece_index, piece_data[start:end], start):
+                written &= self._write_to_file(file_index, position, [view])
+        return written
+
+    # Read a piece back from disk into a new buffer, None if the files do not hold it yet
+    def read_piece(self, piece_index: int) -> Optional[bytearray]:
+        piece_data = bytearray(self.torrent.get_piece_length(piece_index))
+        try:
+            for file_index, position, view in self._piece_segments(piece_index, memoryview(piece_data)):
+                file_path = self._file_path(file_index)
+                if file_path not in self.handles and not os.path.exists(file_path):
+                    return None
+                fd = self._get_fd(file_index, file_path)
                 try:
-                    file_handle.close()
-                    print(f"Closed file: {file_path}")
+                    if not self._preadv(fd, [view], position):
+                        return None
+                finally:
+                    self.handles.release(file_path)
+        except OSError as e:
+            print(f"Error reading piece {piece_index}: {e}")
+            return None
+        return piece_data
+
+    # Fill views from position, retrying short reads; False if the file ends first
+    def _preadv(self, fd: int, views: List[memoryview], position: int) -> bool:
+        first = 0
+        while first < len(views):
+            if hasattr(os, 'preadv'):
+                count = os.preadv(fd, views[first:first + MAX_IO_SEGMENTS], position)
+            else:
+                data = os.pread(fd, len(views[first]), position)
+                views[first][:len(data)] = data
+                count = len(data)
+            if count == 0:
+                return False
+            position += count
+            while first < len(views) and count >= len(views[first]):
+                count -= len(views[first])
+                first += 1
+            if count:
+                views[first] = views[first][count:]
+        return True
+
+    # Hash pieces already on disk against the torrent, across a process pool reading
+    # through mmap; returns the indices that verified. Pieces spanning files are hashed
+    # across them. Meant for start-up, before anything is written.
+    def recheck(self, piece_indices: Optional[Iterable[int]] = None,
+                workers: Optional[int] = None) -> Set[int]:
+        if piece_indices is None:
+            piece_indices = range(self.torrent.get_total_pieces())
+        
+        # Group consecutive pieces into tasks so each worker reads long sequential runs
+        tasks = []
+        task_bytes = RECHECK_TASK_BYTES
+        for piece_index in sorted(piece_indices):
+            length = self.torrent.get_piece_length(piece_index)
+            extents = [(self._file_path(file_index), position, extent_length)
+                       for file_index, position, _, extent_length
+                       in self._piece_extents(piece_index, 0, length)]
+            if task_bytes >= RECHECK_TASK_BYTES:
+                tasks.append([[], 0])
+                task_bytes = 0
+            tasks[-1][0].append((piece_index, bytes(self.torrent.get_piece_hash(piece_index)), extents))
+            tasks[-1][1] += length
+            task_bytes += length
+        
+        total_pieces = sum(len(pieces) for pieces, _ in tasks)
+        total_bytes = sum(task_bytes for _, task_bytes in tasks)
+        print(f"Rechecking {total_pieces} pieces ({total_bytes} bytes) in {self.download_dir}")
+        
+        verified = set()
+        checked_pieces = 0
+        checked_bytes = 0
+        start = time.monotonic()
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            futures = {pool.submit(_recheck_pieces, pieces): (len(pieces), task_bytes)
+                       for pieces, task_bytes in tasks}
+            for future in as_completed(futures):
+                try:
+                    verified.update(future.result())
                 except Exception as e:
-                    print(f"Error closing file {file_path}: {e}")
-            
-            self.file_handles.clear()
+                    print(f"Error rechecking pieces: {e}")
+                
+                task_pieces, task_bytes = futures[future]
+                checked_pieces += task_pieces
+                checked_bytes += task_bytes
+                elapsed = max(time.monotonic() - start, 1e-6)
+                print(f"\r Rechecking: {checked_pieces * 100.0 / total_pieces:.1f}% "
+                      f"({checked_pieces}/{total_pieces} pieces, {len(verified)} verified) | "
+                      f"{checked_bytes / elapsed / 1e6:.1f} MB/s", end="", flush=True)
+        
+        elapsed = time.monotonic() - start
+        if total_pieces:
+            print()
+        print(f"Recheck found {len(verified)} of {total_pieces} pieces on disk "
+              f"in {elapsed:.2f}s ({total_bytes / max(elapsed, 1e-6) / 1e6:.1f} MB/s)")
+        return verified
+
+    # Block until every queued piece has been written
+    def flush(self):
+        with self.write_condition:
+            while self.pending_bytes:
+                self.write_condition.wait()
+
+    # Close all open file handles
+    def close_all_files(self):
+        self.handles.close_all()
+
+    # Open/close churn, hit rate and evictions of the file handle cache
+    def get_handle_stats(self) -> Dict:
+        return self.handles.get_stats()
 
     # Verify that all files have the correct size
     def verify_file_integrity(self) -> bool:
@@ -133,8 +469,17 @@ class FileManager:
     def get_download_path(self) -> str:
         return os.path.abspath(self.download_dir)
 
-    # Clean up resources
+    # Clean up resources, writing out whatever is still queued first
     def cleanup(self):
+        with self.write_condition:
+            self.closing = True
+            self.write_condition.notify_all()
+        self.writer_thread.join()
+        self.disk_pool.shutdown(wait=True)
+        
+        stats = self.handles.get_stats()
+        print(f"File handles: {stats['opens']} opens, {stats['evictions']} evictions, "
+              f"{stats['hit_rate'] * 100:.1f}% hit rate")
         self.close_all_files()
 
 
@@ -0,0 +1,80 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterator, List
+
+# The torrent's files in columns: cumulative byte offsets in an array('q') (one
+# more entry than there are files, ending at the total length), lengths in
+# another, and paths split into a shared table of directory tuples plus a file
+# name, with every component interned. Finding the files a byte range overlaps
+# is a bisect over the offsets instead of a scan of every file.
+class FileTable:
+
+    def __init__(self):
+        self.offsets = array('q', [0])  # offsets[i] is where file i starts
+        self.lengths = array('q')
+        self.dirs = []                  # Directory component tuples, shared between files
+        self.dir_index = {}             # Directory tuple -> index in dirs
+        self.file_dirs = array('l')     # File -> index of its directory in dirs
+        self.names = []                 # File -> file name
+        self.interned = {}              # Path component -> the one copy kept of it
+
+    # Add a file at the end of the torrent
+    def append(self, path: List[str], length: int):
+        components = tuple(self.interned.setdefault(part, part) for part in path)
+        directory = components[:-1]
+        dir_number = self.dir_index.get(directory)
+        if dir_number is None:
+            dir_number = len(self.dirs)
+            self.dirs.append(directory)
+            self.dir_index[directory] = dir_number
+
+        self.file_dirs.append(dir_number)
+        self.names.append(components[-1])
+        self.lengths.append(length)
+        self.offsets.append(self.offsets[-1] + length)
+
+    # Path components of a file
+    def path(self, file_index: int) -> List[str]:
+        return list(self.dirs[self.file_dirs[file_index]]) + [self.names[file_index]]
+
+    # Byte offset of a file in the torrent
+    def offset(self, file_index: int) -> int:
+        return self.offsets[file_index]
+
+    # Length of a file
+    def length(self, file_index: int) -> int:
+        return self.lengths[file_index]
+
+    # Total length of all files
+    def total_length(self) -> int:
+        return self.offsets[-1]
+
+    # Indices of the non-empty files overlapping length bytes at offset
+    def files_in_range(self, offset: int, length: int) -> List[int]:
+        count = len(self.lengths)
+        if length <= 0 or count == 0:
+            return []
+
+        # Last file starting at or before offset (never an empty file unless it
+        # is at the very end), through the last file starting before the range ends
+        first = max(bisect_right(self.offsets, offset, 0, count) - 1, 0)
+        last = bisect_left(self.offsets, offset + length, 0, count)
+        lengths = self.lengths
+        return [file_index for file_index in range(first, last) if lengths[file_index]]
+
+    # File entry in the dict form used before the table: path, length and offset
+    def __getitem__(self, file_index: int) -> Dict:
+        if file_index < 0:
+            file_index += len(self.lengths)
+        if not 0 <= file_index < len(self.lengths):
+            raise IndexError(f"File index {file_index} out of range")
+        return {'path': self.path(file_index),
+                'length': self.lengths[file_index],
+                'offset': self.offsets[file_index]}
+
+    def __iter__(self) -> Iterator[Dict]:
+        for file_index in range(len(self.lengths)):
+            yield self[file_index]
+
+    def __len__(self) -> int:
+        return len(self.lengths)
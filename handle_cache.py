@@ -0,0 +1,122 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict
+
+# Keeps at most max_open file descriptors open, closing the least recently used
+# ones to make room. Descriptors held by an I/O call are never closed under it,
+# and files with writes queued on the disk pool are evicted only when nothing
+# else can go, so a file is not closed just before it is written again. When
+# every candidate is busy the cap is exceeded until one is released.
+class HandleCache:
+
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.handles = OrderedDict()  # path -> fd, least recently used first
+        self.users = {}               # path -> I/O calls holding its fd
+        self.pending = {}             # path -> queued writes to the file
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.opens = 0
+        self.closes = 0
+        self.evictions = 0
+
+    # Get the descriptor for path, opening it with open_file() on a miss; the
+    # caller must release(path) once its I/O is done
+    def acquire(self, path: str, open_file: Callable[[], int]) -> int:
+        with self.lock:
+            fd = self.handles.get(path)
+            if fd is not None:
+                self.handles.move_to_end(path)
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._evict(self.max_open - 1)
+                fd = open_file()
+                self.handles[path] = fd
+                self.opens += 1
+            self.users[path] = self.users.get(path, 0) + 1
+            return fd
+
+    # An I/O call is done with path's descriptor
+    def release(self, path: str):
+        with self.lock:
+            users = self.users[path] - 1
+            if users:
+                self.users[path] = users
+            else:
+                del self.users[path]
+                if len(self.handles) > self.max_open:
+                    self._evict(self.max_open)
+
+    # Count a write queued for path
+    def add_pending(self, path: str):
+        with self.lock:
+            self.pending[path] = self.pending.get(path, 0) + 1
+
+    # A queued write to path has been made
+    def remove_pending(self, path: str):
+        with self.lock:
+            pending = self.pending[path] - 1
+            if pending:
+                self.pending[path] = pending
+            else:
+                del self.pending[path]
+
+    # Close least recently used idle descriptors until at most limit are open,
+    # sparing files with queued writes while others can go (lock must be held)
+    def _evict(self, limit: int):
+        for spare_pending in (True, False):
+            excess = len(self.handles) - limit
+            if excess <= 0:
+                return
+            victims = []
+            for path in self.handles:
+                if path in self.users or (spare_pending and path in self.pending):
+                    continue
+                victims.append(path)
+                if len(victims) == excess:
+                    break
+            for path in victims:
+                self._close(path)
+                self.evictions += 1
+
+    # Close and forget a descriptor (lock must be held)
+    def _close(self, path: str):
+        fd = self.handles.pop(path)
+        self.closes += 1
+        try:
+            os.close(fd)
+        except OSError as e:
+            print(f"Error closing file {path}: {e}")
+
+    # Close every descriptor
+    def close_all(self):
+        with self.lock:
+            for path in list(self.handles):
+                self._close(path)
+                print(f"Closed file: {path}")
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.handles
+
+    def __len__(self) -> int:
+        return len(self.handles)
+
+    # Open/close churn, hit rate and evictions
+    def get_stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'open_files': len(self.handles),
+                'max_open_files': self.max_open,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'opens': self.opens,
+                'closes': self.closes,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,63 @@
+import os
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+from utils import sha1_hash
+
+# Verifies completed pieces off the caller's thread. Worker threads hash the
+# piece buffer in place through a memoryview (hashlib releases the GIL while it
+# runs, so threads scale across cores); worker processes avoid the GIL
+# entirely but need the piece pickled across to them, which costs one copy.
+class HashPool:
+
+    def __init__(self, workers: Optional[int] = None, use_processes: bool = False):
+        self.workers = workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='hash')
+
+    # Hash data in the pool; callback(piece_index, verified) runs on a pool thread
+    def submit(self, piece_index: int, data: memoryview, expected_hash: bytes,
+               callback: Callable[[int, bool], None]) -> Future:
+        if self.use_processes:
+            future = self.executor.submit(sha1_hash, bytes(data))
+        else:
+            future = self.executor.submit(sha1_hash, data)
+        future.add_done_callback(
+            lambda done: self._on_hashed(done, piece_index, expected_hash, callback))
+        return future
+
+    # Feed data into a running hash on a pool thread, then call callback() there (threads only)
+    def feed(self, piece_index: int, hasher, data: memoryview, callback: Callable[[], None]) -> Future:
+        future = self.executor.submit(hasher.update, data)
+        future.add_done_callback(lambda done: self._on_fed(done, piece_index, callback))
+        return future
+
+    # Continue with the piece once its data is in the running hash
+    def _on_fed(self, future: Future, piece_index: int, callback: Callable[[], None]):
+        try:
+            future.result()
+        except CancelledError:
+            return  # Pool shut down before the data was hashed
+        except Exception as e:
+            print(f"Error hashing piece {piece_index}: {e}")
+            return
+        callback()
+
+    # Compare the digest and report the result
+    def _on_hashed(self, future: Future, piece_index: int, expected_hash: bytes,
+                   callback: Callable[[int, bool], None]):
+        try:
+            verified = future.result() == expected_hash
+        except CancelledError:
+            return  # Pool shut down before the piece was hashed
+        except Exception as e:
+            print(f"Error hashing piece {piece_index}: {e}")
+            verified = False
+        callback(piece_index, verified)
+
+    # Stop the workers, dropping pieces that have not started hashing
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 import threading
@@ -6,8 +7,12 @@ from typing import List, Set
 from torrent import TorrentFile
 from tracker import TrackerClient
 from peer import PeerConnection
-from piece_manager import PieceManager
+from peer_engine import AsyncPeerConnection, PeerEngine
+from piece_manager import BLOCK_SIZE, PieceManager
+from bitfield import Bitfield
 from file_manager import FileManager
+from hash_pool import HashPool
+from resume import ResumeStore
 from utils import format_bytes, format_speed, create_peer_id
 
 # Main BitTorrent client class
@@ -23,6 +28,9 @@ class BitTorrentClient:
         self.tracker_client = None
         self.piece_manager = None
         self.file_manager = None
+        self.hash_pool = None
+        self.resume = None
+        self.peer_engine = PeerEngine()
         
         # Peer management
         self.peers = {}  # (ip, port) -> PeerConnection
@@ -39,6 +47,19 @@ class BitTorrentClient:
         self.main_thread = None
         self.stats_thread = None
         
+        # Scheduling: peers wake the download loop whenever something changes
+        self.schedule_event = threading.Event()
+        self.maintenance_interval = 1.0  # Seconds between peer/tracker housekeeping
+        self.request_timeout = 30.0      # Seconds before an unanswered request is re-issued
+        self.checkpoint_interval = 60.0  # Seconds between fast-resume checkpoints
+        self.recheck = False             # Hash everything on disk at start, ignoring fast-resume data
+        
+        # Piece verification: worker threads hash in place, processes sidestep the GIL
+        self.hash_workers = os.cpu_count() or 1
+        self.hash_processes = False
+        self.buffer_budget = 256 * 1024 * 1024  # Bytes of piece buffers in flight at once
+        self.matrix_picker = None  # NumPy piece picker: None uses it for large torrents if NumPy is installed
+        
         # Setup signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, self._signal_handler)
         signal.signal(signal.SIGTERM, self._signal_handler)
@@ -100,52 +121,119 @@ class BitTorrentClient:
         # Initialize tracker client
         self.tracker_client = TrackerClient(self.torrent, self.peer_id)
         
-        # Initialize piece manager
-        self.piece_manager = PieceManager(self.torrent)
+        # Initialize piece manager, verifying completed pieces on the hashing pool
+        self.hash_pool = HashPool(self.hash_workers, self.hash_processes)
+        self.piece_manager = PieceManager(self.torrent, self.request_timeout,
+                                          self.hash_pool, self.buffer_budget,
+                                          self.matrix_picker)
         self.piece_manager.on_piece_completed = self._on_piece_completed
+        self.piece_manager.on_cancel_request = self._on_cancel_request
+        self.piece_manager.on_piece_hashed = lambda index, verified: self._wake_scheduler()
+        self.piece_manager.on_peer_banned = self._on_peer_banned
         
-        # Initialize file manager
+        # Initialize file manager; written pieces release their buffers
         self.file_manager = FileManager(self.torrent, self.download_dir)
+        self.file_manager.on_piece_written = self._on_piece_written
+        
+        # Pick up where the last run left off
+        self.resume = ResumeStore(self.torrent, self.download_dir)
+        self._restore_progress()
+        
+        # Start the event loop that drives all peer connections
+        self.peer_engine.start()
         
         print("All components initialized successfully")
 
+    # Restore pieces recorded by the fast-resume file. After a clean shutdown with the
+    # files untouched they are trusted as is; otherwise only the pieces it names are
+    # rechecked. Without fast-resume data, whatever is already on disk is rechecked.
+    def _restore_progress(self):
+        state = None if self.recheck else self.resume.load()
+        if state is None:
+            if self.recheck or self._has_existing_data():
+                pieces = self.file_manager.recheck(workers=self.hash_workers)
+                self.piece_manager.restore(pieces, {})
+                print(f"Resumed {len(pieces)} pieces found on disk")
+            return
+        
+        if state.trusted:
+            pieces = state.pieces
+        else:
+            pieces = self.file_manager.recheck(state.pieces, self.hash_workers)
+        
+        partial = {}
+        for piece_index, blocks in state.partial.items():
+            piece_data = self.file_manager.read_piece(piece_index)
+            if piece_data is not None:
+                partial[piece_index] = (blocks, piece_data)
+        
+        self.piece_manager.restore(pieces, partial)
+        print(f"Resumed {len(pieces)} pieces and {len(partial)} partial pieces")
+
+    # Check if any of the torrent's files already exists with data in it
+    def _has_existing_data(self) -> bool:
+        for file_info in self.torrent.files:
+            file_path = os.path.join(self.download_dir, *file_info['path'])
+            if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
+                return True
+        return False
+
     # Main download loop
     def _download_loop(self):
         last_announce = 0
+        last_maintenance = 0
+        last_checkpoint = time.time()
         announce_interval = 1800  # 30 minutes
         
         while self.running and not self.piece_manager.is_complete():
             try:
-                # Announce to tracker periodically
-                current_time = time.time()
-                if current_time - last_announce > announce_interval:
-                    self._announce_to_tracker()
-                    last_announce = current_time
+                # Sleep until a peer event arrives or housekeeping is due
+                self.schedule_event.wait(self.maintenance_interval)
+                self.schedule_event.clear()
                 
-                # Connect to new peers if needed
-                self._manage_peer_connections()
+                current_time = time.time()
+                if current_time - last_maintenance >= self.maintenance_interval:
+                    # Announce to tracker periodically
+                    if current_time - last_announce > announce_interval:
+                        self._announce_to_tracker()
+                        last_announce = current_time
+                    
+                    # Connect to new peers if needed
+                    self._manage_peer_connections()
+                    
+                    # Re-issue requests that peers never answered
+                    self._expire_stale_requests()
+                    
+                    # Clean up disconnected peers
+                    self._cleanup_disconnected_peers()
+                    
+                    # Fold the journal into a fresh checkpoint
+                    if current_time - last_checkpoint >= self.checkpoint_interval:
+                        self.resume.save(self.piece_manager)
+                        last_checkpoint = current_time
+                    
+                    last_maintenance = current_time
                 
-                # Request pieces from connected peers
+                # Refill every peer's request pipeline
                 self._request_pieces_from_peers()
                 
-                # Clean up disconnected peers
-                self._cleanup_disconnected_peers()
-                
-                time.sleep(1)  # Prevent busy waiting
-                
             except Exception as e:
                 print(f"Error in download loop: {e}")
                 time.sleep(5)
 
+    # Wake the download loop so it refills request pipelines immediately
+    def _wake_scheduler(self):
+        self.schedule_event.set()
+
     # Announce to tracker and get peer list
     def _announce_to_tracker(self):
         try:
             # Update tracker stats
-            stats = self.piece_manager.get_download_stats()
+            progress = self.piece_manager.get_progress()
             self.tracker_client.update_stats(
-                downloaded=stats['bytes_downloaded'],
+                downloaded=progress['verified_bytes'],
                 uploaded=0,  # We don't upload in this simple client
-                left=stats['total_bytes'] - stats['bytes_downloaded']
+                left=self.torrent.total_length - progress['verified_bytes']
             )
             
             # Get peers from tracker
@@ -156,6 +244,8 @@ class BitTorrentClient:
             
             # Add new peers
             for ip, port in peer_list:
+                if self.piece_manager.scores.is_banned(ip, port):
+                    continue
                 if (ip, port) not in self.peers and len(self.peers) < self.max_peers:
                     self._add_peer(ip, port)
             
@@ -165,21 +255,30 @@ class BitTorrentClient:
     # Add a new peer connection
     def _add_peer(self, ip: str, port: int):
         try:
-            peer = PeerConnection(ip, port, self.torrent.info_hash, self.peer_id)
-            peer.on_piece_received = self._on_piece_received
-            peer.on_have_received = self._on_have_received
+            peer = AsyncPeerConnection(ip, port, self.torrent.info_hash, self.peer_id, self.peer_engine,
+                                       self.torrent.get_total_pieces())
+            peer.on_piece_received = (
+                lambda index, offset, data, peer=peer: self._on_piece_received(peer, index, offset, data))
+            peer.claim_block_buffer = self.piece_manager.claim_block_buffer
+            peer.release_block_buffer = self.piece_manager.release_block_buffer
+            peer.on_have_received = lambda index, peer=peer: self._on_have_received(peer, index)
+            peer.on_bitfield_received = lambda added, peer=peer: self._on_bitfield_received(peer, added)
+            peer.on_unchoke = self._wake_scheduler
+            peer.on_choke = lambda peer=peer: self._on_peer_choked(peer)
+            peer.on_disconnect = lambda peer=peer: self._on_peer_disconnected(peer)
             
             self.peers[(ip, port)] = peer
             
-            # Connect to peer in background
-            threading.Thread(target=self._connect_peer, args=(peer,), daemon=True).start()
+            # Connect to peer on the peer engine's event loop
+            future = self.peer_engine.connect(peer)
+            future.add_done_callback(lambda f, peer=peer: self._on_peer_connected(peer, f))
             
         except Exception as e:
             print(f"Error adding peer {ip}:{port}: {e}")
 
-    # Connect to a peer (runs in background thread)
-    def _connect_peer(self, peer: PeerConnection):
-        if peer.connect():
+    # Handle the outcome of a connection attempt (runs on the event loop)
+    def _on_peer_connected(self, peer: PeerConnection, future):
+        if not future.cancelled() and future.exception() is None and future.result():
             # Send interested message
             peer.send_interested()
 
@@ -191,47 +290,103 @@ class BitTorrentClient:
             # Try to get more peers if we don't have enough connections
             threading.Thread(target=self._announce_to_tracker, daemon=True).start()
 
-    # Request pieces from connected peers
+    # Request pieces from connected peers, filling each peer's pipeline
     def _request_pieces_from_peers(self):
-        for peer in self.peers.values():
-            if peer.can_request():
-                # Get available pieces from this peer
-                available_pieces = set()
-                for i in range(len(peer.peer_pieces)):
-                    if peer.has_piece(i):
-                        available_pieces.add(i)
-                
-                # Request next piece/block
-                request = self.piece_manager.get_next_request(available_pieces)
-                if request:
-                    piece_index, offset, length = request
-                    peer.request_piece(piece_index, offset, length)
+        for peer in list(self.peers.values()):
+            if not peer.can_request() or peer.available_request_slots() <= 0:
+                continue
+            
+            # Fill the free pipeline slots with one batch of blocks
+            requests = self.piece_manager.get_next_requests(peer, peer.available_request_slots())
+            for i, (piece_index, offset, length) in enumerate(requests):
+                if not peer.request_piece(piece_index, offset, length):
+                    for piece_index, offset, length in requests[i:]:
+                        self.piece_manager.reset_block_request(piece_index, offset, peer)
+                    break
+
+    # Cancel timed out requests; the piece manager has already freed their blocks
+    def _expire_stale_requests(self):
+        expired = self.piece_manager.expire_requests()
+        for peer, piece_index, offset, length in expired:
+            peer.send_cancel(piece_index, offset, length)
+        
+        if expired:
+            print(f"\n{len(expired)} requests timed out and were reassigned")
+            self._wake_scheduler()
 
-    # Remove disconnected peers
+    # Remove disconnected peers (peers still connecting are kept)
     def _cleanup_disconnected_peers(self):
         disconnected = []
         for key, peer in self.peers.items():
-            if not peer.connected:
+            if peer.is_closed():
                 disconnected.append(key)
         
         for key in disconnected:
             del self.peers[key]
 
     # Handle received piece data
-    def _on_piece_received(self, piece_index: int, offset: int, data: bytes):
-        self.piece_manager.add_piece_data(piece_index, offset, data)
+    def _on_piece_received(self, peer: PeerConnection, piece_index: int, offset: int, data: memoryview):
+        self.piece_manager.add_piece_data(piece_index, offset, data, peer)
         self.bytes_downloaded += len(data)
+        self._wake_scheduler()
+
+    # Cancel a duplicate endgame request once another peer delivered the block
+    def _on_cancel_request(self, peer: PeerConnection, piece_index: int, offset: int, length: int):
+        peer.send_cancel(piece_index, offset, length)
+
+    # Peer choked us: its outstanding blocks go back to the picker
+    def _on_peer_choked(self, peer: PeerConnection):
+        self.piece_manager.release_peer_requests(peer)
+        self._wake_scheduler()
+
+    # Peer went away: return its blocks and forget its pieces
+    def _on_peer_disconnected(self, peer: PeerConnection):
+        if not self.piece_manager:
+            return
+        
+        self.piece_manager.release_peer_requests(peer)
+        self.piece_manager.remove_peer_pieces(peer)
+        self._wake_scheduler()
+
+    # Peer sent too much corrupt data: drop it; the tracker's copy of its address is skipped
+    def _on_peer_banned(self, peer: PeerConnection):
+        peer.disconnect()
+        self._wake_scheduler()
 
     # Handle HAVE message from peer
-    def _on_have_received(self, piece_index: int):
+    def _on_have_received(self, peer: PeerConnection, piece_index: int):
         """Handle HAVE message from peer"""
-        pass  # Could be used for piece rarity tracking
+        self.piece_manager.add_peer_have(peer, piece_index)
+        if not peer.am_interested and piece_index not in self.piece_manager.completed_pieces:
+            peer.send_interested()
+        self._wake_scheduler()
+
+    # Handle BITFIELD message from peer; added holds the pieces not yet counted from HAVEs
+    def _on_bitfield_received(self, peer: PeerConnection, added: Bitfield):
+        self.piece_manager.add_peer_pieces(peer, added)
+        if not self.piece_manager.wants_pieces_from(peer.peer_pieces):
+            # Nothing we need; HAVEs for pieces we lack make us interested again
+            peer.send_not_interested()
+        self._wake_scheduler()
 
     # Handle completed piece
-    def _on_piece_completed(self, piece_index: int, piece_data: bytes):
-        # Write piece to disk
+    def _on_piece_completed(self, piece_index: int, piece_data: memoryview):
+        # Queue piece for the background writer
         self.file_manager.write_piece(piece_index, piece_data)
 
+    # Piece reached the disk: its buffer is free for a new piece. A piece that could
+    # not be written is downloaded again instead.
+    def _on_piece_written(self, piece_index: int, written: bool):
+        if not written:
+            self.piece_manager.piece_write_failed(piece_index)
+            self._wake_scheduler()
+            return
+        self.piece_manager.piece_written(piece_index)
+        resume = self.resume
+        if resume:
+            resume.record_piece(piece_index)
+        self._wake_scheduler()
+
     # Display download statistics
     def _stats_loop(self):
         last_bytes = 0
@@ -285,14 +440,42 @@ class BitTorrentClient:
         
         self.running = False
         
+        # Release the download loop if it is waiting for peer events
+        self.schedule_event.set()
+        
         # Disconnect all peers
-        for peer in self.peers.values():
+        for peer in list(self.peers.values()):
             peer.disconnect()
+        self.peer_engine.stop()
         
-        # Clean up file manager
+        # Let pieces already being hashed reach the disk before closing files
+        if self.hash_pool:
+            self.hash_pool.shutdown()
+        
+        # Save the blocks of unfinished pieces so a restart does not fetch them again;
+        # a piece whose blocks could not be written is left out of the checkpoint
+        partial = {}
+        if self.resume and self.file_manager:
+            for piece_index, blocks, piece_data in self.piece_manager.get_partial_pieces():
+                if self.file_manager.write_blocks(piece_index, blocks, piece_data, BLOCK_SIZE):
+                    partial[piece_index] = blocks
+        
+        # Clean up file manager once queued pieces are written
         if self.file_manager:
             self.file_manager.cleanup()
         
+        # Every write has finished, so the checkpoint can vouch for the files
+        resume, self.resume = self.resume, None
+        if resume:
+            resume.save(self.piece_manager, partial, clean=True)
+            resume.close()
+        
+        # How long threads waited on the piece manager's locks
+        if self.piece_manager:
+            for name, stats in self.piece_manager.get_lock_stats().items():
+                print(f"Lock {name}: {stats['contended']} of {stats['acquisitions']} acquisitions waited, "
+                      f"{stats['wait_time'] * 1e3:.1f} ms in total, longest {stats['max_wait'] * 1e3:.2f} ms")
+        
         # Final announce to tracker
         if self.tracker_client:
             try:
@@ -303,16 +486,18 @@ class BitTorrentClient:
         print("Client stopped")
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python main.py <torrent_file> [download_directory]")
+    args = [arg for arg in sys.argv[1:] if arg != '--recheck']
+    if not args:
+        print("Usage: python main.py <torrent_file> [download_directory] [--recheck]")
         print("Example: python main.py example.torrent downloads")
         sys.exit(1)
     
-    torrent_file = sys.argv[1]
-    download_dir = sys.argv[2] if len(sys.argv) > 2 else "downloads"
+    torrent_file = args[0]
+    download_dir = args[1] if len(args) > 1 else "downloads"
     
     # Create and start client
     client = BitTorrentClient(torrent_file, download_dir)
+    client.recheck = '--recheck' in sys.argv[1:]
     client.start()
 
 if __name__ == "__main__":
@@ -1,9 +1,11 @@
 import socket
 import struct
 import threading
+import math
 import time
 from typing import Optional, Callable, Set, List
-from bitstring import BitArray
+from bitfield import Bitfield
+from bencode import BencodeError, bdecode, bencode
 from utils import int_to_bytes, bytes_to_int
 
 # BitTorrent protocol message types
@@ -16,12 +18,191 @@ MSG_BITFIELD = 5
 MSG_REQUEST = 6
 MSG_PIECE = 7
 MSG_CANCEL = 8
+MSG_EXTENDED = 20  # BEP 10 extension protocol
+
+EXTENDED_HANDSHAKE_ID = 0
+
+PROTOCOL_STRING = b"BitTorrent protocol"
+HANDSHAKE_LENGTH = 68  # Handshake is always 68 bytes
+EXTENSION_PROTOCOL_BIT = 0x10  # Set in reserved byte 5 by BEP 10 peers
+
+# Request pipelining
+BLOCK_REQUEST_SIZE = 16384
+MIN_PIPELINE_DEPTH = 2       # Never fewer outstanding requests than this
+MAX_PIPELINE_DEPTH = 250     # Upper bound when the peer does not send reqq
+REQUEST_QUEUE_TIME = 2.0     # Seconds of data to keep requested ahead of the peer
+RATE_SAMPLE_INTERVAL = 0.5   # Seconds between delivery rate samples
+
+# Receive path
+READ_BUFFER_SIZE = 32768     # Initial size of the reusable receive buffer
+PIECE_HEADER_LENGTH = 13     # <length><id=7><index><begin>
+
+# Incremental wire protocol parser fed through recv_into-style buffers.
+# Transports call get_buffer() for somewhere to receive into and
+# buffer_updated(n) once n bytes have landed there. Message bodies are passed
+# on as memoryviews of a reusable buffer, and PIECE payloads are received
+# straight into the destination piece buffer when one can be claimed.
+class MessageReader:
+
+    def __init__(self, peer: 'PeerConnection', expect_handshake: bool = False):
+        self.peer = peer
+        self.expect_handshake = expect_handshake
+        self.buffer = bytearray(READ_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First unparsed byte in buffer
+        self.end = 0    # End of received data in buffer
+        
+        # PIECE payload being received in place
+        self.block = None
+        self.block_filled = 0
+        self.block_index = 0
+        self.block_begin = 0
+        self.scratch_piece = False  # Current PIECE is buffered because no destination was claimed
+        
+        # Copy accounting (bytes moved in user space after recv)
+        self.bytes_received = 0
+        self.bytes_copied = 0
+
+    # Buffer the transport should receive into next
+    def get_buffer(self) -> memoryview:
+        if self.block is not None:
+            return self.block[self.block_filled:]
+        
+        needed = self._bytes_needed()
+        self._reserve(needed)
+        return self.view[self.end:self.end + needed]
+
+    # Account for nbytes received into the last buffer and parse what is complete
+    def buffer_updated(self, nbytes: int):
+        self.bytes_received += nbytes
+        if self.block is not None:
+            self.block_filled += nbytes
+            if self.block_filled == len(self.block):
+                self._finish_block()
+            return
+        
+        self.end += nbytes
+        self._parse()
+
+    # Give back a partially received block when the connection goes away
+    def close(self):
+        if self.block is not None:
+            self.peer._release_block_buffer(self.block_index, self.block_begin)
+            self.block = None
+        self.view.release()
+
+    # Bytes to read to complete the current handshake, header or message
+    def _bytes_needed(self) -> int:
+        available = self.end - self.start
+        if self.expect_handshake:
+            return HANDSHAKE_LENGTH - available
+        if available < 5:
+            return PIECE_HEADER_LENGTH - available
+        
+        message_length = struct.unpack_from('>I', self.buffer, self.start)[0]
+        if self.buffer[self.start + 4] == MSG_PIECE and not self.scratch_piece:
+            return max(PIECE_HEADER_LENGTH - available, 1)
+        return 4 + message_length - available
+
+    # Make room for needed bytes after self.end, compacting or growing the buffer
+    def _reserve(self, needed: int):
+        if self.end + needed <= len(self.buffer):
+            return
+        
+        pending = self.end - self.start
+        if pending + needed <= len(self.buffer):
+            self.buffer[:pending] = bytes(self.view[self.start:self.end])
+        else:
+            buffer = bytearray(max(pending + needed, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.bytes_copied += pending
+        self.start = 0
+        self.end = pending
+
+    # Dispatch every complete message in the buffer
+    def _parse(self):
+        view = self.view
+        while self.peer.connected or self.expect_handshake:
+            available = self.end - self.start
+            
+            if self.expect_handshake:
+                if available < HANDSHAKE_LENGTH:
+                    break
+                self.expect_handshake = False
+                self.peer._on_handshake(bytes(view[self.start:self.start + HANDSHAKE_LENGTH]))
+                self.start += HANDSHAKE_LENGTH
+                continue
+            
+            if available < 4:
+                break
+            message_length = struct.unpack_from('>I', self.buffer, self.start)[0]
+            if message_length == 0:
+                # Keep-alive
+                self.start += 4
+                continue
+            if available < 5:
+                break
+            
+            if (self.buffer[self.start + 4] == MSG_PIECE and not self.scratch_piece
+                    and message_length >= 9):
+                if available < PIECE_HEADER_LENGTH:
+                    break
+                if self._start_block(message_length):
+                    break
+                continue
+            
+            if available < 4 + message_length:
+                break
+            message_start = self.start + 4
+            self.start = message_start + message_length
+            self.scratch_piece = False
+            self.peer._handle_message(view[message_start:self.start])
+        
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    # Claim the destination for a PIECE payload; returns True while it is still arriving
+    def _start_block(self, message_length: int) -> bool:
+        piece_index, begin = struct.unpack_from('>II', self.buffer, self.start + 5)
+        length = message_length - 9
+        destination = self.peer._claim_block_buffer(piece_index, begin, length)
+        if destination is None:
+            # Nowhere to land it; receive the whole message into the buffer instead
+            self.scratch_piece = True
+            self.bytes_copied += length
+            return False
+        
+        # Move any payload bytes that were already read past the header
+        payload_start = self.start + PIECE_HEADER_LENGTH
+        buffered = min(self.end - payload_start, length)
+        if buffered:
+            destination[:buffered] = self.view[payload_start:payload_start + buffered]
+            self.bytes_copied += buffered
+        self.start = payload_start + buffered
+        
+        self.block = destination
+        self.block_filled = buffered
+        self.block_index = piece_index
+        self.block_begin = begin
+        if buffered == length:
+            self._finish_block()
+            return False
+        return True
+
+    # Hand a fully received in-place block to the peer
+    def _finish_block(self):
+        block = self.block
+        self.block = None
+        self.peer._handle_piece(self.block_index, self.block_begin, block)
 
 # Represents a connection to a BitTorrent peer
 class PeerConnection:
 
     # Initialize peer connection
-    def __init__(self, ip: str, port: int, info_hash: bytes, peer_id: bytes):
+    def __init__(self, ip: str, port: int, info_hash: bytes, peer_id: bytes, num_pieces: int):
         self.ip = ip
         self.port = port
         self.info_hash = info_hash
@@ -39,15 +220,38 @@ class PeerConnection:
         self.peer_interested = False # Peer is interested in us
         
         # Piece availability
-        self.peer_pieces = BitArray()  # Which pieces the peer has
+        self.peer_pieces = Bitfield(num_pieces)  # Which pieces the peer has
+        self.bitfield_received = False
         
         # Request management
-        self.pending_requests = {}  # piece_index -> set of (begin, length)
-        self.max_requests = 5       # Maximum concurrent requests
+        self.pending_requests = {}  # piece_index -> {(begin, length): sent time}
+        self.max_requests = 5       # Current pipeline depth, adapted from throughput and latency
+        self.outstanding_requests = 0
+        self.outstanding_bytes = 0
+        self.request_lock = threading.Lock()
+        
+        # Pipeline sizing measurements
+        self.peer_max_requests = None  # reqq from the peer's extended handshake
+        self.supports_extensions = False
+        self.block_latency = None      # Smoothed seconds from REQUEST to PIECE
+        self.min_latency = None        # Shortest REQUEST to PIECE seen: the round trip without queueing
+        self.download_rate = 0.0       # Smoothed bytes per second from this peer
+        self._rate_bytes = 0
+        self._rate_window_start = None
         
         # Callbacks
         self.on_piece_received = None  # Callback for received piece data
+        self.claim_block_buffer = None    # (piece, begin, length) -> memoryview to receive a block into
+        self.release_block_buffer = None  # Give back a claimed buffer that was never filled
         self.on_have_received = None   # Callback for have messages
+        self.on_bitfield_received = None  # Callback(added) for a bitfield; added holds pieces not seen in a HAVE
+        self.on_unchoke = None         # Callback when the peer unchokes us
+        self.on_choke = None           # Callback when the peer chokes us (its requests are dropped)
+        self.on_disconnect = None      # Callback once the connection is gone
+        self._disconnect_notified = False
+        
+        # Receive path
+        self.reader = None  # MessageReader for the current connection
         
         # Threading
         self.receive_thread = None
@@ -68,6 +272,7 @@ class PeerConnection:
             # Perform BitTorrent handshake
             if self._perform_handshake():
                 self.handshake_completed = True
+                self._send_extended_handshake()
                 
                 # Start receive thread
                 self.running = True
@@ -89,82 +294,81 @@ class PeerConnection:
     # Perform BitTorrent protocol handshake
     def _perform_handshake(self) -> bool:
         try:
-            # Send handshake: <pstrlen><pstr><reserved><info_hash><peer_id>
-            pstr = b"BitTorrent protocol"
-            pstrlen = len(pstr)
-            reserved = b'\x00' * 8
-            
-            handshake = struct.pack('B', pstrlen) + pstr + reserved + self.info_hash + self.peer_id
-            self.socket.send(handshake)
+            self.socket.sendall(self._build_handshake())
             
             # Receive handshake response
-            response = self._receive_exact(68)  # Handshake is always 68 bytes
+            response = self._receive_exact(HANDSHAKE_LENGTH)
             if not response:
                 return False
             
-            # Parse handshake response
-            resp_pstrlen = response[0]
-            resp_pstr = response[1:1+resp_pstrlen]
-            resp_reserved = response[1+resp_pstrlen:1+resp_pstrlen+8]
-            resp_info_hash = response[1+resp_pstrlen+8:1+resp_pstrlen+8+20]
-            resp_peer_id = response[1+resp_pstrlen+8+20:1+resp_pstrlen+8+20+20]
-            
-            # Verify handshake
-            if resp_pstr != pstr or resp_info_hash != self.info_hash:
-                print(f"Handshake verification failed with peer {self.ip}:{self.port}")
-                return False
-            
-            print(f"Handshake completed with peer {self.ip}:{self.port}")
-            return True
+            return self._verify_handshake(response)
             
         except Exception as e:
             print(f"Handshake failed with peer {self.ip}:{self.port}: {e}")
             return False
 
+    # Build our handshake: <pstrlen><pstr><reserved><info_hash><peer_id>
+    def _build_handshake(self) -> bytes:
+        pstr = PROTOCOL_STRING
+        pstrlen = len(pstr)
+        reserved = bytearray(8)
+        reserved[5] |= EXTENSION_PROTOCOL_BIT
+        
+        return struct.pack('B', pstrlen) + pstr + bytes(reserved) + self.info_hash + self.peer_id
+
+    # Check the peer's handshake response
+    def _verify_handshake(self, response: bytes) -> bool:
+        # Parse handshake response
+        resp_pstrlen = response[0]
+        resp_pstr = response[1:1+resp_pstrlen]
+        resp_reserved = response[1+resp_pstrlen:1+resp_pstrlen+8]
+        resp_info_hash = response[1+resp_pstrlen+8:1+resp_pstrlen+8+20]
+        resp_peer_id = response[1+resp_pstrlen+8+20:1+resp_pstrlen+8+20+20]
+        
+        # Verify handshake
+        if resp_pstr != PROTOCOL_STRING or resp_info_hash != self.info_hash:
+            print(f"Handshake verification failed with peer {self.ip}:{self.port}")
+            return False
+        
+        self.supports_extensions = bool(resp_reserved[5] & EXTENSION_PROTOCOL_BIT)
+        print(f"Handshake completed with peer {self.ip}:{self.port}")
+        return True
+
     # Receive exactly the specified number of bytes
     def _receive_exact(self, length: int) -> Optional[bytes]:
-        data = b''
-        while len(data) < length:
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
             try:
-                chunk = self.socket.recv(length - len(data))
-                if not chunk:
+                count = self.socket.recv_into(view[received:])
+                if not count:
                     return None
-                data += chunk
+                received += count
             except Exception:
                 return None
-        return data
+        return bytes(data)
 
     # Main receive loop for handling peer messages
     def _receive_loop(self):
+        reader = self.reader = MessageReader(self)
         while self.running and self.connected:
             try:
-                # Receive message length (4 bytes)
-                length_data = self._receive_exact(4)
-                if not length_data:
-                    break
-                
-                message_length = bytes_to_int(length_data)
-                
-                # Handle keep-alive message (length = 0)
-                if message_length == 0:
-                    continue
-                
-                # Receive message data
-                message_data = self._receive_exact(message_length)
-                if not message_data:
+                count = self.socket.recv_into(reader.get_buffer())
+                if not count:
                     break
                 
-                # Process message
-                self._handle_message(message_data)
+                reader.buffer_updated(count)
                 
             except Exception as e:
                 print(f"Error in receive loop for peer {self.ip}:{self.port}: {e}")
                 break
         
+        reader.close()
         self.disconnect()
 
-    # Handle received peer message
-    def _handle_message(self, message: bytes):
+    # Handle received peer message (a memoryview only valid during the call)
+    def _handle_message(self, message: memoryview):
         if len(message) == 0:
             return
         
@@ -174,10 +378,16 @@ class PeerConnection:
         if message_type == MSG_CHOKE:
             self.peer_choking = True
             print(f"Peer {self.ip}:{self.port} choked us")
+            # A choking peer discards our outstanding requests
+            self.clear_requests()
+            if self.on_choke:
+                self.on_choke()
             
         elif message_type == MSG_UNCHOKE:
             self.peer_choking = False
             print(f"Peer {self.ip}:{self.port} unchoked us")
+            if self.on_unchoke:
+                self.on_unchoke()
             
         elif message_type == MSG_INTERESTED:
             self.peer_interested = True
@@ -207,27 +417,79 @@ class PeerConnection:
         elif message_type == MSG_CANCEL:
             # Handle cancel message if needed
             pass
+            
+        elif message_type == MSG_EXTENDED:
+            if len(payload) >= 1 and payload[0] == EXTENDED_HANDSHAKE_ID:
+                self._handle_extended_handshake(payload[1:])
+
+    # Send our BEP 10 extended handshake if the peer supports it
+    def _send_extended_handshake(self):
+        if not self.supports_extensions:
+            return
+        
+        handshake = {'m': {}, 'v': 'PC0001'}
+        self._send_message(MSG_EXTENDED, bytes([EXTENDED_HANDSHAKE_ID]) + bencode(handshake))
+
+    # Handle BEP 10 extended handshake (only reqq is used)
+    def _handle_extended_handshake(self, data: bytes):
+        try:
+            handshake = bdecode(data)
+        except BencodeError as e:
+            print(f"Invalid extended handshake from peer {self.ip}:{self.port}: {e}")
+            return
+        
+        if not isinstance(handshake, dict):
+            return
+        
+        reqq = handshake.get(b'reqq')
+        if isinstance(reqq, int) and reqq > 0:
+            self.peer_max_requests = reqq
+            self.max_requests = min(self.max_requests, reqq)
 
     # Handle HAVE message
     def _handle_have(self, piece_index: int):
-        if piece_index < len(self.peer_pieces):
-            self.peer_pieces[piece_index] = True
-            if self.on_have_received:
-                self.on_have_received(piece_index)
+        if self.peer_pieces.set(piece_index) and self.on_have_received:
+            self.on_have_received(piece_index)
 
     # Handle BITFIELD message
-    def _handle_bitfield(self, bitfield_data: bytes):
-        self.peer_pieces = BitArray(bytes=bitfield_data)
-        print(f"Received bitfield from peer {self.ip}:{self.port}: {self.peer_pieces.count(True)} pieces")
+    def _handle_bitfield(self, bitfield_data: memoryview):
+        if self.bitfield_received:
+            # Only the first message may be a bitfield; availability is already counted
+            return
+        self.bitfield_received = True
+        
+        # Pieces announced by earlier HAVEs are already counted; pass on only the new ones
+        added = self.peer_pieces.update(Bitfield.from_bytes(bitfield_data, len(self.peer_pieces)))
+        print(f"Received bitfield from peer {self.ip}:{self.port}: {self.peer_pieces.count} pieces")
+        if self.on_bitfield_received:
+            self.on_bitfield_received(added)
+
+    # Ask for a buffer to receive a block straight into
+    def _claim_block_buffer(self, piece_index: int, begin: int, length: int) -> Optional[memoryview]:
+        if not self.claim_block_buffer:
+            return None
+        return self.claim_block_buffer(piece_index, begin, length)
+
+    # Return a claimed block buffer that will not be filled
+    def _release_block_buffer(self, piece_index: int, begin: int):
+        if self.release_block_buffer:
+            self.release_block_buffer(piece_index, begin)
 
     # Handle PIECE message
-    def _handle_piece(self, piece_index: int, begin: int, block_data: bytes):
+    def _handle_piece(self, piece_index: int, begin: int, block_data: memoryview):
         # Remove from pending requests
-        if piece_index in self.pending_requests:
-            request_key = (begin, len(block_data))
-            self.pending_requests[piece_index].discard(request_key)
-            if not self.pending_requests[piece_index]:
-                del self.pending_requests[piece_index]
+        sent_time = None
+        with self.request_lock:
+            if piece_index in self.pending_requests:
+                request_key = (begin, len(block_data))
+                sent_time = self.pending_requests[piece_index].pop(request_key, None)
+                if not self.pending_requests[piece_index]:
+                    del self.pending_requests[piece_index]
+                if sent_time is not None:
+                    self.outstanding_requests -= 1
+                    self.outstanding_bytes -= len(block_data)
+        
+        self._update_pipeline(len(block_data), sent_time)
         
         # Call callback with received piece data
         if self.on_piece_received:
@@ -252,25 +514,102 @@ class PeerConnection:
             return False
         
         # Check if we already have too many pending requests
-        total_pending = sum(len(requests) for requests in self.pending_requests.values())
-        if total_pending >= self.max_requests:
+        if self.available_request_slots() <= 0:
             return False
         
         # Check if peer has this piece
-        if piece_index >= len(self.peer_pieces) or not self.peer_pieces[piece_index]:
+        if not self.peer_pieces.has(piece_index):
             return False
         
+        # Track pending request
+        with self.request_lock:
+            if piece_index not in self.pending_requests:
+                self.pending_requests[piece_index] = {}
+            self.pending_requests[piece_index][(begin, length)] = time.time()
+            self.outstanding_requests += 1
+            self.outstanding_bytes += length
+            if self._rate_window_start is None:
+                self._rate_window_start = time.time()
+        
         # Send request message
         payload = int_to_bytes(piece_index, 4) + int_to_bytes(begin, 4) + int_to_bytes(length, 4)
         self._send_message(MSG_REQUEST, payload)
         
-        # Track pending request
-        if piece_index not in self.pending_requests:
-            self.pending_requests[piece_index] = set()
-        self.pending_requests[piece_index].add((begin, length))
-        
         return True
 
+    # Cancel an outstanding request (endgame duplicates that another peer delivered)
+    def send_cancel(self, piece_index: int, begin: int, length: int):
+        with self.request_lock:
+            requests = self.pending_requests.get(piece_index)
+            if not requests or requests.pop((begin, length), None) is None:
+                return
+            if not requests:
+                del self.pending_requests[piece_index]
+            self.outstanding_requests -= 1
+            self.outstanding_bytes -= length
+        
+        payload = int_to_bytes(piece_index, 4) + int_to_bytes(begin, 4) + int_to_bytes(length, 4)
+        self._send_message(MSG_CANCEL, payload)
+
+    # Number of additional requests that can be sent right now
+    def available_request_slots(self) -> int:
+        return self.max_requests - self.outstanding_requests
+
+    # Update latency and delivery rate estimates and resize the request pipeline
+    def _update_pipeline(self, length: int, sent_time: Optional[float]):
+        now = time.time()
+        
+        if sent_time is not None:
+            latency = now - sent_time
+            if self.block_latency is None:
+                self.block_latency = latency
+            else:
+                self.block_latency += (latency - self.block_latency) / 8
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+        
+        # Sample the delivery rate over windows in which requests were outstanding
+        if self._rate_window_start is None:
+            return
+        self._rate_bytes += length
+        elapsed = now - self._rate_window_start
+        if elapsed < RATE_SAMPLE_INTERVAL:
+            return
+        
+        sample = self._rate_bytes / elapsed
+        if self.download_rate == 0.0:
+            self.download_rate = sample
+        else:
+            self.download_rate += (sample - self.download_rate) * 0.3
+        self._rate_bytes = 0
+        self._rate_window_start = now if self.outstanding_requests else None
+        
+        # Keep enough requests queued to cover the bandwidth-delay product. The
+        # round trip is the shortest latency seen: block_latency includes the time
+        # blocks wait behind our own queue, so sizing from it would keep growing it.
+        queue_time = max(REQUEST_QUEUE_TIME, 2 * (self.min_latency or 0.0))
+        depth = math.ceil(self.download_rate * queue_time / BLOCK_REQUEST_SIZE)
+        limit = self.peer_max_requests or MAX_PIPELINE_DEPTH
+        self.max_requests = max(MIN_PIPELINE_DEPTH, min(depth, limit, MAX_PIPELINE_DEPTH))
+
+    # Forget every outstanding request (after a choke or disconnect)
+    def clear_requests(self):
+        with self.request_lock:
+            self.pending_requests.clear()
+            self.outstanding_requests = 0
+            self.outstanding_bytes = 0
+            self._rate_window_start = None
+            self._rate_bytes = 0
+
+    # Run the on_disconnect callback exactly once
+    def _notify_disconnect(self):
+        if self._disconnect_notified:
+            return
+        self._disconnect_notified = True
+        self.clear_requests()
+        if self.on_disconnect:
+            self.on_disconnect()
+
     # Send a message to the peer
     def _send_message(self, message_type: int, payload: bytes):
         if not self.connected:
@@ -279,15 +618,22 @@ class PeerConnection:
         try:
             message_length = 1 + len(payload)
             message = int_to_bytes(message_length, 4) + bytes([message_type]) + payload
-            self.socket.send(message)
+            self._write(message)
         except Exception as e:
             print(f"Failed to send message to peer {self.ip}:{self.port}: {e}")
             self.disconnect()
 
+    # Write raw bytes to the peer socket
+    def _write(self, data: bytes):
+        self.socket.sendall(data)
+
     # Check if peer has a specific piece
     def has_piece(self, piece_index: int) -> bool:
-        return (piece_index < len(self.peer_pieces) and
-                self.peer_pieces[piece_index])
+        return self.peer_pieces.has(piece_index)
+
+    # Check if the connection has ended, or failed before it came up
+    def is_closed(self) -> bool:
+        return self._disconnect_notified
 
     # Check if we can make requests to this peer
     def can_request(self) -> bool:
@@ -307,4 +653,5 @@ class PeerConnection:
             self.socket = None
         
         print(f"Disconnected from peer {self.ip}:{self.port}")
+        self._notify_disconnect()
 
@@ -0,0 +1,185 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Optional
+from peer import PeerConnection, MessageReader
+
+# asyncio protocol that frames the peer wire protocol for one AsyncPeerConnection
+class PeerProtocol(asyncio.BufferedProtocol):
+
+    def __init__(self, peer: 'AsyncPeerConnection'):
+        self.peer = peer
+        self.reader = peer.reader = MessageReader(peer, expect_handshake=True)
+
+    # Called by the event loop once the TCP connection is established
+    def connection_made(self, transport: asyncio.Transport):
+        self.peer._transport = transport
+        self.peer.connected = True
+        transport.write(self.peer._build_handshake())
+
+    # Buffer for the event loop to recv_into
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.reader.get_buffer()
+
+    # Parse whatever landed in the last buffer
+    def buffer_updated(self, nbytes: int):
+        self.reader.buffer_updated(nbytes)
+
+    # Called by the event loop when the connection closes
+    def connection_lost(self, exc: Optional[Exception]):
+        self.reader.close()
+        self.peer._on_connection_lost()
+
+# Peer connection whose socket I/O runs on a shared PeerEngine event loop
+class AsyncPeerConnection(PeerConnection):
+
+    def __init__(self, ip: str, port: int, info_hash: bytes, peer_id: bytes, engine: 'PeerEngine',
+                 num_pieces: int):
+        super().__init__(ip, port, info_hash, peer_id, num_pieces)
+        self.engine = engine
+        self.connect_timeout = 10
+        self._transport = None
+        self._handshake_future = None
+
+        # Outgoing messages queued from other threads, flushed on the loop
+        self._outbox = []
+        self._flush_scheduled = False
+        self._outbox_lock = threading.Lock()
+
+    # Blocking connect for callers that are not on the event loop
+    def connect(self) -> bool:
+        return self.engine.connect(self).result()
+
+    # Connect and handshake on the event loop
+    async def connect_async(self) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            print(f"Connecting to peer {self.ip}:{self.port}")
+
+            self._handshake_future = loop.create_future()
+            await asyncio.wait_for(
+                loop.create_connection(lambda: PeerProtocol(self), self.ip, self.port),
+                self.connect_timeout)
+
+            # Wait for the handshake response parsed by the protocol
+            if not await asyncio.wait_for(self._handshake_future, self.connect_timeout):
+                self.disconnect()
+                return False
+
+            self.handshake_completed = True
+            self.running = True
+            self._send_extended_handshake()
+            print(f"Successfully connected to peer {self.ip}:{self.port}")
+            return True
+
+        except Exception as e:
+            print(f"Failed to connect to peer {self.ip}:{self.port}: {e!r}")
+            self.disconnect()
+            return False
+
+    # Handle the 68-byte handshake response
+    def _on_handshake(self, response: bytes):
+        verified = self._verify_handshake(response)
+        if self._handshake_future and not self._handshake_future.done():
+            self._handshake_future.set_result(verified)
+        if not verified:
+            self.disconnect()
+
+    # Handle the transport closing underneath us
+    def _on_connection_lost(self):
+        was_connected = self.connected
+        self.running = False
+        self.connected = False
+        self._transport = None
+
+        if self._handshake_future and not self._handshake_future.done():
+            self._handshake_future.set_result(False)
+        if was_connected:
+            print(f"Disconnected from peer {self.ip}:{self.port}")
+        self._notify_disconnect()
+
+    # Write raw bytes to the transport, batching writes made from other threads
+    def _write(self, data: bytes):
+        if self.engine.in_loop_thread():
+            if self._transport:
+                self._transport.write(data)
+            return
+
+        with self._outbox_lock:
+            self._outbox.append(data)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.engine.call_soon(self._flush_outbox)
+
+    # Send everything queued by _write from other threads
+    def _flush_outbox(self):
+        with self._outbox_lock:
+            pending = self._outbox
+            self._outbox = []
+            self._flush_scheduled = False
+
+        if self._transport and pending:
+            self._transport.writelines(pending)
+
+    # Disconnect from the peer
+    def disconnect(self):
+        self.running = False
+        self.connected = False
+
+        transport = self._transport
+        self._transport = None
+        if transport:
+            self.engine.call_soon(transport.close)
+            print(f"Disconnected from peer {self.ip}:{self.port}")
+        self._notify_disconnect()
+
+# Runs a single asyncio event loop that drives every peer connection
+class PeerEngine:
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+
+    # Start the event loop in a background thread
+    def start(self):
+        if self.loop:
+            return
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, name="peer-engine")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Event loop thread body
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Start connecting a peer; the future resolves to True once the handshake completes
+    def connect(self, peer: AsyncPeerConnection) -> Future:
+        return asyncio.run_coroutine_threadsafe(peer.connect_async(), self.loop)
+
+    # Check whether the caller is running on the event loop thread
+    def in_loop_thread(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    # Schedule a callback on the event loop from any thread
+    def call_soon(self, callback, *args):
+        if not self.loop or self.loop.is_closed():
+            return
+        if self.in_loop_thread():
+            self.loop.call_soon(callback, *args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    # Stop the event loop and wait for its thread to exit
+    def stop(self):
+        if not self.loop:
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread and not self.in_loop_thread():
+            self.thread.join(timeout=5)
+        self.loop = None
+        self.thread = None
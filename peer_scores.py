@@ -0,0 +1,49 @@
+from typing import Iterable, List
+
+# Peers that alone sent this many pieces failing their hash check are banned
+# for the rest of the session
+BAN_FAILURES = 2
+
+
+# Corruption scores of peers that sent blocks of pieces failing their hash check,
+# by (ip, port) so a peer that reconnects keeps its score. Only a failed piece a
+# peer sent on its own counts towards a ban. A piece shared between peers could
+# have been spoiled by any of them, so it only makes its senders suspects: a
+# suspect downloads whole pieces on its own, so the next failure it is part of
+# can be blamed on it alone.
+class CorruptionScores:
+
+    def __init__(self):
+        self.scores = {}       # (ip, port) -> failed pieces sent alone
+        self.suspects = set()  # Addresses that sent blocks of a failed piece
+        self.banned = set()    # Addresses not to connect to again
+
+    def __len__(self) -> int:
+        return len(self.suspects)
+
+    # Blame the peers that sent blocks of a failed piece; returns the peers newly banned
+    def record_failure(self, senders: Iterable) -> List:
+        by_address = {(peer.ip, peer.port): peer for peer in senders}
+        if len(by_address) != 1:
+            # A suspect or banned sender already explains the failure, so the
+            # others are not blamed; otherwise every sender becomes a suspect
+            if not any(address in self.suspects for address in by_address):
+                self.suspects.update(by_address)
+            return []
+
+        (address, peer), = by_address.items()
+        self.suspects.add(address)
+        score = self.scores.get(address, 0) + 1
+        self.scores[address] = score
+        if score >= BAN_FAILURES and address not in self.banned:
+            self.banned.add(address)
+            return [peer]
+        return []
+
+    # Whether a peer has sent blocks of a failed piece before
+    def is_suspect(self, peer) -> bool:
+        return (peer.ip, peer.port) in self.suspects
+
+    # Whether connections to a peer address are refused
+    def is_banned(self, ip: str, port: int) -> bool:
+        return (ip, port) in self.banned
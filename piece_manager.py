@@ -1,195 +1,779 @@
-import threading
-from typing import Dict, List, Set, Optional, Callable
-from utils import sha1_hash
+import hashlib
+from typing import Dict, Iterable, List, Set, Optional, Callable
+from bitfield import Bitfield
+from buffer_pool import BufferPool
+from counters import ShardedCounter
+from hash_pool import HashPool
+from peer_scores import CorruptionScores
+from piece_picker import PiecePicker
+from request_tracker import RequestTracker
+from swarm_matrix import SwarmMatrixPicker, np
+from timed_lock import TimedLock, combined_stats
 
 # Standard block size for BitTorrent (16KB)
 BLOCK_SIZE = 16384
 
-# Represents a block within a piece
-class Block:
-    def __init__(self, piece_index: int, offset: int, length: int):
-        self.piece_index = piece_index
-        self.offset = offset
-        self.length = length
-        self.data = None
-        self.requested = False
-        self.received = False
+# Endgame: once every missing block is requested, ask this many peers for each
+ENDGAME_MAX_REQUESTERS = 3
+
+# Default memory budget for buffers of pieces being downloaded, hashed or written
+DEFAULT_BUFFER_BUDGET = 256 * 1024 * 1024
+
+# Torrents with at least this many pieces use the NumPy picker when NumPy is installed
+MATRIX_PICKER_MIN_PIECES = 1024
 
-# Represents a piece with its blocks
+# Piece state is guarded by striped locks: piece i by piece_locks[i % PIECE_LOCK_STRIPES]
+PIECE_LOCK_STRIPES = 64
+
+# Runs of in-order blocks up to this size are hashed on the receiving thread;
+# longer runs (left behind by out-of-order blocks) go to the hash pool
+INLINE_HASH_BYTES = 4 * BLOCK_SIZE
+
+# Block state flags, one byte per block in Piece.block_state
+BLOCK_REQUESTED = 1
+BLOCK_RECEIVED = 2
+BLOCK_LANDING = 4  # A peer is receiving this block straight into the piece buffer
+
+# Represents a piece; blocks are numbered offset // BLOCK_SIZE and their state
+# lives in a bytearray that only exists while the piece is being downloaded
 class Piece:
-    def __init__(self, index: int, length: int, hash_value: bytes):
+    __slots__ = ('index', 'length', 'num_blocks', 'block_state',
+                 'blocks_received', 'next_free_block', 'completed', 'verified', 'data',
+                 'hasher', 'hashed_bytes', 'hashing', 'senders', 'owner')
+
+    def __init__(self, index: int, length: int):
         self.index = index
         self.length = length
-        self.hash_value = hash_value
-        self.blocks = []
+        self.num_blocks = (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.block_state = None   # bytearray of BLOCK_* flags once the piece is started
+        self.blocks_received = 0
+        self.next_free_block = 0  # No block before this index is free to request
         self.completed = False
         self.verified = False
-        self.data = bytearray(length)
-        
-        # Create blocks for this piece
-        self._create_blocks()
-
-    # Create blocks for this piece
-    def _create_blocks(self):
-        offset = 0
-        while offset < self.length:
-            block_length = min(BLOCK_SIZE, self.length - offset)
-            block = Block(self.index, offset, block_length)
-            self.blocks.append(block)
-            offset += block_length
-
-    # Add block data to the piece
-    def add_block_data(self, offset: int, data: bytes) -> bool:
-        if offset + len(data) > self.length:
-            return False
+        self.data = None  # Buffer from the piece manager's pool while the piece is in flight
+        
+        # Running SHA1 over the in-order prefix of received blocks
+        self.hasher = None
+        self.hashed_bytes = 0
+        self.hashing = False  # A thread is feeding the hasher
         
-        # Find the corresponding block
-        for block in self.blocks:
-            if block.offset == offset and block.length == len(data):
-                if not block.received:
-                    block.data = data
-                    block.received = True
-                    
-                    # Copy data to piece buffer
-                    self.data[offset:offset + len(data)] = data
-                    
-                    # Check if piece is complete
-                    if self.is_complete():
-                        self.completed = True
-                        self.verified = self.verify()
-                    
-                    return True
-        
-        return False
+        # Peer that sent each received block, blamed if the piece fails its hash check
+        self.senders = None
+        self.owner = None  # Suspect peer downloading the whole piece alone
 
-    # Check if all blocks have been received
-    def is_complete(self) -> bool:
-        return all(block.received for block in self.blocks)
+    # Length of a block (the last block of the last piece may be short)
+    def block_length(self, block: int) -> int:
+        return min(BLOCK_SIZE, self.length - block * BLOCK_SIZE)
+
+    # Block number for an offset, or None if it is not the start of a block of this length
+    def block_at(self, offset: int, length: int) -> Optional[int]:
+        block = offset // BLOCK_SIZE
+        if offset % BLOCK_SIZE or block >= self.num_blocks or self.block_length(block) != length:
+            return None
+        return block
+
+    # Give the piece a buffer and fresh block state
+    def start(self, data: bytearray):
+        self.data = data
+        self.block_state = bytearray(self.num_blocks)
+        self.senders = [None] * self.num_blocks
+        self.blocks_received = 0
+        self.next_free_block = 0
+        self.hasher = hashlib.sha1()
+        self.hashed_bytes = 0
+        self.hashing = False
 
-    # Verify piece integrity using SHA1 hash
-    def verify(self) -> bool:
-        if not self.completed:
+    # Forget the buffer and block state; the piece can be started again
+    def reset(self):
+        self.data = None
+        self.block_state = None
+        self.blocks_received = 0
+        self.next_free_block = 0
+        self.completed = False
+        self.verified = False
+        self.hasher = None
+        self.hashed_bytes = 0
+        self.hashing = False
+        self.senders = None
+        self.owner = None
+
+    # Add block data to the piece, remembering which peer sent it
+    def add_block_data(self, offset: int, data: memoryview, sender=None) -> bool:
+        if self.block_state is None:
+            return False
+        
+        block = self.block_at(offset, len(data))
+        if block is None:
+            return False
+        
+        state = self.block_state[block]
+        in_place = isinstance(data, memoryview) and data.obj is self.data
+        if state & BLOCK_LANDING and not in_place:
+            # Another peer is receiving this block into the buffer; let it finish
+            return False
+        if state & BLOCK_RECEIVED:
             return False
         
-        calculated_hash = sha1_hash(bytes(self.data))
-        return calculated_hash == self.hash_value
+        self.block_state[block] = (state & ~BLOCK_LANDING) | BLOCK_RECEIVED
+        self.senders[block] = sender
+        self.blocks_received += 1
+        
+        # Copy data to piece buffer unless it was received in place
+        if not in_place:
+            self.data[offset:offset + len(data)] = data
+        
+        # Check if piece is complete; the piece manager verifies it
+        if self.is_complete():
+            self.completed = True
+        
+        return True
+
+    # Mark a block as being received in place; False if it cannot be
+    def claim_landing(self, offset: int, length: int) -> bool:
+        block = self.block_at(offset, length)
+        if block is None or self.block_state[block] & (BLOCK_RECEIVED | BLOCK_LANDING):
+            return False
+        self.block_state[block] |= BLOCK_LANDING
+        return True
 
-    # Get list of blocks that haven't been received yet
-    def get_missing_blocks(self) -> List[Block]:
-        return [block for block in self.blocks if not block.received and not block.requested]
+    # A block that was being received in place never arrived
+    def release_landing(self, offset: int):
+        block = offset // BLOCK_SIZE
+        if self.block_state is not None and block < self.num_blocks:
+            self.block_state[block] &= ~BLOCK_LANDING
+            self.next_free_block = min(self.next_free_block, block)
 
-    # Get list of blocks that have been requested but not received
-    def get_requested_blocks(self) -> List[Block]:
-        return [block for block in self.blocks if block.requested and not block.received]
+    # First block at or after the cursor that is not requested, received or landing
+    # (a landing block whose request expired is still arriving from its peer)
+    def _next_free(self, state: bytearray) -> int:
+        cursor = self.next_free_block
+        taken = BLOCK_REQUESTED | BLOCK_RECEIVED | BLOCK_LANDING
+        while cursor < self.num_blocks and state[cursor] & taken:
+            cursor += 1
+        return cursor
+
+    # Check if a block is free to request. Only reads, so it can be called without
+    # the piece's lock as a hint; take_free_blocks decides under the lock.
+    def has_free_blocks(self) -> bool:
+        if self.completed:
+            return False
+        state = self.block_state
+        if state is None:
+            return True  # Not started: every block is free
+        return self._next_free(state) < self.num_blocks
+
+    # Mark up to count free blocks as requested and return their numbers
+    def take_free_blocks(self, count: int) -> List[int]:
+        taken = []
+        if self.completed or self.block_state is None:
+            return taken
+        state = self.block_state
+        while len(taken) < count:
+            block = self._next_free(state)
+            if block >= self.num_blocks:
+                self.next_free_block = block
+                break
+            state[block] |= BLOCK_REQUESTED
+            self.next_free_block = block + 1
+            taken.append(block)
+        return taken
+
+    # Make a block requestable again, moving the cursor back if needed
+    def release_block(self, block: int):
+        state = self.block_state
+        if state is not None and not state[block] & BLOCK_RECEIVED:
+            state[block] &= ~BLOCK_REQUESTED
+            self.next_free_block = min(self.next_free_block, block)
+
+    # Claim the received blocks following the hashed prefix for hashing: returns the
+    # (start, end) byte range, or None if there are none or another thread is hashing
+    def claim_hash_run(self) -> Optional[tuple]:
+        if self.hashing or self.hasher is None:
+            return None
+        block = self.hashed_bytes // BLOCK_SIZE
+        while block < self.num_blocks and self.block_state[block] & BLOCK_RECEIVED:
+            block += 1
+        end = min(block * BLOCK_SIZE, self.length)
+        if end == self.hashed_bytes:
+            return None
+        self.hashing = True
+        return (self.hashed_bytes, end)
+
+    # Record that a claimed run has been hashed and claim the next one
+    def finish_hash_run(self, end: int) -> Optional[tuple]:
+        self.hashed_bytes = end
+        self.hashing = False
+        return self.claim_hash_run()
+
+    # Check if every byte has been fed to the running hash
+    def is_hashed(self) -> bool:
+        return self.hashed_bytes == self.length
+
+    # Check if all blocks have been received
+    def is_complete(self) -> bool:
+        return self.blocks_received == self.num_blocks
+
+    # Get the numbers of blocks that are neither requested nor received
+    def get_missing_blocks(self) -> List[int]:
+        if self.block_state is None:
+            return [] if self.completed else list(range(self.num_blocks))
+        return [block for block, state in enumerate(self.block_state)
+                if not state & (BLOCK_REQUESTED | BLOCK_RECEIVED)]
+
+    # Get the numbers of blocks that have been requested but not received
+    def get_requested_blocks(self) -> List[int]:
+        if self.block_state is None:
+            return []
+        return [block for block, state in enumerate(self.block_state)
+                if state & BLOCK_REQUESTED and not state & BLOCK_RECEIVED]
 
     # Reset all block request flags (for timeout handling)
     def reset_block_requests(self):
-        for block in self.blocks:
-            if not block.received:
-                block.requested = False
+        if self.block_state is not None:
+            for block, state in enumerate(self.block_state):
+                if not state & BLOCK_RECEIVED:
+                    self.block_state[block] = state & ~BLOCK_REQUESTED
+        self.next_free_block = 0
 
 # Manages piece downloading and verification
 class PieceManager:
-    def __init__(self, torrent_file):
+    def __init__(self, torrent_file, request_timeout: float = 30.0,
+                 hash_pool: Optional[HashPool] = None,
+                 buffer_budget: int = DEFAULT_BUFFER_BUDGET,
+                 matrix_picker: Optional[bool] = None):
         self.torrent = torrent_file
-        self.pieces = {}
+        self.pieces = []  # Piece objects indexed by piece number
         self.completed_pieces = set()
-        self.lock = threading.Lock()
+        self.have_pieces = Bitfield(self.torrent.get_total_pieces())  # completed_pieces as a bitfield
+        self.picker = self._create_picker(matrix_picker)
+        
+        # Locks, always taken in this order when nested: picker_lock (picker, buffer
+        # pool, completed pieces), one piece lock (that piece's blocks and hash state),
+        # request_lock (outstanding requests). Blocks arriving for different pieces
+        # only meet briefly on request_lock, and progress counters take no lock.
+        self.picker_lock = TimedLock()
+        self.piece_locks = [TimedLock() for _ in range(PIECE_LOCK_STRIPES)]
+        self.request_lock = TimedLock()
+        
+        # Outstanding requests by block and by peer, with send times and a timeout wheel
+        self.requests = RequestTracker(request_timeout)
+        self.blocks_remaining = ShardedCounter()  # Blocks not yet received in unverified pieces
+        self.endgame = False
+        
+        # Progress counters, updated where the bytes are received, verified or thrown away
+        self.verified_bytes = ShardedCounter()    # Bytes of pieces that passed their hash check
+        self.unverified_bytes = ShardedCounter()  # Bytes received for pieces not yet checked
+        self.duplicate_bytes = ShardedCounter()   # Bytes received for blocks we already had
+        self.hash_failed_bytes = ShardedCounter() # Bytes of pieces that failed their hash check
+        
+        # Pieces are hashed outside the lock as their blocks arrive in order, with long
+        # runs on the hash pool. A process pool cannot share running hashes, so there
+        # pieces are hashed whole once complete.
+        self.hash_pool = hash_pool
+        self.incremental_hashing = hash_pool is None or not hash_pool.use_processes
+        
+        # Piece buffers are taken when a piece is started and returned once it is written
+        self.buffers = BufferPool(buffer_budget)
+        
+        # Peers blamed for pieces that failed their hash check, and the pieces each
+        # suspect is downloading alone (both guarded by picker_lock)
+        self.scores = CorruptionScores()
+        self.owned_pieces = {}  # suspect peer -> set of piece indices
         
         # Callbacks
-        self.on_piece_completed = None  # Callback when piece is completed and verified
+        self.on_piece_completed = None  # Callback(piece_index, data) for a verified piece; call piece_written() once it is on disk, or piece_write_failed()
+        self.on_cancel_request = None   # Callback(peer, piece_index, offset, length) to cancel a duplicate request
+        self.on_piece_hashed = None     # Callback(piece_index, verified) once a piece has been checked
+        self.on_peer_banned = None      # Callback(peer) for a peer banned for sending corrupt data
         
         # Initialize pieces
         self._initialize_pieces()
 
+    # Rarest-first picker: the NumPy matrix for large torrents (or when asked for),
+    # the pure-Python buckets otherwise or when NumPy is not installed
+    def _create_picker(self, matrix_picker: Optional[bool]):
+        num_pieces = self.torrent.get_total_pieces()
+        if matrix_picker is None:
+            matrix_picker = num_pieces >= MATRIX_PICKER_MIN_PIECES and np is not None
+        elif matrix_picker and np is None:
+            print("NumPy is not installed; using the pure-Python piece picker")
+            matrix_picker = False
+        if matrix_picker:
+            return SwarmMatrixPicker(num_pieces)
+        return PiecePicker(num_pieces)
+
     # Initialize all pieces
     def _initialize_pieces(self):
         print(f"Initializing {self.torrent.get_total_pieces()} pieces")
         
         for i in range(self.torrent.get_total_pieces()):
-            piece_length = self.torrent.get_piece_length(i)
-            piece_hash = self.torrent.get_piece_hash(i)
-            
-            piece = Piece(i, piece_length, piece_hash)
-            self.pieces[i] = piece
+            # Hashes stay in the torrent's hash buffer and are looked up when a piece is checked
+            piece = Piece(i, self.torrent.get_piece_length(i))
+            self.pieces.append(piece)
+        self.blocks_remaining.add(sum(piece.num_blocks for piece in self.pieces))
 
-    # Add piece data and check for completion
-    def add_piece_data(self, piece_index: int, offset: int, data: bytes) -> bool:
-        with self.lock:
-            if piece_index not in self.pieces:
-                return False
-            
-            piece = self.pieces[piece_index]
+    # Lock guarding a piece's block and hash state
+    def _piece_lock(self, piece_index: int) -> TimedLock:
+        return self.piece_locks[piece_index % PIECE_LOCK_STRIPES]
+
+    # Look up a piece by index, None if out of range
+    def _get_piece(self, piece_index: int) -> Optional[Piece]:
+        if 0 <= piece_index < len(self.pieces):
+            return self.pieces[piece_index]
+        return None
+
+    # Hand out the piece buffer region for a block so a peer can receive into it directly
+    def claim_block_buffer(self, piece_index: int, offset: int, length: int) -> Optional[memoryview]:
+        piece = self._get_piece(piece_index)
+        if piece is None:
+            return None
+        
+        # A block another peer may also deliver is received into scratch space, so the
+        # first complete copy always wins: nothing lands in place during endgame or
+        # while a block has several requesters. Endgame in turn never duplicates a
+        # landing block; both checks are made under the piece's lock.
+        if self.endgame:
+            return None
+        
+        with self._piece_lock(piece_index):
+            if piece.completed or piece.data is None:
+                return None
+            with self.request_lock:
+                if len(self.requests.requesters(piece_index, offset)) > 1:
+                    return None
+            if not piece.claim_landing(offset, length):
+                return None
+            return memoryview(piece.data)[offset:offset + length]
+
+    # Give back a claimed block buffer that was never filled
+    def release_block_buffer(self, piece_index: int, offset: int):
+        piece = self._get_piece(piece_index)
+        if piece is not None:
+            with self._piece_lock(piece_index):
+                piece.release_landing(offset)
+
+    # Add piece data from peer and check for completion
+    def add_piece_data(self, piece_index: int, offset: int, data: memoryview, peer=None) -> bool:
+        piece = self._get_piece(piece_index)
+        if piece is None:
+            return False
+        
+        with self._piece_lock(piece_index):
             if piece.completed:
+                self.duplicate_bytes.add(len(data))
                 return True  # Already completed
             
             # Add block data to piece
-            success = piece.add_block_data(offset, data)
-            
-            if success and piece.completed:
-                if piece.verified:
-                    print(f"Piece {piece_index} completed and verified!")
-                    self.completed_pieces.add(piece_index)
-                    
-                    # Call completion callback
-                    if self.on_piece_completed:
-                        self.on_piece_completed(piece_index, bytes(piece.data))
-                else:
-                    print(f"Piece {piece_index} completed but failed verification!")
-                    # Reset piece for re-download
-                    piece.completed = False
-                    piece.verified = False
-                    piece.data = bytearray(piece.length)
-                    for block in piece.blocks:
-                        block.data = None
-                        block.received = False
-                        block.requested = False
-            
-            return success
-
-    # Get next block request (piece_index, offset, length)
-    def get_next_request(self, available_pieces: Set[int]) -> Optional[tuple]:
-        with self.lock:
-            # Find pieces we need that are available from peers
-            needed_pieces = []
-            for piece_index in available_pieces:
-                if (piece_index in self.pieces and 
-                    piece_index not in self.completed_pieces):
-                    needed_pieces.append(piece_index)
-            
-            if not needed_pieces:
-                return None
+            success = piece.add_block_data(offset, data, peer)
+            if not success:
+                self.duplicate_bytes.add(len(data))
+                # The peer has answered, so its request no longer holds the block
+                block = piece.block_at(offset, len(data))
+                if peer is not None and block is not None:
+                    with self.request_lock:
+                        released = self.requests.remove(peer, piece_index, offset)
+                    if released:
+                        piece.release_block(block)
+                return False
             
-            # Prioritize pieces with fewer missing blocks (rarest first approximation)
-            needed_pieces.sort(key=lambda p: len(self.pieces[p].get_missing_blocks()))
+            self.blocks_remaining.add(-1)
+            self.unverified_bytes.add(len(data))
+            with self.request_lock:
+                requesters = self.requests.pop_block(piece_index, offset)
             
-            # Find next block to request
-            for piece_index in needed_pieces:
-                piece = self.pieces[piece_index]
-                missing_blocks = piece.get_missing_blocks()
+            # Received blocks are never written again, so they can be hashed unlocked
+            if self.incremental_hashing:
+                run = piece.claim_hash_run()
+                piece_data = None
+            else:
+                run = None
+                piece_data = memoryview(piece.data) if piece.completed else None
+        
+        # Cancel the copies of this block still requested from other peers
+        if self.on_cancel_request:
+            for other in requesters:
+                if other is not peer:
+                    self.on_cancel_request(other, piece_index, offset, len(data))
+        
+        # Hash without holding the lock so other peers keep delivering blocks
+        if run is not None:
+            self._feed_hash(piece, run)
+        elif piece_data is not None:
+            self.hash_pool.submit(piece_index, piece_data, self.torrent.get_piece_hash(piece_index),
+                                  self._on_piece_hashed)
+        
+        return success
+
+    # Feed runs of in-order blocks into the piece's running hash (lock not held);
+    # only the thread that claimed a run feeds the piece until no run is left
+    def _feed_hash(self, piece: Piece, run: tuple):
+        while run is not None:
+            start, end = run
+            data = memoryview(piece.data)[start:end]
+            if self.hash_pool and end - start > INLINE_HASH_BYTES:
+                # A gap just filled behind many out-of-order blocks; hash them on the pool
+                self.hash_pool.feed(piece.index, piece.hasher, data,
+                                    lambda: self._feed_hash(piece, self._end_hash_run(piece, end)))
+                return
+            piece.hasher.update(data)
+            run = self._end_hash_run(piece, end)
+
+    # Record a hashed run and claim the next; verifies the piece once all of it is hashed
+    def _end_hash_run(self, piece: Piece, end: int) -> Optional[tuple]:
+        with self._piece_lock(piece.index):
+            run = piece.finish_hash_run(end)
+            if run is not None or not piece.is_hashed():
+                return run
+            verified = piece.hasher.digest() == self.torrent.get_piece_hash(piece.index)
+        self._on_piece_hashed(piece.index, verified)
+        return None
+
+    # Finish a completed piece once its hash has been checked
+    def _on_piece_hashed(self, piece_index: int, verified: bool):
+        self._finish_piece(piece_index, verified)
+        if self.on_piece_hashed:
+            self.on_piece_hashed(piece_index, verified)
+
+    # Write out a verified piece or reset a corrupt one, returning its buffer to the pool
+    def _finish_piece(self, piece_index: int, verified: bool):
+        piece = self.pieces[piece_index]
+        if not verified:
+            print(f"Piece {piece_index} completed but failed verification!")
+            with self.picker_lock, self._piece_lock(piece_index):
+                # Blame the peers that sent its blocks
+                senders = {peer for peer in piece.senders if peer is not None}
+                banned = self.scores.record_failure(senders)
+                self._disown_piece(piece)
                 
-                if missing_blocks:
-                    block = missing_blocks[0]
-                    block.requested = True
-                    return (piece_index, block.offset, block.length)
+                # Reset piece for re-download; it takes a buffer again when restarted
+                self.buffers.release(piece.data)
+                piece.reset()
+                with self.request_lock:
+                    for block in range(piece.num_blocks):
+                        self.requests.pop_block(piece_index, block * BLOCK_SIZE)
+                self.blocks_remaining.add(piece.num_blocks)
+                self.unverified_bytes.add(-piece.length)
+                self.hash_failed_bytes.add(piece.length)
+                self.picker.clear_partial(piece_index)
             
-            return None
+            for peer in banned:
+                print(f"Banning peer {peer.ip}:{peer.port} for sending corrupt data")
+                if self.on_peer_banned:
+                    self.on_peer_banned(peer)
+            return
+        
+        with self._piece_lock(piece_index):
+            piece.verified = True
+        self.unverified_bytes.add(-piece.length)
+        self.verified_bytes.add(piece.length)
+        with self.picker_lock:
+            self.picker.mark_have(piece_index)
+        
+        # Hand the piece over for writing; it counts as completed once written
+        if self.on_piece_completed:
+            self.on_piece_completed(piece_index, memoryview(piece.data))
+        else:
+            self.piece_written(piece_index)
+
+    # A verified piece has been written: it is completed and its buffer goes back to the pool
+    def piece_written(self, piece_index: int):
+        piece = self.pieces[piece_index]
+        print(f"Piece {piece_index} completed and verified!")
+        with self.picker_lock, self._piece_lock(piece_index):
+            self.completed_pieces.add(piece_index)
+            self.have_pieces.set(piece_index)
+            self.buffers.release(piece.data)
+            self._disown_piece(piece)
+            piece.data = None
+            piece.block_state = None
+            piece.senders = None
+            piece.hasher = None
+
+    # A verified piece could not be written: reset it so it is downloaded again
+    def piece_write_failed(self, piece_index: int):
+        piece = self.pieces[piece_index]
+        print(f"Piece {piece_index} could not be written; downloading it again")
+        with self.picker_lock, self._piece_lock(piece_index):
+            self.buffers.release(piece.data)
+            self._disown_piece(piece)
+            piece.reset()
+            with self.request_lock:
+                for block in range(piece.num_blocks):
+                    self.requests.pop_block(piece_index, block * BLOCK_SIZE)
+            self.blocks_remaining.add(piece.num_blocks)
+            self.verified_bytes.add(-piece.length)
+            self.picker.mark_missing(piece_index)
+
+    # Restore state saved by a previous run: pieces already verified on disk, and
+    # partial maps piece_index to (received block numbers, piece data read from disk)
+    def restore(self, pieces: Iterable[int], partial: Dict[int, tuple]):
+        with self.picker_lock:
+            for piece_index in pieces:
+                piece = self._get_piece(piece_index)
+                if piece is None:
+                    continue
+                with self._piece_lock(piece_index):
+                    if piece.verified:
+                        continue
+                    piece.completed = True
+                    piece.verified = True
+                self.completed_pieces.add(piece_index)
+                self.have_pieces.set(piece_index)
+                self.picker.mark_have(piece_index)
+                self.blocks_remaining.add(-piece.num_blocks)
+                self.verified_bytes.add(piece.length)
+
+            for piece_index, (blocks, data) in partial.items():
+                piece = self._get_piece(piece_index)
+                if piece is None or not self.buffers.can_acquire(piece.length):
+                    continue
+                with self._piece_lock(piece_index):
+                    if piece.completed or piece.data is not None:
+                        continue
+                    piece.start(self.buffers.acquire(piece.length))
+                    piece.data[:] = data
+                    for block in blocks:
+                        if 0 <= block < piece.num_blocks and not piece.block_state[block]:
+                            piece.block_state[block] = BLOCK_RECEIVED
+                            piece.blocks_received += 1
+                            self.blocks_remaining.add(-1)
+                            self.unverified_bytes.add(piece.block_length(block))
+
+                    # Hash the in-order prefix now; the rest follows as blocks arrive
+                    run = piece.claim_hash_run() if self.incremental_hashing else None
+                    if run is not None:
+                        piece.hasher.update(memoryview(piece.data)[run[0]:run[1]])
+                        piece.finish_hash_run(run[1])
+                self.picker.mark_partial(piece_index)
+
+    # Get (piece_index, received block numbers, piece data) for pieces in progress
+    def get_partial_pieces(self) -> List[tuple]:
+        partial = []
+        for piece in self.pieces:
+            if piece.block_state is None:
+                continue
+            with self._piece_lock(piece.index):
+                if piece.completed or piece.block_state is None or not piece.blocks_received:
+                    continue
+                blocks = [block for block, state in enumerate(piece.block_state)
+                          if state & BLOCK_RECEIVED]
+                partial.append((piece.index, blocks, memoryview(piece.data)))
+        return partial
+
+    # Check if a peer's pieces include any we still need
+    def wants_pieces_from(self, peer_pieces: Bitfield) -> bool:
+        return peer_pieces.any_and_not(self.have_pieces)
+
+    # Count the pieces in a newly received peer bitfield; added holds those not yet counted.
+    # Ignored once the peer is closed, as its pieces may already have been removed.
+    def add_peer_pieces(self, peer, added: Bitfield):
+        with self.picker_lock:
+            if not peer.is_closed():
+                self.picker.add_peer(peer, added)
+
+    # Count a piece announced by a HAVE message (ignored once the peer is closed)
+    def add_peer_have(self, peer, piece_index: int):
+        with self.picker_lock:
+            if not peer.is_closed():
+                self.picker.peer_have(peer, piece_index)
+
+    # Pieces a suspect was downloading alone become open to every peer (picker_lock must be held)
+    def _disown_pieces(self, peer):
+        for piece_index in self.owned_pieces.pop(peer, ()):
+            piece = self.pieces[piece_index]
+            with self._piece_lock(piece_index):
+                if piece.owner is peer:
+                    piece.owner = None
+
+    # A piece is finished or reset and no longer held by its suspect (picker_lock
+    # and the piece's lock must be held)
+    def _disown_piece(self, piece: Piece):
+        if piece.owner is not None:
+            self.owned_pieces.get(piece.owner, set()).discard(piece.index)
+            piece.owner = None
+
+    # Forget the pieces of a disconnected peer
+    def remove_peer_pieces(self, peer):
+        with self.picker_lock:
+            self.picker.remove_peer(peer)
+
+    # Get next block request (piece_index, offset, length) for a peer
+    def get_next_request(self, peer) -> Optional[tuple]:
+        with self.picker_lock:
+            requests = self._pick_blocks(peer, 1)
+            return requests[0] if requests else None
+
+    # Get up to count block requests for a peer in one pass
+    def get_next_requests(self, peer, count: int) -> List[tuple]:
+        with self.picker_lock:
+            return self._pick_blocks(peer, count)
+
+    # Whether a piece still has blocks to request from peer; a hint read without the
+    # piece's lock. Suspects only start pieces nobody else has blocks of, and pieces
+    # a suspect is downloading are left to it.
+    def _is_pickable(self, piece_index: int, peer, suspect: bool) -> bool:
+        piece = self.pieces[piece_index]
+        if piece.owner is not None:
+            return piece.owner is peer and piece.has_free_blocks()
+        if suspect:
+            return piece.block_state is None and not piece.completed
+        return piece.has_free_blocks()
+
+    # Assign free blocks piece by piece, rarest pieces first (picker_lock must be held)
+    def _pick_blocks(self, peer, count: int) -> List[tuple]:
+        requests = []
+        suspect = bool(self.scores) and self.scores.is_suspect(peer)
+        is_pickable = lambda piece_index: self._is_pickable(piece_index, peer, suspect)
+        
+        while len(requests) < count:
+            # Rarest piece this peer has, finishing partial pieces first and
+            # starting new ones only while the buffer budget allows
+            new_pieces = self.buffers.can_acquire(self.torrent.piece_length)
+            piece_index = self.picker.pick(peer, is_pickable, new_pieces)
+            if (piece_index is None and suspect
+                    and (new_pieces or self.picker.pick(peer, is_pickable) is None)):
+                # Nothing left this suspect could download alone; share pieces rather
+                # than stall. Blame from these pieces is deliberately weak: a shared
+                # failure never counts towards a ban, and co-senders of a suspect
+                # are not blamed at all.
+                suspect = False
+                piece_index = self.picker.pick(peer, is_pickable, new_pieces)
+            if piece_index is None:
+                break
+            
+            piece = self.pieces[piece_index]
+            with self._piece_lock(piece_index):
+                if piece.data is None:
+                    piece.start(self.buffers.acquire(piece.length))
+                    if suspect:
+                        piece.owner = peer
+                        self.owned_pieces.setdefault(peer, set()).add(piece_index)
+                blocks = piece.take_free_blocks(count - len(requests))
+                with self.request_lock:
+                    for block in blocks:
+                        offset = block * BLOCK_SIZE
+                        requests.append((piece_index, offset, piece.block_length(block)))
+                        self.requests.add(peer, piece_index, offset)
+            self.picker.mark_partial(piece_index)
+        
+        # Suspects never share blocks, so they take no part in endgame
+        if len(requests) < count and not suspect and self._in_endgame():
+            requests.extend(self._pick_endgame_blocks(peer, count - len(requests)))
+        
+        return requests
+
+    # Endgame starts once every block we still need has been requested (picker_lock must be held)
+    def _in_endgame(self) -> bool:
+        blocks_remaining = self.blocks_remaining.value()
+        in_endgame = 0 < blocks_remaining <= len(self.requests)
+        if in_endgame and not self.endgame:
+            print(f"Entering endgame mode ({blocks_remaining} blocks left)")
+        self.endgame = in_endgame
+        return in_endgame
+
+    # Duplicate outstanding blocks onto another peer, least-requested first (picker_lock must be held)
+    def _pick_endgame_blocks(self, peer, count: int) -> List[tuple]:
+        with self.request_lock:
+            candidates = []
+            for (piece_index, offset), requesters in self.requests.blocks.items():
+                if (peer not in requesters and len(requesters) < ENDGAME_MAX_REQUESTERS
+                        and peer.has_piece(piece_index) and self.pieces[piece_index].owner is None):
+                    candidates.append((len(requesters), piece_index, offset))
+        candidates.sort()
+        
+        # Recheck each block under its piece's lock: a block already landing in place
+        # is left to the peer sending it, as a second copy could not be accepted
+        requests = []
+        for _, piece_index, offset in candidates:
+            if len(requests) == count:
+                break
+            piece = self.pieces[piece_index]
+            block = offset // BLOCK_SIZE
+            with self._piece_lock(piece_index):
+                state = piece.block_state
+                if state is None or state[block] & (BLOCK_LANDING | BLOCK_RECEIVED):
+                    continue
+                with self.request_lock:
+                    requesters = self.requests.requesters(piece_index, offset)
+                    if (not requesters or peer in requesters
+                            or len(requesters) >= ENDGAME_MAX_REQUESTERS):
+                        continue
+                    self.requests.add(peer, piece_index, offset)
+            requests.append((piece_index, offset, piece.block_length(block)))
+        return requests
 
     # Mark a block as requested
     def mark_block_requested(self, piece_index: int, offset: int):
-        with self.lock:
-            if piece_index in self.pieces:
-                piece = self.pieces[piece_index]
-                for block in piece.blocks:
-                    if block.offset == offset:
-                        block.requested = True
-                        break
+        piece = self._get_piece(piece_index)
+        if piece is not None:
+            with self._piece_lock(piece_index):
+                if piece.block_state is not None:
+                    piece.block_state[offset // BLOCK_SIZE] |= BLOCK_REQUESTED
+
+    # Drop peer's request for a block; the block becomes free once nobody has it requested
+    def reset_block_request(self, piece_index: int, offset: int, peer=None):
+        if self._get_piece(piece_index) is None:
+            return
+        with self.request_lock:
+            if peer is None:
+                self.requests.pop_block(piece_index, offset)
+            elif not self.requests.remove(peer, piece_index, offset):
+                return
+        self._release_block(piece_index, offset)
+
+    # Return every block requested from peer (choked or disconnected) to the picker,
+    # along with any pieces it was downloading alone
+    def release_peer_requests(self, peer) -> List[tuple]:
+        with self.request_lock:
+            blocks = self.requests.pop_peer(peer)
+        released = [self._release_block(piece_index, offset) for piece_index, offset in blocks]
+        if peer in self.owned_pieces:
+            with self.picker_lock:
+                self._disown_pieces(peer)
+        return released
+
+    # Expire stale requests: returns (peer, piece_index, offset, length) for each.
+    # A suspect that lets a request for its own piece time out has stopped
+    # answering, so the pieces it holds become open to every peer.
+    def expire_requests(self, now: Optional[float] = None) -> List[tuple]:
+        with self.request_lock:
+            timed_out = self.requests.expire(now)
+        expired = []
+        stalled = set()  # Suspects whose own pieces stopped arriving
+        for peer, piece_index, offset, released in timed_out:
+            if released:
+                self._release_block(piece_index, offset)
+            piece = self.pieces[piece_index]
+            if piece.owner is peer:
+                stalled.add(peer)
+            expired.append((peer, piece_index, offset, piece.block_length(offset // BLOCK_SIZE)))
+        if stalled:
+            with self.picker_lock:
+                for peer in stalled:
+                    self._disown_pieces(peer)
+        return expired
+
+    # Make a block requestable again once no request is outstanding for it; it may
+    # have been requested again between leaving request_lock and getting here
+    def _release_block(self, piece_index: int, offset: int) -> tuple:
+        piece = self.pieces[piece_index]
+        block = offset // BLOCK_SIZE
+        with self._piece_lock(piece_index):
+            with self.request_lock:
+                requested = bool(self.requests.requesters(piece_index, offset))
+            if not requested:
+                piece.release_block(block)
+        return (piece_index, offset, piece.block_length(block))
 
     # Reset all requests for a piece (for timeout handling)
     def reset_piece_requests(self, piece_index: int):
-        with self.lock:
-            if piece_index in self.pieces:
-                self.pieces[piece_index].reset_block_requests()
+        piece = self._get_piece(piece_index)
+        if piece is not None:
+            with self._piece_lock(piece_index):
+                piece.reset_block_requests()
+                with self.request_lock:
+                    for block in range(piece.num_blocks):
+                        self.requests.pop_block(piece_index, block * BLOCK_SIZE)
 
     # Check if all pieces are completed
     def is_complete(self) -> bool:
@@ -207,28 +791,43 @@ class PieceManager:
 
     # Get data for a completed piece
     def get_piece_data(self, piece_index: int) -> Optional[bytes]:
-        with self.lock:
-            if (piece_index in self.completed_pieces and 
-                piece_index in self.pieces):
-                return bytes(self.pieces[piece_index].data)
+        piece = self._get_piece(piece_index)
+        if piece is None:
             return None
+        with self._piece_lock(piece_index):
+            if piece.verified and piece.data is not None:
+                return bytes(piece.data)
+            return None  # Not verified yet, or already written and its buffer returned
+
+    # Snapshot of the progress counters; takes no lock, so counters updated by
+    # other threads at the same moment may be a block or a piece apart
+    def get_progress(self) -> Dict[str, int]:
+        return {
+            'verified_bytes': self.verified_bytes.value(),
+            'unverified_bytes': self.unverified_bytes.value(),
+            'duplicate_bytes': self.duplicate_bytes.value(),
+            'hash_failed_bytes': self.hash_failed_bytes.value(),
+        }
 
     # Get download statistics
     def get_download_stats(self) -> Dict:
-        with self.lock:
-            total_pieces = len(self.pieces)
-            completed_pieces = len(self.completed_pieces)
-            
-            # Calculate bytes downloaded
-            bytes_downloaded = 0
-            for piece_index in self.completed_pieces:
-                bytes_downloaded += self.pieces[piece_index].length
-            
-            return {
-                'total_pieces': total_pieces,
-                'completed_pieces': completed_pieces,
-                'completion_percentage': self.get_completion_percentage(),
-                'bytes_downloaded': bytes_downloaded,
-                'total_bytes': self.torrent.total_length
-            }
+        progress = self.get_progress()
+        return {
+            'total_pieces': len(self.pieces),
+            'completed_pieces': len(self.completed_pieces),
+            'completion_percentage': self.get_completion_percentage(),
+            'bytes_downloaded': progress['verified_bytes'],
+            'unverified_bytes': progress['unverified_bytes'],
+            'duplicate_bytes': progress['duplicate_bytes'],
+            'hash_failed_bytes': progress['hash_failed_bytes'],
+            'buffer_bytes': self.buffers.total_bytes(),
+            'total_bytes': self.torrent.total_length
+        }
 
+    # Time spent waiting for each lock: acquisitions, how many had to wait and for how long
+    def get_lock_stats(self) -> Dict[str, Dict]:
+        return {
+            'picker': self.picker_lock.get_stats(),
+            'pieces': combined_stats(self.piece_locks),
+            'requests': self.request_lock.get_stats(),
+        }
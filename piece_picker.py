@@ -0,0 +1,146 @@
+import random
+from typing import Callable, Iterable, Optional
+from bitfield import Bitfield
+
+# Tracks how many connected peers have each piece and picks rarest pieces first.
+# Wanted pieces live in buckets keyed by availability count; each piece knows its
+# position in its bucket so moving it between buckets is a constant-time swap.
+class PiecePicker:
+
+    def __init__(self, num_pieces: int):
+        self.num_pieces = num_pieces
+        self.availability = [0] * num_pieces
+        self.buckets = [list(range(num_pieces))]  # availability -> wanted piece indices
+        self.positions = list(range(num_pieces))  # piece -> index within its bucket
+        self.wanted = [True] * num_pieces
+        self.partial = set()  # Wanted pieces with blocks already requested or received
+
+    # A peer announced it has a piece
+    def increment(self, piece_index: int):
+        count = self.availability[piece_index]
+        self.availability[piece_index] = count + 1
+        if self.wanted[piece_index]:
+            self._move(piece_index, count, count + 1)
+
+    # A peer that had a piece went away
+    def decrement(self, piece_index: int):
+        count = self.availability[piece_index]
+        if count == 0:
+            return
+        self.availability[piece_index] = count - 1
+        if self.wanted[piece_index]:
+            self._move(piece_index, count, count - 1)
+
+    # Count every piece in a peer's bitfield
+    def add_pieces(self, piece_indices: Iterable[int]):
+        for piece_index in piece_indices:
+            if piece_index < self.num_pieces:
+                self.increment(piece_index)
+
+    # Forget every piece of a departed peer
+    def remove_pieces(self, piece_indices: Iterable[int]):
+        for piece_index in piece_indices:
+            if piece_index < self.num_pieces:
+                self.decrement(piece_index)
+
+    # A peer announced it has a piece
+    def peer_have(self, peer, piece_index: int):
+        if 0 <= piece_index < self.num_pieces:
+            self.increment(piece_index)
+
+    # A peer's bitfield arrived; added holds the pieces not already counted from HAVEs
+    def add_peer(self, peer, added: Bitfield):
+        self.add_pieces(added.iter_set())
+
+    # Forget a departed peer's pieces
+    def remove_peer(self, peer):
+        if peer.peer_pieces.count:
+            self.remove_pieces(peer.peer_pieces.iter_set())
+
+    # Note that a piece has been started so it is finished before new ones
+    def mark_partial(self, piece_index: int):
+        if self.wanted[piece_index]:
+            self.partial.add(piece_index)
+
+    # Note that a piece has no requested or received blocks any more
+    def clear_partial(self, piece_index: int):
+        self.partial.discard(piece_index)
+
+    # Stop picking a piece once it has been verified
+    def mark_have(self, piece_index: int):
+        if not self.wanted[piece_index]:
+            return
+        self.wanted[piece_index] = False
+        self.partial.discard(piece_index)
+        self._remove(piece_index, self.availability[piece_index])
+
+    # Pick a verified piece again after all, as it could not be written
+    def mark_missing(self, piece_index: int):
+        if self.wanted[piece_index]:
+            return
+        self.wanted[piece_index] = True
+        self._add(piece_index, self.availability[piece_index])
+
+    # Pick the rarest wanted piece the peer has, preferring partially downloaded pieces.
+    # is_pickable filters out pieces with nothing left to request; with new_pieces
+    # False (no memory for another piece buffer) only partial pieces are considered.
+    def pick(self, peer, is_pickable: Callable[[int], bool],
+             new_pieces: bool = True) -> Optional[int]:
+        has_piece = peer.has_piece
+        best = None
+        best_count = None
+        ties = 0
+        for piece_index in self.partial:
+            count = self.availability[piece_index]
+            if best_count is not None and count > best_count:
+                continue
+            if not has_piece(piece_index) or not is_pickable(piece_index):
+                continue
+            if count != best_count:
+                best_count = count
+                ties = 0
+            # Reservoir sampling keeps the choice among equally rare pieces uniform
+            ties += 1
+            if random.randrange(ties) == 0:
+                best = piece_index
+        if best is not None or not new_pieces:
+            return best
+
+        # Rarest first; pieces nobody has (bucket 0) can never be requested
+        for count in range(1, len(self.buckets)):
+            bucket = self.buckets[count]
+            size = len(bucket)
+            if not size:
+                continue
+
+            # Start at a random position so ties are broken randomly
+            start = random.randrange(size)
+            for i in range(size):
+                piece_index = bucket[(start + i) % size]
+                if piece_index in self.partial:
+                    continue
+                if has_piece(piece_index) and is_pickable(piece_index):
+                    return piece_index
+        return None
+
+    # Move a wanted piece between availability buckets
+    def _move(self, piece_index: int, old_count: int, new_count: int):
+        self._remove(piece_index, old_count)
+        self._add(piece_index, new_count)
+
+    # Append a piece to the bucket for count
+    def _add(self, piece_index: int, count: int):
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        bucket = self.buckets[count]
+        self.positions[piece_index] = len(bucket)
+        bucket.append(piece_index)
+
+    # Swap-remove a piece from its bucket
+    def _remove(self, piece_index: int, count: int):
+        bucket = self.buckets[count]
+        position = self.positions[piece_index]
+        last = bucket.pop()
+        if last != piece_index:
+            bucket[position] = last
+            self.positions[last] = position
@@ -0,0 +1,140 @@
+import math
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# Hashed timer wheel: keys are filed into one-second slots by deadline, so
+# advancing the clock only looks at the slots that came due instead of every
+# scheduled key. Cancelled keys are dropped lazily when their slot comes up.
+class TimerWheel:
+
+    def __init__(self, horizon: float, tick: float = 1.0):
+        self.tick = tick
+        self.slots = [set() for _ in range(int(math.ceil(horizon / tick)) + 1)]
+        self.deadlines = {}  # key -> deadline
+        self.current_tick = None
+
+    # Schedule (or reschedule) key to expire at deadline
+    def schedule(self, key: Hashable, deadline: float):
+        self.deadlines[key] = deadline
+        self.slots[int(deadline / self.tick) % len(self.slots)].add(key)
+        if self.current_tick is None:
+            self.current_tick = int(deadline / self.tick) - len(self.slots) + 1
+
+    # Forget key; its slot entry is discarded when the slot is next visited
+    def cancel(self, key: Hashable):
+        self.deadlines.pop(key, None)
+
+    # Return every key whose deadline is at or before now
+    def advance(self, now: float) -> List[Hashable]:
+        now_tick = int(now / self.tick)
+        if self.current_tick is None:
+            self.current_tick = now_tick
+            return []
+
+        expired = []
+        first_tick = max(self.current_tick, now_tick - len(self.slots) + 1)
+        for tick in range(first_tick, now_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in list(slot):
+                deadline = self.deadlines.get(key)
+                if deadline is None:
+                    slot.discard(key)
+                elif deadline <= now:
+                    slot.discard(key)
+                    del self.deadlines[key]
+                    expired.append(key)
+                # Later deadlines stay for a future turn of the wheel
+        self.current_tick = now_tick
+        return expired
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+# Tracks every outstanding block request with the peers it was sent to and
+# when, indexed both by block and by peer, and expires stale requests.
+class RequestTracker:
+
+    def __init__(self, timeout: float = 30.0):
+        self.timeout = timeout
+        self.blocks = {}   # (piece_index, offset) -> {peer: sent time}
+        self.by_peer = {}  # peer -> set of (piece_index, offset)
+        self.wheel = TimerWheel(timeout)
+
+    # Record that block was requested from peer
+    def add(self, peer, piece_index: int, offset: int, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        key = (piece_index, offset)
+        self.blocks.setdefault(key, {})[peer] = now
+        self.by_peer.setdefault(peer, set()).add(key)
+        self.wheel.schedule((peer, piece_index, offset), now + self.timeout)
+
+    # Peers currently asked for a block, with their send times
+    def requesters(self, piece_index: int, offset: int) -> Dict:
+        return self.blocks.get((piece_index, offset), {})
+
+    # Drop one peer's request; returns True if nobody has the block requested any more
+    def remove(self, peer, piece_index: int, offset: int) -> bool:
+        key = (piece_index, offset)
+        requesters = self.blocks.get(key)
+        if requesters is None:
+            return True
+        if requesters.pop(peer, None) is not None:
+            self._forget(peer, piece_index, offset)
+        if requesters:
+            return False
+        del self.blocks[key]
+        return True
+
+    # Drop every request for a block (it arrived or its piece was reset)
+    def pop_block(self, piece_index: int, offset: int) -> Dict:
+        requesters = self.blocks.pop((piece_index, offset), {})
+        for peer in requesters:
+            self._forget(peer, piece_index, offset)
+        return requesters
+
+    # Drop every request sent to peer; returns the blocks nobody else has requested
+    def pop_peer(self, peer) -> List[Tuple[int, int]]:
+        released = []
+        for piece_index, offset in self.by_peer.pop(peer, ()):
+            self.wheel.cancel((peer, piece_index, offset))
+            requesters = self.blocks.get((piece_index, offset))
+            if requesters is None:
+                continue
+            requesters.pop(peer, None)
+            if not requesters:
+                del self.blocks[(piece_index, offset)]
+                released.append((piece_index, offset))
+        return released
+
+    # Expire requests older than the timeout: returns (peer, piece_index, offset, released)
+    # where released is True when no other peer still has the block requested
+    def expire(self, now: Optional[float] = None) -> List[Tuple]:
+        now = time.time() if now is None else now
+        expired = []
+        for peer, piece_index, offset in self.wheel.advance(now):
+            peer_blocks = self.by_peer.get(peer)
+            if peer_blocks is not None:
+                peer_blocks.discard((piece_index, offset))
+                if not peer_blocks:
+                    del self.by_peer[peer]
+            requesters = self.blocks.get((piece_index, offset))
+            if requesters is None or requesters.pop(peer, None) is None:
+                continue
+            released = not requesters
+            if released:
+                del self.blocks[(piece_index, offset)]
+            expired.append((peer, piece_index, offset, released))
+        return expired
+
+    # Remove a single (peer, block) entry from the peer index and the wheel
+    def _forget(self, peer, piece_index: int, offset: int):
+        self.wheel.cancel((peer, piece_index, offset))
+        peer_blocks = self.by_peer.get(peer)
+        if peer_blocks is not None:
+            peer_blocks.discard((piece_index, offset))
+            if not peer_blocks:
+                del self.by_peer[peer]
+
+    # Number of blocks with at least one outstanding request
+    def __len__(self) -> int:
+        return len(self.blocks)
@@ -0,0 +1,167 @@
+import os
+import struct
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+from bencode import bdecode, bencode
+from piece_manager import BLOCK_SIZE
+
+RESUME_VERSION = 1
+
+# Pack indices into a BitTorrent-style bitfield (high bit of byte 0 is index 0)
+def pack_bits(indices: Iterable[int], length: int) -> bytes:
+    bits = bytearray((length + 7) // 8)
+    for index in indices:
+        bits[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(bits)
+
+# Unpack a bitfield into the set indices below length
+def unpack_bits(bits: bytes, length: int) -> List[int]:
+    indices = []
+    for byte_index, byte in enumerate(bits[:(length + 7) // 8]):
+        if not byte:
+            continue
+        for bit in range(8):
+            index = byte_index * 8 + bit
+            if byte & (0x80 >> bit) and index < length:
+                indices.append(index)
+    return indices
+
+# State recovered from a fast-resume file
+class ResumeState:
+    def __init__(self, pieces: Set[int], partial: Dict[int, List[int]], trusted: bool):
+        self.pieces = pieces    # Verified pieces
+        self.partial = partial  # piece_index -> numbers of blocks already on disk
+        self.trusted = trusted  # Files are unchanged since a clean save; skip rechecking
+
+# Fast-resume data for one torrent: a bencoded checkpoint holding the verified
+# piece bitfield, block bitmaps of partial pieces and file sizes/mtimes, plus a
+# journal of pieces written since. The checkpoint is replaced atomically and
+# folds the journal in. It is only trusted without a recheck when every file
+# still has the size and mtime recorded at a clean shutdown.
+class ResumeStore:
+
+    def __init__(self, torrent_file, download_dir: str):
+        self.torrent = torrent_file
+        self.download_dir = download_dir
+        name = self.torrent.info_hash.hex()
+        self.path = os.path.join(download_dir, f".{name}.fastresume")
+        self.journal_path = self.path + ".journal"
+        self.journal = None
+        self.lock = threading.Lock()  # Pieces are journaled from disk threads
+
+    # Load the checkpoint and journal; None if there is nothing usable
+    def load(self) -> Optional[ResumeState]:
+        num_pieces = self.torrent.get_total_pieces()
+        pieces = set()
+        partial = {}
+        trusted = False
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = bdecode(f.read())
+
+            if (data.get(b'version') != RESUME_VERSION or
+                    data.get(b'info-hash') != self.torrent.info_hash):
+                print("Ignoring fast-resume data for a different torrent")
+                return None
+
+            pieces.update(unpack_bits(data[b'pieces'], num_pieces))
+            for key, bits in data.get(b'partial', {}).items():
+                piece_index = int(key)
+                if 0 <= piece_index < num_pieces:
+                    partial[piece_index] = unpack_bits(bits, self._num_blocks(piece_index))
+            trusted = data.get(b'files') == self.file_stats()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error reading fast-resume file {self.path}: {e}")
+
+        # Pieces written since the checkpoint; the files changed after it, so recheck
+        try:
+            with open(self.journal_path, 'rb') as f:
+                journal = f.read()
+            for (piece_index,) in struct.iter_unpack('>I', journal[:len(journal) // 4 * 4]):
+                if piece_index < num_pieces and piece_index not in pieces:
+                    pieces.add(piece_index)
+                    trusted = False
+        except FileNotFoundError:
+            pass
+
+        # Saved blocks of partial pieces are only as good as the files around them
+        if not trusted:
+            partial = {}
+        if not pieces and not partial:
+            return None
+
+        for piece_index in pieces:
+            partial.pop(piece_index, None)
+        return ResumeState(pieces, partial, trusted)
+
+    # Append a written piece to the journal
+    def record_piece(self, piece_index: int):
+        with self.lock:
+            try:
+                if self.journal is None:
+                    self.journal = open(self.journal_path, 'ab', buffering=0)
+                self.journal.write(struct.pack('>I', piece_index))
+            except Exception as e:
+                print(f"Error writing fast-resume journal: {e}")
+
+    # Write a checkpoint of piece_manager's completed pieces and start a fresh journal.
+    # partial maps piece_index to the blocks already on disk. Files are only recorded
+    # for a clean checkpoint taken at shutdown once every write has finished;
+    # otherwise the next start would trust files that changed afterwards.
+    def save(self, piece_manager, partial: Optional[Dict[int, List[int]]] = None, clean: bool = False):
+        with self.lock:
+            # Snapshot under the lock so a piece is always in the checkpoint or the new journal
+            pieces = piece_manager.get_completed_pieces()
+            data = {
+                'version': RESUME_VERSION,
+                'info-hash': self.torrent.info_hash,
+                'pieces': pack_bits(pieces, self.torrent.get_total_pieces()),
+                'partial': {str(piece_index): pack_bits(blocks, self._num_blocks(piece_index))
+                            for piece_index, blocks in (partial or {}).items() if blocks},
+                'files': self.file_stats() if clean else [],
+            }
+            self._write_checkpoint(data)
+
+    # Atomically replace the checkpoint, then empty the journal (lock must be held)
+    def _write_checkpoint(self, data: Dict):
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(bencode(data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+
+            # Everything in the journal is now in the checkpoint
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            open(self.journal_path, 'wb').close()
+        except Exception as e:
+            print(f"Error saving fast-resume file {self.path}: {e}")
+
+    # Size and mtime of every file, [-1, 0] for files that do not exist
+    def file_stats(self) -> List[List[int]]:
+        stats = []
+        for file_info in self.torrent.files:
+            file_path = os.path.join(self.download_dir, *file_info['path'])
+            try:
+                st = os.stat(file_path)
+                stats.append([st.st_size, st.st_mtime_ns])
+            except FileNotFoundError:
+                stats.append([-1, 0])
+        return stats
+
+    # Close the journal
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    # Number of blocks in a piece
+    def _num_blocks(self, piece_index: int) -> int:
+        return (self.torrent.get_piece_length(piece_index) + BLOCK_SIZE - 1) // BLOCK_SIZE
@@ -0,0 +1,269 @@
+import random
+from typing import Callable, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from bitfield import Bitfield
+
+# Rows added to the peer matrix or the level masks at a time when they fill up
+MATRIX_GROWTH = 64
+
+# Peers with at most one piece in this many are picked for by gathering the
+# availability of every piece they offer; denser peers scan the level masks
+SPARSE_PEER_RATIO = 1024
+
+
+# Rarest-first picker over a NumPy availability matrix. Every connected peer's
+# pieces are a row of a packed uint8 matrix in wire bit order, and availability is
+# the column sums of that matrix, added to or taken away from a whole row at a
+# time. Wanted pieces not yet started are also kept as one packed mask per
+# availability count, the vector form of PiecePicker's buckets: a bitfield moves
+# every piece it holds up a level with a few whole-array operations. A pick ANDs
+# the peer's row with the rarest non-empty levels until one has a piece the peer
+# can give us; for peers with few pieces it instead looks up the availability of
+# all of them at once. Same interface as PiecePicker.
+class SwarmMatrixPicker:
+
+    def __init__(self, num_pieces: int):
+        if np is None:
+            raise RuntimeError("NumPy is not installed")
+        self.num_pieces = num_pieces
+        # Rows are padded to whole 64-bit words so they can be scanned a word at a time
+        self.num_bytes = (num_pieces + 63) // 64 * 8
+        self.matrix = np.zeros((0, self.num_bytes), dtype=np.uint8)
+        self.rows = {}        # peer -> its row in the matrix
+        self.free_rows = []
+        self.row_counts = np.zeros(0, dtype=np.int64)  # Pieces in each row
+        self.availability = np.zeros(num_pieces, dtype=np.int32)
+        self.wanted = self._all_pieces()
+        self.open = self._all_pieces()  # Wanted pieces not yet started
+        self.partial = set()  # Wanted pieces with blocks already requested or received
+
+        # Open pieces by availability: level_masks[count] and how many each holds
+        self.level_masks = np.zeros((MATRIX_GROWTH, self.num_bytes), dtype=np.uint8)
+        self.level_masks[0] = self.open
+        self.level_sizes = np.zeros(MATRIX_GROWTH, dtype=np.int64)
+        self.level_sizes[0] = num_pieces
+        self.top_level = 0  # Highest level with any pieces
+
+    # Packed bits with every piece set and the padding clear
+    def _all_pieces(self):
+        bits = np.zeros(self.num_bytes, dtype=np.uint8)
+        bits[:self.num_pieces // 8] = 0xff
+        if self.num_pieces % 8:
+            bits[self.num_pieces // 8] = (0xff << (8 - self.num_pieces % 8)) & 0xff
+        return bits
+
+    # Row of a peer, taking a free one (and growing the matrix) for a new peer
+    def _row(self, peer) -> int:
+        row = self.rows.get(peer)
+        if row is None:
+            if not self.free_rows:
+                size = len(self.matrix)
+                self.matrix = self._grow(self.matrix, size + MATRIX_GROWTH)
+                self.row_counts = self._grow(self.row_counts, size + MATRIX_GROWTH)
+                self.free_rows = list(range(size + MATRIX_GROWTH - 1, size - 1, -1))
+            row = self.free_rows.pop()
+            self.rows[peer] = row
+        return row
+
+    # Copy of array with room for rows rows, the new ones zero
+    @staticmethod
+    def _grow(array, rows: int):
+        grown = np.zeros((rows,) + array.shape[1:], dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    # Make sure level_masks has a row for level
+    def _reserve_level(self, level: int):
+        if level >= len(self.level_masks):
+            size = level + MATRIX_GROWTH
+            self.level_masks = self._grow(self.level_masks, size)
+            self.level_sizes = self._grow(self.level_sizes, size)
+
+    # Move an open piece between levels
+    def _move(self, piece_index: int, old_level: int, new_level: int):
+        byte, mask = piece_index >> 3, 0x80 >> (piece_index & 7)
+        self._reserve_level(new_level)
+        self.level_masks[old_level, byte] &= 0xff ^ mask
+        self.level_masks[new_level, byte] |= mask
+        self.level_sizes[old_level] -= 1
+        self.level_sizes[new_level] += 1
+        self.top_level = max(self.top_level, new_level)
+
+    # Recount level_sizes after a whole-row update
+    def _count_levels(self):
+        open_pieces = np.flatnonzero(np.unpackbits(self.open, count=self.num_pieces))
+        counts = np.bincount(self.availability[open_pieces], minlength=1)
+        self._reserve_level(len(counts))
+        self.level_sizes[:] = 0
+        self.level_sizes[:len(counts)] = counts
+        self.top_level = len(counts) - 1
+
+    # A peer announced it has a piece
+    def peer_have(self, peer, piece_index: int):
+        if not 0 <= piece_index < self.num_pieces:
+            return
+        index = self._row(peer)  # May grow, and so replace, the matrix
+        row = self.matrix[index]
+        byte, mask = piece_index >> 3, 0x80 >> (piece_index & 7)
+        if row[byte] & mask:
+            return
+        row[byte] |= mask
+        self.row_counts[index] += 1
+        count = int(self.availability[piece_index])
+        self.availability[piece_index] = count + 1
+        if self.open[byte] & mask:
+            self._move(piece_index, count, count + 1)
+
+    # A peer's bitfield arrived; added holds the pieces not already counted from HAVEs
+    def add_peer(self, peer, added: Bitfield):
+        index = self._row(peer)
+        row = self.matrix[index]
+        new = np.zeros(self.num_bytes, dtype=np.uint8)
+        new[:len(added.bits)] = np.frombuffer(added.bits, dtype=np.uint8)
+        new &= ~row
+        row |= new
+        unpacked = np.unpackbits(new, count=self.num_pieces)
+        self.row_counts[index] += int(np.count_nonzero(unpacked))
+        self.availability += unpacked
+
+        # Every new piece goes up a level, from the top level down
+        self._reserve_level(self.top_level + 1)
+        levels = self.level_masks
+        for level in range(self.top_level, -1, -1):
+            if self.level_sizes[level]:
+                moved = levels[level] & new
+                levels[level] ^= moved
+                levels[level + 1] |= moved
+        self._count_levels()
+
+    # Forget a departed peer: its row comes off the column sums and is reused
+    def remove_peer(self, peer):
+        index = self.rows.pop(peer, None)
+        if index is None:
+            return
+        row = self.matrix[index]
+        self.availability -= np.unpackbits(row, count=self.num_pieces)
+
+        # Every piece of the peer goes down a level, from the bottom level up
+        levels = self.level_masks
+        for level in range(1, self.top_level + 1):
+            if self.level_sizes[level]:
+                moved = levels[level] & row
+                levels[level] ^= moved
+                levels[level - 1] |= moved
+        self._count_levels()
+
+        row[:] = 0
+        self.row_counts[index] = 0
+        self.free_rows.append(index)
+
+    # Take an open piece out of the levels once it is started or verified
+    def _close(self, piece_index: int):
+        byte, mask = piece_index >> 3, 0x80 >> (piece_index & 7)
+        if self.open[byte] & mask:
+            self.open[byte] &= 0xff ^ mask
+            level = int(self.availability[piece_index])
+            self.level_masks[level, byte] &= 0xff ^ mask
+            self.level_sizes[level] -= 1
+
+    # Note that a piece has been started so it is finished before new ones
+    def mark_partial(self, piece_index: int):
+        if self.wanted[piece_index >> 3] & (0x80 >> (piece_index & 7)):
+            self.partial.add(piece_index)
+            self._close(piece_index)
+
+    # Put a wanted piece back in the levels at its availability
+    def _open(self, piece_index: int):
+        byte, mask = piece_index >> 3, 0x80 >> (piece_index & 7)
+        level = int(self.availability[piece_index])
+        self._reserve_level(level)
+        self.open[byte] |= mask
+        self.level_masks[level, byte] |= mask
+        self.level_sizes[level] += 1
+        self.top_level = max(self.top_level, level)
+
+    # Note that a piece has no requested or received blocks any more
+    def clear_partial(self, piece_index: int):
+        if piece_index in self.partial:
+            self.partial.discard(piece_index)
+            self._open(piece_index)
+
+    # Stop picking a piece once it has been verified
+    def mark_have(self, piece_index: int):
+        self._close(piece_index)
+        self.wanted[piece_index >> 3] &= 0xff ^ (0x80 >> (piece_index & 7))
+        self.partial.discard(piece_index)
+
+    # Pick a verified piece again after all, as it could not be written
+    def mark_missing(self, piece_index: int):
+        byte, mask = piece_index >> 3, 0x80 >> (piece_index & 7)
+        if not self.wanted[byte] & mask:
+            self.wanted[byte] |= mask
+            self._open(piece_index)
+
+    # Pick the rarest wanted piece the peer has, preferring partially downloaded pieces.
+    # is_pickable filters out pieces with nothing left to request; with new_pieces
+    # False (no memory for another piece buffer) only partial pieces are considered.
+    def pick(self, peer, is_pickable: Callable[[int], bool],
+             new_pieces: bool = True) -> Optional[int]:
+        index = self.rows.get(peer)
+        if index is None:
+            return None
+        row = self.matrix[index]
+
+        if self.partial:
+            candidates = np.fromiter(self.partial, dtype=np.int64, count=len(self.partial))
+            has = row[candidates >> 3] & (0x80 >> (candidates & 7)).astype(np.uint8)
+            best = self._rarest(candidates[has != 0], is_pickable)
+            if best is not None:
+                return best
+        if not new_pieces:
+            return None
+
+        if self.row_counts[index] * SPARSE_PEER_RATIO <= self.num_pieces:
+            return self._rarest(self._pieces_in(row & self.open), is_pickable)
+
+        # Rarest first; pieces nobody has (level 0) can never be requested
+        for level in range(1, self.top_level + 1):
+            if self.level_sizes[level]:
+                offered = row & self.level_masks[level]
+                if offered.view(np.uint64).any():
+                    piece_index = self._first_pickable(self._pieces_in(offered), is_pickable)
+                    if piece_index is not None:
+                        return piece_index
+        return None
+
+    # Indices of the set bits of packed bits, unpacking only the non-zero words
+    def _pieces_in(self, bits):
+        words = np.flatnonzero(bits.view(np.uint64))
+        positions = np.flatnonzero(np.unpackbits(bits.reshape(-1, 8)[words]))
+        return words[positions >> 6] * 64 + (positions & 63)
+
+    # Rarest pickable piece among candidates; pieces nobody has are never returned
+    def _rarest(self, candidates, is_pickable: Callable[[int], bool]) -> Optional[int]:
+        counts = self.availability[candidates]
+        keep = counts > 0
+        candidates, counts = candidates[keep], counts[keep]
+        while len(candidates):
+            rarest = counts == counts.min()
+            piece_index = self._first_pickable(candidates[rarest], is_pickable)
+            if piece_index is not None:
+                return piece_index
+            candidates, counts = candidates[~rarest], counts[~rarest]
+        return None
+
+    # First pickable piece of equally rare candidates, starting at a random
+    # position so ties are broken randomly
+    def _first_pickable(self, candidates, is_pickable: Callable[[int], bool]) -> Optional[int]:
+        size = len(candidates)
+        start = random.randrange(size)
+        for i in range(size):
+            piece_index = int(candidates[(start + i) % size])
+            if is_pickable(piece_index):
+                return piece_index
+        return None
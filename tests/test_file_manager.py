@@ -0,0 +1,59 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_manager import FileManager
+from file_table import FileTable
+
+PIECE_LENGTH = 16384
+
+
+# Just enough of TorrentFile for FileManager
+class StubTorrent:
+    def __init__(self, piece_length: int, file_lengths):
+        self.piece_length = piece_length
+        self.files = FileTable()
+        for i, length in enumerate(file_lengths):
+            self.files.append(['test', f'file{i}.bin'], length)
+        self.total_length = sum(file_lengths)
+
+    def get_piece_length(self, piece_index: int) -> int:
+        return min(self.piece_length, self.total_length - piece_index * self.piece_length)
+
+
+class WriteFailureTest(unittest.TestCase):
+
+    # Pieces landing in a file that cannot be opened are reported as not written,
+    # and pieces of the same batch in other files still are
+    def test_failed_write_is_reported(self):
+        torrent = StubTorrent(PIECE_LENGTH, [2 * PIECE_LENGTH, 2 * PIECE_LENGTH])
+        written = {}
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            # A directory where the second file should be makes its writes fail
+            os.makedirs(os.path.join(directory, 'test', 'file1.bin'))
+            manager = FileManager(torrent, directory)
+            manager.on_piece_written = lambda piece_index, ok: written.__setitem__(piece_index, ok)
+            for piece_index in range(4):
+                manager.write_piece(piece_index, memoryview(bytes(PIECE_LENGTH)))
+            manager.cleanup()
+        self.assertEqual(written, {0: True, 1: True, 2: False, 3: False})
+
+    # Blocks saved at shutdown only count as saved if every write succeeded
+    def test_failed_block_write_is_reported(self):
+        torrent = StubTorrent(PIECE_LENGTH, [PIECE_LENGTH, PIECE_LENGTH])
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            os.makedirs(os.path.join(directory, 'test', 'file1.bin'))
+            manager = FileManager(torrent, directory)
+            data = memoryview(bytes(PIECE_LENGTH))
+            self.assertTrue(manager.write_blocks(0, [0, 1], data, PIECE_LENGTH // 2))
+            self.assertFalse(manager.write_blocks(1, [0, 1], data, PIECE_LENGTH // 2))
+            manager.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitfield import Bitfield
+from peer import BLOCK_REQUEST_SIZE, REQUEST_QUEUE_TIME, PeerConnection
+
+
+# Stands in for time.time so the simulated link sets the clock
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class PipelineSizingTest(unittest.TestCase):
+
+    # A peer serving requests one after another at rate bytes per second, each
+    # block arriving half a round trip after it is sent; returns the connection
+    # and the longest latency seen once the pipeline has settled
+    def simulate(self, rate: float, rtt: float, duration: float = 120.0):
+        peer = PeerConnection('10.0.0.1', 6881, bytes(20), bytes(20), 1)
+        peer.connected = True
+        peer.peer_choking = False
+        peer.peer_pieces = Bitfield.from_indices([0], 1)
+        peer._send_message = lambda message_id, payload: None
+
+        clock = FakeClock()
+        end = clock.now + duration
+        in_flight = []  # (arrival time, begin) in the order the peer serves them
+        server_free = clock.now
+        next_begin = 0
+        longest = 0.0
+        with mock.patch('peer.time.time', clock):
+            while clock.now < end:
+                while peer.available_request_slots() > 0:
+                    self.assertTrue(peer.request_piece(0, next_begin, BLOCK_REQUEST_SIZE))
+                    served = max(server_free, clock.now + rtt / 2) + BLOCK_REQUEST_SIZE / rate
+                    server_free = served
+                    in_flight.append((served + rtt / 2, next_begin, clock.now))
+                    next_begin += BLOCK_REQUEST_SIZE
+
+                arrival, begin, sent = in_flight.pop(0)
+                clock.now = arrival
+                peer._handle_piece(0, begin, memoryview(bytes(BLOCK_REQUEST_SIZE)))
+                if clock.now > end - duration / 2:
+                    longest = max(longest, arrival - sent)
+        return peer, longest
+
+    # Depth the bandwidth-delay formula gives for a link
+    def expected_depth(self, rate: float, rtt: float) -> float:
+        return rate * max(REQUEST_QUEUE_TIME, 2 * rtt) / BLOCK_REQUEST_SIZE
+
+    def test_depth_does_not_grow_from_own_queueing(self):
+        for rate in (100_000, 1_000_000):
+            peer, longest = self.simulate(rate, rtt=0.05)
+            expected = self.expected_depth(rate, 0.05)
+            self.assertLess(peer.max_requests, expected * 1.3, f"rate {rate}")
+            self.assertGreater(peer.max_requests, expected * 0.7, f"rate {rate}")
+            # Queued requests wait about REQUEST_QUEUE_TIME, far below the request timeout
+            self.assertLess(longest, 2 * REQUEST_QUEUE_TIME, f"rate {rate}")
+
+    def test_round_trip_is_the_shortest_latency(self):
+        peer, _ = self.simulate(1_000_000, rtt=0.05, duration=30.0)
+        self.assertAlmostEqual(peer.min_latency, 0.05 + BLOCK_REQUEST_SIZE / 1_000_000, places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import contextlib
+import hashlib
+import io
+import os
+import random
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitfield import Bitfield
+from peer_scores import CorruptionScores
+from piece_manager import BLOCK_SIZE, PieceManager
+
+# Requests each simulated peer keeps in flight
+PIPELINE = 10
+
+
+# Just enough of TorrentFile for PieceManager, with random piece data
+class StubTorrent:
+    def __init__(self, num_pieces: int, piece_length: int):
+        rng = random.Random(num_pieces)
+        self.num_pieces = num_pieces
+        self.piece_length = piece_length
+        self.total_length = num_pieces * piece_length
+        self.data = rng.randbytes(self.total_length)
+        self.hashes = [hashlib.sha1(self.piece(i)).digest() for i in range(num_pieces)]
+
+    def piece(self, piece_index: int) -> bytes:
+        start = piece_index * self.piece_length
+        return self.data[start:start + self.piece_length]
+
+    def get_total_pieces(self) -> int:
+        return self.num_pieces
+
+    def get_piece_length(self, piece_index: int) -> int:
+        return self.piece_length
+
+    def get_piece_hash(self, piece_index: int) -> bytes:
+        return self.hashes[piece_index]
+
+
+# A seed with every piece; a corrupt one answers every request with zeros
+class StubPeer:
+    def __init__(self, port: int, num_pieces: int, corrupt: bool = False):
+        self.ip = '10.0.0.1'
+        self.port = port
+        self.corrupt = corrupt
+        self.peer_pieces = Bitfield.from_indices(range(num_pieces), num_pieces)
+        self.has_piece = self.peer_pieces.has
+        self.closed = False
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+
+class CorruptionScoresTest(unittest.TestCase):
+
+    def test_sole_sender_is_banned_after_repeat_failures(self):
+        scores = CorruptionScores()
+        peer = StubPeer(1, 1)
+        self.assertEqual(scores.record_failure([peer]), [])
+        self.assertTrue(scores.is_suspect(peer))
+        self.assertEqual(scores.record_failure([peer]), [peer])
+        self.assertTrue(scores.is_banned(peer.ip, peer.port))
+
+    def test_shared_failures_never_ban(self):
+        scores = CorruptionScores()
+        peers = [StubPeer(port, 1) for port in range(3)]
+        for _ in range(10):
+            self.assertEqual(scores.record_failure(peers), [])
+        for peer in peers:
+            self.assertTrue(scores.is_suspect(peer))
+            self.assertFalse(scores.is_banned(peer.ip, peer.port))
+
+    def test_co_senders_of_a_suspect_are_not_blamed(self):
+        scores = CorruptionScores()
+        bad, honest = StubPeer(1, 1), StubPeer(2, 1)
+        scores.record_failure([bad])
+        scores.record_failure([bad, honest])
+        self.assertFalse(scores.is_suspect(honest))
+
+
+class SwarmDownloadTest(unittest.TestCase):
+
+    # Three seeds, one corrupt, answering deep pipelines in random order so that
+    # pieces in flight are shared between peers when the corrupt one is found out.
+    # With silent, the corrupt seed stays connected but stops answering once it is
+    # a suspect, and its requests are left to time out.
+    def download(self, seed: int, silent: bool = False):
+        random.seed(seed)
+        torrent = StubTorrent(num_pieces=40, piece_length=4 * BLOCK_SIZE)
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager = PieceManager(torrent, matrix_picker=False)
+        peers = [StubPeer(6881 + i, torrent.num_pieces, corrupt=(i == 0)) for i in range(3)]
+        active = list(peers)
+        banned = []
+
+        def on_peer_banned(peer):
+            banned.append(peer)
+            active.remove(peer)
+            manager.release_peer_requests(peer)
+            manager.remove_peer_pieces(peer)
+        manager.on_peer_banned = on_peer_banned
+
+        for peer in peers:
+            manager.add_peer_pieces(peer, peer.peer_pieces)
+
+        # Keep every pipeline full and answer one outstanding request at a time
+        outstanding = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(100000):
+                if manager.is_complete():
+                    break
+                for peer in active:
+                    in_flight = sum(1 for other, _ in outstanding if other is peer)
+                    outstanding += [(peer, request) for request in
+                                    manager.get_next_requests(peer, PIPELINE - in_flight)]
+                answering = [i for i, (peer, _) in enumerate(outstanding)
+                             if not (silent and peer.corrupt and manager.scores.is_suspect(peer))]
+                if not answering:
+                    if not outstanding:
+                        break
+                    expired = manager.expire_requests(time.time() + 3600)
+                    expired = {(peer, tuple(request)) for peer, *request in expired}
+                    outstanding = [(peer, request) for peer, request in outstanding
+                                   if (peer, request) not in expired]
+                    continue
+                peer, (piece_index, offset, length) = outstanding.pop(random.choice(answering))
+                if peer not in active:
+                    continue
+                start = piece_index * torrent.piece_length + offset
+                data = bytes(length) if peer.corrupt else torrent.data[start:start + length]
+                manager.add_piece_data(piece_index, offset, memoryview(data), peer)
+        return manager, peers, banned
+
+    def test_corrupt_seed_is_banned_and_download_completes(self):
+        for seed in range(20):
+            manager, peers, banned = self.download(seed)
+            self.assertTrue(manager.is_complete(), f"seed {seed}")
+            self.assertEqual(banned, [peers[0]], f"seed {seed}")
+
+    # The pieces of a suspect that stops answering go to the other peers
+    def test_silent_suspect_does_not_stall_download(self):
+        for seed in range(20):
+            manager, peers, banned = self.download(seed, silent=True)
+            self.assertTrue(manager.is_complete(), f"seed {seed}")
+            self.assertNotIn(peers[1], banned, f"seed {seed}")
+            self.assertNotIn(peers[2], banned, f"seed {seed}")
+
+
+if __name__ == '__main__':
+    unittest.main()
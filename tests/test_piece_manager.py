@@ -0,0 +1,138 @@
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitfield import Bitfield
+from piece_manager import BLOCK_SIZE, PieceManager
+from swarm_matrix import np
+
+NUM_PIECES = 16
+
+
+# Just enough of TorrentFile for PieceManager; every piece is zeros
+class StubTorrent:
+    def __init__(self, num_pieces: int, piece_length: int):
+        self.num_pieces = num_pieces
+        self.piece_length = piece_length
+        self.total_length = num_pieces * piece_length
+        self.piece_hash = hashlib.sha1(bytes(piece_length)).digest()
+
+    def get_total_pieces(self) -> int:
+        return self.num_pieces
+
+    def get_piece_length(self, piece_index: int) -> int:
+        return self.piece_length
+
+    def get_piece_hash(self, piece_index: int) -> bytes:
+        return self.piece_hash
+
+
+class StubPeer:
+    def __init__(self, num_pieces: int, port: int = 6881):
+        self.ip = '10.0.0.1'
+        self.port = port
+        self.peer_pieces = Bitfield.from_indices(range(num_pieces), num_pieces)
+        self.has_piece = self.peer_pieces.has
+        self.closed = False
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+
+class PeerAvailabilityTest(unittest.TestCase):
+
+    def create_manager(self, matrix_picker: bool) -> PieceManager:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return PieceManager(StubTorrent(NUM_PIECES, BLOCK_SIZE), matrix_picker=matrix_picker)
+
+    # A HAVE or BITFIELD handled after the peer's disconnect must not count it again
+    def check_closed_peer_ignored(self, matrix_picker: bool):
+        manager = self.create_manager(matrix_picker)
+        peer = StubPeer(NUM_PIECES)
+        manager.add_peer_pieces(peer, peer.peer_pieces)
+        peer.closed = True
+        manager.remove_peer_pieces(peer)
+
+        manager.add_peer_have(peer, 3)
+        manager.add_peer_pieces(peer, peer.peer_pieces)
+        self.assertEqual(sum(int(count) for count in manager.picker.availability), 0)
+        if matrix_picker:
+            self.assertNotIn(peer, manager.picker.rows)
+
+    def test_closed_peer_ignored(self):
+        self.check_closed_peer_ignored(False)
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_closed_peer_ignored_matrix(self):
+        self.check_closed_peer_ignored(True)
+
+
+class EndgameLandingTest(unittest.TestCase):
+
+    # A slow peer is receiving a block in place when endgame starts: a fast peer
+    # is not sent a duplicate it could not deliver, and gets the block as soon
+    # as the slow peer goes away
+    def test_landing_block_is_not_duplicated(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager = PieceManager(StubTorrent(1, 2 * BLOCK_SIZE), matrix_picker=False)
+        slow, fast = StubPeer(1, 6881), StubPeer(1, 6882)
+        manager.add_peer_pieces(slow, slow.peer_pieces)
+        manager.add_peer_pieces(fast, fast.peer_pieces)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(len(manager.get_next_requests(slow, 2)), 2)
+            self.assertIsNotNone(manager.claim_block_buffer(0, 0, BLOCK_SIZE))
+            self.assertEqual(manager.get_next_requests(fast, 2), [(0, BLOCK_SIZE, BLOCK_SIZE)])
+
+            # Duplicated blocks are not received in place, so the fast copy is accepted
+            self.assertIsNone(manager.claim_block_buffer(0, BLOCK_SIZE, BLOCK_SIZE))
+            self.assertTrue(manager.add_piece_data(0, BLOCK_SIZE, memoryview(bytes(BLOCK_SIZE)), fast))
+            self.assertEqual(manager.duplicate_bytes.value(), 0)
+
+            # The slow peer disconnects mid-block
+            manager.release_block_buffer(0, 0)
+            slow.closed = True
+            manager.release_peer_requests(slow)
+            manager.remove_peer_pieces(slow)
+            self.assertEqual(manager.get_next_requests(fast, 2), [(0, 0, BLOCK_SIZE)])
+            self.assertTrue(manager.add_piece_data(0, 0, memoryview(bytes(BLOCK_SIZE)), fast))
+        self.assertTrue(manager.is_complete())
+
+
+class WriteFailureTest(unittest.TestCase):
+
+    # A verified piece that could not be written is downloaded again
+    def check_piece_downloaded_again(self, matrix_picker: bool):
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager = PieceManager(StubTorrent(1, BLOCK_SIZE), matrix_picker=matrix_picker)
+        manager.on_piece_completed = lambda piece_index, data: None
+        peer = StubPeer(1)
+        manager.add_peer_pieces(peer, peer.peer_pieces)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            for attempt in range(2):
+                self.assertEqual(manager.get_next_requests(peer, 2), [(0, 0, BLOCK_SIZE)])
+                self.assertTrue(manager.add_piece_data(0, 0, memoryview(bytes(BLOCK_SIZE)), peer))
+                self.assertEqual(manager.verified_bytes.value(), BLOCK_SIZE)
+                if attempt == 0:
+                    manager.piece_write_failed(0)
+                    self.assertFalse(manager.is_complete())
+                    self.assertEqual(manager.verified_bytes.value(), 0)
+            manager.piece_written(0)
+        self.assertTrue(manager.is_complete())
+
+    def test_piece_downloaded_again(self):
+        self.check_piece_downloaded_again(False)
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_piece_downloaded_again_matrix(self):
+        self.check_piece_downloaded_again(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import threading
+import time
+from typing import Dict, Iterable
+
+# A lock that records how long threads wait for it. An uncontended acquire is a
+# plain non-blocking acquire; only when that fails is the wait timed. Counters
+# are updated while the lock is held, so they need no lock of their own.
+class TimedLock:
+    __slots__ = ('lock', 'acquisitions', 'contended', 'wait_time', 'max_wait')
+
+    def __init__(self, lock=None):
+        self.lock = lock if lock is not None else threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0    # Acquisitions that had to wait
+        self.wait_time = 0.0  # Seconds spent waiting, in total
+        self.max_wait = 0.0
+
+    def acquire(self):
+        if not self.lock.acquire(False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            wait = time.perf_counter() - start
+            self.contended += 1
+            self.wait_time += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+        self.acquisitions += 1
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+
+    # Wait statistics so far
+    def get_stats(self) -> Dict:
+        return combined_stats([self])
+
+
+# Wait statistics of several locks taken together, e.g. the stripes of a striped lock
+def combined_stats(locks: Iterable[TimedLock]) -> Dict:
+    locks = list(locks)
+    acquisitions = sum(lock.acquisitions for lock in locks)
+    contended = sum(lock.contended for lock in locks)
+    wait_time = sum(lock.wait_time for lock in locks)
+    return {
+        'acquisitions': acquisitions,
+        'contended': contended,
+        'contention_rate': contended / acquisitions if acquisitions else 0.0,
+        'wait_time': wait_time,
+        'mean_wait': wait_time / contended if contended else 0.0,
+        'max_wait': max((lock.max_wait for lock in locks), default=0.0),
+    }
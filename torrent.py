@@ -1,7 +1,11 @@
-import bcoding
 import hashlib
 from typing import Dict, List, Optional, Any, Union
-from utils import sha1_hash, split_into_chunks
+from bencode import bdecode_spans
+from file_table import FileTable
+from utils import sha1_hash
+
+# Length of a SHA1 piece hash
+HASH_LENGTH = 20
 
 # Represents a parsed torrent file
 class TorrentFile:
@@ -10,8 +14,9 @@ class TorrentFile:
         self.torrent_path = torrent_path
         self.data = None
         self.info_hash = None
-        self.piece_hashes = []
-        self.files = []
+        self.piece_hashes = b''  # Every piece's SHA1 back to back, as in the torrent
+        self.num_pieces = 0
+        self.files = FileTable()
         self.total_length = 0
         self.piece_length = 0
         self.name = ""
@@ -45,30 +50,29 @@ class TorrentFile:
             with open(self.torrent_path, 'rb') as f:
                 torrent_data = f.read()
 
-            # Decode bencoded torrent data
-            self.data = bcoding.bdecode(torrent_data)
+            # Decode bencoded torrent data, noting where the info dictionary lies
+            self.data, spans = bdecode_spans(torrent_data, [b'info'])
 
             print(f"Torrent data keys: {list(self.data.keys())}")
 
             info = self._get_key(self.data, 'info')
             print(f"Info keys: {list(info.keys())}")
 
-            # Calculate info hash (SHA1 of bencoded info dictionary)
-            if b'info' in self.data:
-                info_bencoded = bcoding.bencode(self.data[b'info'])
-            else:
-                info_bencoded = bcoding.bencode(self.data['info'])
-            self.info_hash = sha1_hash(info_bencoded)
+            # Calculate info hash (SHA1 of the info dictionary exactly as encoded in the file)
+            info_start, info_end = spans[b'info']
+            self.info_hash = sha1_hash(memoryview(torrent_data)[info_start:info_end])
 
             # Extract basic torrent information
             self.name = self._decode_string(self._get_key(info, 'name'))
             self.piece_length = self._get_key(info, 'piece length')
 
-            # Extract piece hashes (20 bytes each)
+            # Keep the piece hashes (20 bytes each) in the one buffer they were decoded into
             pieces_data = self._get_key(info, 'pieces')
-            if isinstance(pieces_data, str):
-                pieces_data = pieces_data.encode('latin-1')  # Preserve binary data
-            self.piece_hashes = split_into_chunks(pieces_data, 20)
+            if len(pieces_data) % HASH_LENGTH:
+                raise ValueError(f"pieces is {len(pieces_data)} bytes, not a multiple of {HASH_LENGTH}")
+            self.piece_hashes = pieces_data
+            self.num_pieces = len(pieces_data) // HASH_LENGTH
+            self._piece_hash_view = memoryview(self.piece_hashes)
 
             # Extract tracker information
             self.announce = self._decode_string(self._get_key(self.data, 'announce'))
@@ -95,7 +99,7 @@ class TorrentFile:
             print(f"  Name: {self.name}")
             print(f"  Total size: {self.total_length} bytes")
             print(f"  Piece length: {self.piece_length} bytes")
-            print(f"  Number of pieces: {len(self.piece_hashes)}")
+            print(f"  Number of pieces: {self.num_pieces}")
             print(f"  Number of files: {len(self.files)}")
             print(f"  Tracker: {self.announce}")
 
@@ -111,62 +115,47 @@ class TorrentFile:
         self.total_length = file_length
 
         # Single file entry
-        self.files = [{
-            'path': [self.name],
-            'length': file_length,
-            'offset': 0
-        }]
+        self.files = FileTable()
+        self.files.append([self.name], file_length)
 
     # Parse multi-file torrent structure
     def _parse_multi_file(self, info: Dict):
         files_info = self._get_key(info, 'files')
-        offset = 0
+        self.files = FileTable()
 
         for file_info in files_info:
             file_length = self._get_key(file_info, 'length')
             file_path_data = self._get_key(file_info, 'path')
             file_path = [self._decode_string(part) for part in file_path_data]
             
-            self.files.append({
-                'path': [self.name] + file_path,
-                'length': file_length,
-                'offset': offset
-            })
-            
-            offset += file_length
+            self.files.append([self.name] + file_path, file_length)
         
-        self.total_length = offset
+        self.total_length = self.files.total_length()
 
-    # Get SHA1 hash for a specific piece
-    def get_piece_hash(self, piece_index: int) -> bytes:
-        if 0 <= piece_index < len(self.piece_hashes):
-            return self.piece_hashes[piece_index]
+    # Get SHA1 hash for a specific piece, as a view into the hash buffer
+    def get_piece_hash(self, piece_index: int) -> memoryview:
+        if 0 <= piece_index < self.num_pieces:
+            start = piece_index * HASH_LENGTH
+            return self._piece_hash_view[start:start + HASH_LENGTH]
         raise IndexError(f"Piece index {piece_index} out of range")
 
     # Get length of a specific piece (last piece might be shorter)
     def get_piece_length(self, piece_index: int) -> int:
-        if piece_index == len(self.piece_hashes) - 1:
+        if piece_index == self.num_pieces - 1:
             # Last piece might be shorter
             return self.total_length - (piece_index * self.piece_length)
         return self.piece_length
 
     # Get total number of pieces
     def get_total_pieces(self) -> int:
-        return len(self.piece_hashes)
+        return self.num_pieces
 
     # Get list of files that overlap with a specific piece
     def get_files_for_piece(self, piece_index: int) -> List[Dict]:
-        piece_start = piece_index * self.piece_length
-        piece_end = piece_start + self.get_piece_length(piece_index)
-        
-        overlapping_files = []
-        for file_info in self.files:
-            file_start = file_info['offset']
-            file_end = file_start + file_info['length']
-            
-            # Check if piece and file overlap
-            if piece_start < file_end and piece_end > file_start:
-                overlapping_files.append(file_info)
-        
-        return overlapping_files
+        return [self.files[file_index] for file_index in self.get_file_indices_for_piece(piece_index)]
+
+    # Get the indices of the files that overlap with a specific piece
+    def get_file_indices_for_piece(self, piece_index: int) -> List[int]:
+        return self.files.files_in_range(piece_index * self.piece_length,
+                                         self.get_piece_length(piece_index))
 
@@ -5,7 +5,7 @@ import random
 import time
 from typing import List, Tuple, Optional, Dict, Any
 from urllib.parse import urlencode, urlparse
-import bcoding
+from bencode import bdecode
 from utils import bytes_to_int, int_to_bytes, parse_compact_peers, create_peer_id
 
 # Handles communication with BitTorrent trackers
@@ -75,7 +75,7 @@ class TrackerClient:
             response.raise_for_status()
             
             # Decode bencoded response
-            tracker_response = bcoding.bdecode(response.content)
+            tracker_response = bdecode(response.content)
             
             # Check for tracker error
             if b'failure reason' in tracker_response: